@@ -23,10 +23,70 @@ class Config:
     TABLE_LOG = "logs"
     TABLE_ADDRESS = "addresses"
     TABLE_HISTORY = "history"
+    TABLE_STATS = "address_stats"
+
+    # store addresses as integer ids of the address dictionary in the cache and calc dbs
+    # switching it needs new cache files and a new calc db
+    ADDRESS_IDS = False
+    ADDRESS_BOOK = "dbs/addresses.sqlite"
+    # the number of address ids kept in memory
+    ADDRESS_CACHE_SIZE = 10000000
+
+    # format of the finished daily cache files
+    # "sqlite": the sqlite files written while caching
+    # "parquet": columnar files converted from the sqlite files when their days are finished
+    # "arrow": uncompressed Arrow IPC files converted the same way, memory-mapped when calculating
+    CACHE_BACKEND = "sqlite"
+    PARQUET_COMPRESSION = "zstd"
+
+    # merge every fetched chunk into the cache file with bulk statements
+    CACHE_BULK_INGEST = True
+
+    # PRAGMAs for the daily cache sqlite files
+    CACHE_PRAGMAS = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,  # 64MB
+    }
 
     # time seconds between begin and end to load once
     TIME_GAP = 300  # 5 minutes
 
+    # tune the window size toward the target row count and latency of a window
+    # every window still stays in a day
+    ADAPTIVE_GAP = False
+    TARGET_ROWS = 20000
+    TARGET_LATENCY = 5.0  # seconds
+    MIN_GAP = 10  # seconds
+    MAX_GAP = 86400  # seconds
+
+    # csv file reporting every window: begin, end, rows, seconds, next gap
+    # "" doesn't report
+    WINDOW_REPORT = ""
+
+    # number of connections fetching consecutive windows at the same time
+    # 1 fetches the windows one by one
+    FETCH_WORKERS = 1
+
+    # fetch with asyncio, FETCH_WORKERS windows are in flight on a pool of FETCH_CONNECTIONS connections
+    FETCH_ASYNC = False
+    FETCH_CONNECTIONS = 4
+    # seconds of a query before it is retried
+    FETCH_TIMEOUT = 600
+    # retries of a failed query, waiting FETCH_BACKOFF seconds doubled every time up to FETCH_BACKOFF_MAX
+    FETCH_RETRIES = 5
+    FETCH_BACKOFF = 1.0
+    FETCH_BACKOFF_MAX = 60.0
+
+    # rows per round trip of the streaming server-side cursor
+    # 0 fetches a whole window at once
+    FETCH_ITERSIZE = 10000
+
+    # number of fetched windows waiting for the local writes
+    # a fetch thread gets the next windows while the last ones are stored
+    # 0 fetches and stores in turn
+    PIPELINE_DEPTH = 0
+
     # The cached balance unit is Szabo: 1e-6
     # The server balance unit is wei: 1e-18
     # So we multiply 1e-12 to the server balance
@@ -40,11 +100,65 @@ class Config:
     STATUS_CACHE = "status.cache"
     STATUS_CALC = "status.calc"
 
+    # the journal of the cached windows and the calculated days
+    # the status files above are migrated into it at first, and kept as readable copies
+    JOURNAL_FILE = "dbs/journal.sqlite"
+    # seconds after which a claim of a worker is taken over
+    JOURNAL_CLAIM_TIMEOUT = 3600
+
+    # the history columns cached for the analysis, dropped by do_calc when it writes new days
+    HISTORY_CACHE = "dbs/history.npz"
+    # the most points of a history graph, longer history is shown weekly or monthly. 0 to show every day
+    HISTORY_MAX_POINTS = 0
+
+    # the timers, counters and SQL latency histograms of the hot paths.
+    # It is read when the modules are imported, so when it is off the hot paths are not wrapped at all
+    METRICS = False
+    # a JSON line of the summary of every cached or calculated day
+    METRICS_LOG = "metrics.jsonl"
+    # the totals in the Prometheus text format for the textfile collector of the node exporter, "" to skip
+    METRICS_PROM = "metrics.prom"
+
     # threshold days to decide LTH or STH
     WALLET_THRESHOLD = 155
 
+    # the local calc db
+    # "postgresql": LocalCalc on the local PostgreSQL server
+    # "sqlite": SQLiteCalc in the CALC_DB_FILE file, only for the row, set and incremental engines
+    CALC_BACKEND = "postgresql"
+    CALC_DB_FILE = "dbs/calc.sqlite"
+
+    # days of the range mode (do_calc.py --to) that are written in a transaction
+    CALC_RANGE_DAYS = 30
+    # the snapshot of the addresses and the window of the range mode, saved every STATE_SNAPSHOT_DAYS days
+    # and at the end of a range, so the next range starts without reading the tables. 0 not to save or load it
+    STATE_FILE = "dbs/state.npz"
+    STATE_SNAPSHOT_DAYS = 90
+
+    # merge a day's logs with COPY and a few statements instead of queries for every log
+    CALC_BULK_MERGE = True
+
     # calculation chunk size
     CALC_CHUNK_SIZE = 1000
 
+    # worker processes and address hash shards of the parallel engine
+    CALC_WORKERS = 4
+    CALC_SHARDS = 64
+
+    # worker processes reading the logs of the next finished cache files while a day is calculated
+    # the logs read ahead are merged in bulk as with CALC_BULK_MERGE. 0 reads every day in turn
+    PREFETCH_WORKERS = 0
+    # bytes of the logs read ahead, estimated from the record counts of the files
+    PREFETCH_MEMORY = 1 << 30  # 1GB
+
     # Calculation Stage 2) window duration 180
     WINDOW_SIZE = 178
+
+    # Calculation engine for the LTH/STH classification of a day
+    # "row": calculate_lth_sth and update_address_wallet for every address
+    # "set": classify_addresses, a few set-based statements for all addresses
+    # "incremental": only the addresses whose window changed, with running LTH/STH totals
+    # "numpy": ColumnarCalc, the window of logs evaluated as NumPy columns
+    # "parallel": ParallelCalc, calculate_lth_sth over worker processes by address shards
+    # "rolling": the rolling window of every address in the address_stats table
+    CALC_ENGINE = "set"
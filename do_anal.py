@@ -1,12 +1,16 @@
-from libs.local import LocalCalc
+from configuration import Config
+from libs.addressbook import AddressBook
+from libs.history import HistoryStore
+from libs.sqlite_calc import open_calc
+import numpy as np
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from math import log10
 
 
-def get_main_pie(calc):
+def get_main_pie(history):
     # get the data
-    date, lth, sth = calc.get_last_history()
+    date, lth, sth = history.get_last()
 
     fig = make_subplots(rows=2, cols=1, specs=[[{'type': 'domain'}], [{'type': 'domain'}]], subplot_titles=('LTH vs STH', 'Log Percentage'))
     pie = go.Pie(values=[lth, sth], labels=['Long-Term Holding', 'Short-Term Holding'])
@@ -39,6 +43,12 @@ def get_top_address_pie(connection, top_count):
         # subtract top balances
         total_balance = total_balance - balance
 
+    # the ids of the address dictionary are shown as addresses
+    if Config.ADDRESS_IDS:
+        book = AddressBook()
+        addresses = book.decode(addresses)
+        book.close()
+
     # add Others item
     balances.append(total_balance)
     addresses.append('Others')
@@ -46,19 +56,19 @@ def get_top_address_pie(connection, top_count):
     return go.Pie(values=balances, labels=addresses)
 
 
-def get_history_line(calc):
-    data = calc.get_history()
+def get_history_line(history, begin=None, end=None):
+    dates, lth, sth = history.query(begin, end, history.auto_freq(begin, end))
 
     # stack lines
     fig = go.Figure()
     fig.add_trace(go.Scatter(
-        x=[row[0] for row in data],
-        y=[row[1] for row in data],
+        x=dates,
+        y=lth,
         fill='tozeroy',
         name='LTH'))
     fig.add_trace(go.Scatter(
-        x=[row[0] for row in data],
-        y=[row[1] + row[2] for row in data],
+        x=dates,
+        y=lth + sth,
         fill='tonexty',
         name='LTH + STH'))
 
@@ -73,19 +83,19 @@ def get_history_line(calc):
     return fig
 
 
-def get_log_history_line(calc):
-    data = calc.get_history()
+def get_log_history_line(history, begin=None, end=None):
+    dates, lth, sth = history.query(begin, end, history.auto_freq(begin, end))
 
     # stack lines
     fig = go.Figure()
     fig.add_trace(go.Scatter(
-        x=[row[0] for row in data],
-        y=[log10(row[1]) for row in data],
+        x=dates,
+        y=np.log10(lth),
         fill='tozeroy',
         name='LTH'))
     fig.add_trace(go.Scatter(
-        x=[row[0] for row in data],
-        y=[log10(row[1] + row[2]) for row in data],
+        x=dates,
+        y=np.log10(lth + sth),
         fill='tonexty',
         name='LTH + STH'))
 
@@ -101,11 +111,14 @@ def get_log_history_line(calc):
 
 
 def main():
-    calculator = LocalCalc()
+    calculator = open_calc()
+
+    # the history is read once for all graphs
+    history = HistoryStore(calculator)
 
-    get_main_pie(calculator).show()
-    get_history_line(calculator).show()
-    get_log_history_line(calculator).show()
+    get_main_pie(history).show()
+    get_history_line(history).show()
+    get_log_history_line(history).show()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,325 @@
+from configuration import Config
+from libs.local import LocalCache, LocalCalc
+from libs.shard import shard_file
+from libs.synthetic import SyntheticChain
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import psycopg2
+
+
+def parse_args():
+    """
+    Parse the command line arguments
+    :return: argparse.Namespace
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmark the caching and calculating stages on synthetic data.")
+    parser.add_argument("--days", type=int, default=30, help="the number of synthetic days")
+    parser.add_argument("--addresses", type=int, default=10000, help="the number of active addresses")
+    parser.add_argument("--rows", type=int, default=20000, help="the number of balance changes a day")
+    parser.add_argument("--seed", type=int, default=0, help="the random seed of the synthetic data")
+    parser.add_argument("--samples", type=int, default=1000, help="the number of addresses for calculate_lth_sth")
+    parser.add_argument("--output", default="bench.json", help="the JSON file of the results")
+    parser.add_argument("--baseline", default="", help="the JSON file of an older run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="the slowdown ratio against the baseline that fails the run")
+    return parser.parse_args()
+
+
+def peak_rss():
+    """
+    get the peak resident set size of this process and its children so far
+    :return: int, KB
+    """
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+
+def result(seconds, rows):
+    """
+    compose the result of a stage
+    :param seconds: float
+    :param rows: int
+    :return: dict
+    """
+
+    return {
+        "seconds": round(seconds, 3),
+        "rows": rows,
+        "rows_per_sec": round(rows / seconds, 1) if seconds > 0 else None,
+        "peak_rss_kb": peak_rss(),
+    }
+
+
+def reset_schema(schema):
+    """
+    create the throwaway schema of the local PostgreSQL db again with the empty tables
+    :param schema: str
+    :return: void
+    """
+
+    calculator = LocalCalc()
+    if calculator.conn is None:
+        raise RuntimeError("Cannot connect to the local db.")
+
+    cursor = calculator.conn.cursor()
+    cursor.execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0}".format(schema))
+    calculator.conn.commit()
+    calculator.create_tables()
+    calculator.conn.close()
+
+
+def drop_schema(schema):
+    """
+    drop the throwaway schema
+    :param schema: str
+    :return: void
+    """
+
+    calculator = LocalCalc()
+    if calculator.conn is None:
+        return
+
+    cursor = calculator.conn.cursor()
+    cursor.execute("DROP SCHEMA IF EXISTS {} CASCADE".format(schema))
+    calculator.conn.commit()
+    calculator.conn.close()
+
+
+def bench_proc_record(days):
+    """
+    store the synthetic days into the daily cache files window by window, as do_cache does
+    :param days: list of (datetime, rows)
+    :return: dict
+    """
+
+    seconds = 0
+    rows = 0
+    for dt, data in days:
+        # the windows of Config.TIME_GAP seconds
+        windows = {}
+        for row in data:
+            windows.setdefault(int((row[3] - dt).total_seconds()) // Config.TIME_GAP, []).append(row)
+
+        local = LocalCache(shard_file(dt))
+        local.create_table()
+
+        started = time.perf_counter()
+        for window in windows.values():
+            if local.proc_record(window) is False:
+                raise RuntimeError("proc_record failed for {}".format(dt))
+        seconds += time.perf_counter() - started
+
+        rows += len(data)
+        local.close()
+
+    return result(seconds, rows)
+
+
+def bench_add_logs(days):
+    """
+    merge the daily cache files into the local PostgreSQL db
+    :param days: list of (datetime, rows)
+    :return: dict
+    """
+
+    calculator = LocalCalc()
+
+    seconds = 0
+    rows = 0
+    for dt, _ in days:
+        cache = LocalCache(shard_file(dt))
+        rows += cache.get_record_count()
+
+        started = time.perf_counter()
+        if calculator.add_logs(cache.iter_all()) is False:
+            raise RuntimeError("add_logs failed for {}".format(dt))
+        calculator.conn.commit()
+        seconds += time.perf_counter() - started
+
+        cache.close()
+
+    calculator.conn.close()
+
+    return result(seconds, rows)
+
+
+def bench_calculate_lth_sth(dt, samples):
+    """
+    classify some addresses one by one on a day
+    :param dt: datetime.date
+    :param samples: int
+        the number of addresses
+    :return: dict, the rows are the addresses
+    """
+
+    calculator = LocalCalc()
+    cursor = calculator.conn.cursor()
+    cursor.execute("SELECT address, balance FROM {} ORDER BY address LIMIT %s".format(Config.TABLE_ADDRESS),
+                   (samples,))
+    addresses = cursor.fetchall()
+
+    started = time.perf_counter()
+    for address, balance in addresses:
+        calculator.calculate_lth_sth(address, dt, balance)
+    seconds = time.perf_counter() - started
+
+    calculator.conn.close()
+
+    return result(seconds, len(addresses))
+
+
+def bench_day_loop(days, rows):
+    """
+    run the whole do_calc day loop over the daily cache files on the empty tables
+    :param days: list of (datetime, rows)
+    :param rows: int
+        the number of the cached rows
+    :return: dict
+    """
+
+    import do_calc
+
+    # start at the first synthetic day
+    if os.path.isfile(Config.JOURNAL_FILE):
+        os.remove(Config.JOURNAL_FILE)
+    with open(Config.STATUS_CALC, "w") as f:
+        f.write(days[0][0].date().isoformat())
+
+    argv = sys.argv
+    sys.argv = ["do_calc.py"]
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            do_calc.main()
+            seconds = time.perf_counter() - started
+    finally:
+        sys.argv = argv
+
+    return dict(result(seconds, rows), days=len(days))
+
+
+def git_version():
+    """
+    get the commit of the working tree
+    :return: str, or None
+    """
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_file, tolerance):
+    """
+    compare the throughput of the stages with an older run
+    :param results: dict
+    :param baseline_file: str
+    :param tolerance: float
+        the slowdown ratio that counts as a regression
+    :return: boolean, True if no stage regressed
+    """
+
+    try:
+        with open(baseline_file, "r") as f:
+            baseline = json.load(f)["results"]
+    except (IOError, ValueError, KeyError) as e:
+        print(e)
+        return False
+
+    passed = True
+    for stage, current in results.items():
+        old = baseline.get(stage, {}).get("rows_per_sec")
+        if not old or not current["rows_per_sec"]:
+            continue
+
+        change = current["rows_per_sec"] / old - 1
+        regressed = change < -tolerance
+        passed = passed and not regressed
+        print("{:20} {:>12.1f} rows/s  {:+.1%}{}".format(stage, current["rows_per_sec"], change,
+                                                       "  REGRESSION" if regressed else ""))
+
+    return passed
+
+
+def main():
+
+    args = parse_args()
+
+    # every local PostgreSQL connection of this process and its workers uses the throwaway schema
+    schema = "bench_{}".format(os.getpid())
+    os.environ["PGOPTIONS"] = "-c search_path={}".format(schema)
+
+    # the cache files, the journal and the status files go to a temporary folder
+    cwd = os.getcwd()
+    folder = tempfile.mkdtemp(prefix="bench-")
+    os.chdir(folder)
+    os.makedirs("dbs")
+
+    results = {}
+    try:
+        chain = SyntheticChain(args.seed, args.addresses, args.rows)
+        days = list(chain.days(args.days))
+        rows = sum(len(data) for _, data in days)
+        print("{} synthetic rows in {} days".format(rows, len(days)))
+
+        reset_schema(schema)
+
+        results["proc_record"] = bench_proc_record(days)
+        print("proc_record: {rows_per_sec} rows/s".format(**results["proc_record"]))
+
+        results["add_logs"] = bench_add_logs(days)
+        print("add_logs: {rows_per_sec} rows/s".format(**results["add_logs"]))
+
+        dt = (days[-1][0] + datetime.timedelta(days=1)).date()
+        results["calculate_lth_sth"] = bench_calculate_lth_sth(dt, args.samples)
+        print("calculate_lth_sth: {rows_per_sec} addresses/s".format(**results["calculate_lth_sth"]))
+
+        reset_schema(schema)
+        results["day_loop"] = bench_day_loop(days, results["add_logs"]["rows"])
+        print("day loop: {rows_per_sec} rows/s".format(**results["day_loop"]))
+
+    except (RuntimeError, psycopg2.Error) as e:
+        print(e)
+
+    finally:
+        os.chdir(cwd)
+        drop_schema(schema)
+        shutil.rmtree(folder, ignore_errors=True)
+
+    report = {
+        "version": git_version(),
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "params": vars(args),
+        "config": {name: getattr(Config, name) for name in (
+            "CALC_ENGINE", "CALC_BULK_MERGE", "CACHE_BULK_INGEST", "CACHE_BACKEND", "ADDRESS_IDS", "TIME_GAP")},
+        "results": results,
+    }
+
+    try:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Results were saved in {}.".format(args.output))
+    except IOError as e:
+        print(e)
+
+    if args.baseline and not compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,27 @@
 from configuration import Config
+from libs.addressbook import AddressBook
+from libs.async_remote import AsyncRemoteServer
+from libs.backfill import cache_day, day_bounds, init_worker, missing_days
 from libs.local import LocalCache
+from libs.metrics import metrics
 from libs.remote import RemoteServer
+from libs.shard import finish_shard, shard_file
+import argparse
 import datetime
+import multiprocessing
+import os
+import queue
 import signal
+import threading
+import time
+import psycopg2
 
 # terminate flag
 terminate = False
 
+# the journal owner of the days cached in order
+ORDER_OWNER = "in-order"
+
 
 # noinspection PyUnusedLocal
 def signal_handler(signum, frame):
@@ -23,64 +38,324 @@ def signal_handler(signum, frame):
     terminate = True
 
 
+def serial_fetch(remote):
+    """
+    Fetch the windows one by one over the single connection
+    :param remote: RemoteServer object
+    :return: generator of (begin, end, 2D array or false)
+    """
+
+    while True:
+        # the days of the back-fill are cached already
+        remote.begin = remote.skip_done(remote.begin)
+        begin = remote.begin
+        end = remote.window_end(begin)
+        data = remote.auto_fetch()
+        yield begin, end, data
+
+        if data is False:
+            return
+
+
+def pipelined_fetch(remote, windows, depth):
+    """
+    Fetch the windows in a thread ahead of the local writes.
+    At most depth fetched windows wait in a queue, so the fetches and the writes overlap
+    and the memory stays bounded.
+    The rows of a window are read as a whole in the thread, because a streaming cursor
+    cannot be shared with the writer.
+    The window size is tuned here by the fetch time, as the writes are not waited for.
+
+    :param remote: RemoteServer object
+    :param windows: generator of (begin, end, 2D array or iterator of rows or false)
+        serial_fetch or RemoteServer.parallel_fetch
+    :param depth: int
+        the number of windows fetched ahead
+    :return: generator of (begin, end, 2D array or false)
+    """
+
+    fetched = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # wait for a room in the queue until the consumer stops
+        while not stop.is_set():
+            try:
+                fetched.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def produce():
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+
+        try:
+            while not stop.is_set():
+                started = time.time()
+                window = next(windows, None)
+                if window is None:
+                    break
+
+                begin, end, data = window
+                if data is not False:
+                    try:
+                        data = list(data)
+                    except psycopg2.Error as e:
+                        print(e)
+                        data = False
+
+                if data is not False:
+                    remote.adapt_gap(begin, end, len(data), time.time() - started)
+
+                if not put((begin, end, data)) or data is False or end >= today:
+                    break
+
+        finally:
+            # the end of the windows
+            put(None)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            window = fetched.get()
+            if window is None:
+                return
+
+            yield window
+
+    finally:
+        # let the thread finish the window in flight, and drop the waiting windows
+        stop.set()
+        while producer.is_alive():
+            try:
+                fetched.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+        windows.close()
+
+
+def finish_days(journal, origin):
+    """
+    Put in place the days that were cached to the end but are still under their temporary names,
+    as the caching stopped before their files were renamed
+    :param journal: Journal object
+    :param origin: datetime
+        from when the data begin
+    :return: void
+    """
+
+    for begin, end, _, _ in journal.get_intervals():
+        day = begin.date()
+        while day < end.date():
+            day_begin, day_end = day_bounds(day, origin)
+            temp_file = shard_file(day) + ".tmp"
+            if begin <= day_begin and day_end <= end and os.path.isfile(temp_file):
+                if not finish_shard(temp_file, day):
+                    print("Finishing {} failed.".format(temp_file))
+            day += datetime.timedelta(days=1)
+
+
+def compact_journal(journal, date):
+    """
+    Merge the windows of a day into a single interval of the journal
+    :param journal: Journal object
+    :param date: datetime.date
+        the day of the windows
+    :return: boolean
+    """
+
+    begin = datetime.datetime.combine(date, datetime.time())
+    return journal.compact(begin, begin + datetime.timedelta(days=1))
+
+
+def backfill(remote, workers, until):
+    """
+    Cache the days that are not cached over a pool of worker processes, a whole day by a worker.
+    The days are recorded in the journal, the caching in order skips them later.
+    When interrupted, the days in flight are finished.
+
+    :param remote: RemoteServer object
+        its journal lists the days
+    :param workers: int
+        the number of worker processes
+    :param until: datetime.date
+        the day after the last day
+    :return: void
+    """
+
+    days = missing_days(remote.journal, remote.origin, until)
+    print("{} days to cache.".format(len(days)))
+
+    pool = multiprocessing.Pool(workers, initializer=init_worker)
+    pending = []
+
+    try:
+        while days or pending:
+            # keep every worker busy with the next days
+            while days and len(pending) < workers and not terminate:
+                day = days.pop(0)
+                pending.append((day, pool.apply_async(cache_day, (day,))))
+
+            if not pending:
+                break
+
+            day, result = pending.pop(0)
+            rows = result.get()
+
+            if rows is None:
+                print("{} is cached by another worker.".format(day.isoformat()))
+            elif rows is False:
+                print("Caching failed for {}.".format(day.isoformat()))
+            else:
+                print("{} records are cached for {}.".format(rows, day.isoformat()))
+                metrics.count("cache.rows", rows)
+                metrics.flush("cache", day.isoformat())
+
+    finally:
+        pool.close()
+        pool.join()
+
+    if terminate:
+        print("interrupted")
+
+
+def parse_args():
+    """
+    Parse the command line arguments
+    :return: argparse.Namespace
+    """
+
+    parser = argparse.ArgumentParser(description="Cache the balance changes from the anyblock.net server.")
+    parser.add_argument("--backfill", type=int, default=0, metavar="WORKERS",
+                        help="cache the days that are not cached over WORKERS processes, a whole day by a process")
+    parser.add_argument("--until", type=datetime.date.fromisoformat, default=datetime.date.today(),
+                        help="the day after the last day to back-fill, today by default")
+
+    return parser.parse_args()
+
+
 def main():
 
+    args = parse_args()
+
     # connects to the anyblock.net sql server
-    remote = RemoteServer()
+    if Config.FETCH_ASYNC:
+        remote = AsyncRemoteServer()
+    else:
+        remote = RemoteServer()
+
     if remote.conn is None:
         print("Cannot connect to the server. Try again later.")
+        remote.close()
         return
 
     # register the SIGKILL (Ctrl + C) handler
     signal.signal(signal.SIGINT, signal_handler)
 
-    # a flag to check the date change
-    current_day = 0
+    if args.backfill > 0:
+        backfill(remote, args.backfill, args.until)
+        remote.close()
+        print("Bye")
+        return
+
+    # the days cached to the end by the last run
+    finish_days(remote.journal, remote.origin)
 
     # local sqlite file interface
     local = None
 
-    while True:
-        begin = remote.begin
+    # the end of a day cached by the back-fill, its windows are dropped
+    skipped = remote.origin
 
-        year = begin.year
-        month = begin.month
-        day = begin.day
+    # address dictionary
+    book = AddressBook() if Config.ADDRESS_IDS else None
 
-        if current_day != day:
-            # close the sqlite file for yesterday
+    # the windows to cache, one by one or over a pool of connections
+    if Config.FETCH_WORKERS > 1:
+        windows = remote.parallel_fetch(Config.FETCH_WORKERS)
+    else:
+        windows = serial_fetch(remote)
+
+    # fetch the next windows while storing the last ones
+    if Config.PIPELINE_DEPTH > 0:
+        windows = pipelined_fetch(remote, windows, Config.PIPELINE_DEPTH)
+
+    for begin, end, data in windows:
+        started = time.time()
+        seconds = (end - begin).total_seconds()
+
+        if begin < skipped:
+            continue
+
+        # a new file when the date changes, not only the day of the month
+        if local is None or begin.date() != db_date:
+            # close the sqlite file for yesterday, and put it in place
             if local is not None:
                 local.close()
+                local = None
+                if not finish_shard(db_file, db_date):
+                    print("Finishing {} failed.".format(db_file))
+                    break
+                compact_journal(remote.journal, db_date)
+                metrics.flush("cache", db_date.isoformat())
+
+            # claim the rest of the day, so the back-fill does not cache it at the same time
+            day_end = day_bounds(begin.date(), remote.origin)[1]
+            if not remote.journal.claim(begin, day_end, ORDER_OWNER):
+                print("{} is cached by the back-fill. Skipped.".format(begin.date().isoformat()))
+                skipped = day_end
+                remote.done = remote.done + [(begin, day_end)]
+                continue
 
-            # open today's new sqlite file
-            db_file = "dbs/cache-{}-{}-{}.sqlite".format(year, month, day)
-            local = LocalCache(db_file)
+            # open today's new sqlite file under a temporary name, it is renamed when the day is finished
+            db_file = shard_file(begin) + ".tmp"
+            db_date = begin.date()
+            if not os.path.isfile(db_file) and os.path.isfile(shard_file(begin)):
+                # the day was cached partly in place by an older version
+                os.replace(shard_file(begin), db_file)
+            local = LocalCache(db_file, book)
             local.create_table()
 
         # load data from the server
-        data = remote.auto_fetch()
         if data is False:
-            print("Getting data failed from {} for {} seconds.".format(remote.begin, Config.TIME_GAP))
+            print("Getting data failed from {} for {} seconds.".format(begin, seconds))
             break
-        else:
-            print("{} records are retrieved since {} for {} seconds.".format(len(data), remote.begin, Config.TIME_GAP),
-                  end='')
 
-        # store the data
-        ret = local.proc_record(data)
+        # store the data, the rows may be streamed from the server while storing
+        try:
+            ret = local.proc_record(data)
+        except psycopg2.Error as e:
+            print(e)
+            print("Getting data failed from {} for {} seconds.".format(begin, seconds))
+            break
 
         if ret is False:
-            print("  Processing data failed.")
+            print("Processing data failed from {} for {} seconds.".format(begin, seconds))
             break
         else:
-            print("  Stored.")
+            print("{} records are retrieved since {} for {} seconds.  Stored."
+                  .format(local.count, begin, seconds))
+            metrics.count("cache.windows")
+            metrics.count("cache.rows", local.count)
 
-        # save the time with when it begins for the next time
-        remote.save_time()
+        # tune the next window, the fetch thread tunes it in the pipelined mode
+        if Config.PIPELINE_DEPTH <= 0:
+            remote.adapt_gap(begin, end, local.count, time.time() - started)
+
+        # record the window for the next time,
+        # only after the window was committed, as the fetch thread can be ahead
+        if not remote.complete_window(begin, end, local.count, local.checksum):
+            print("Recording the window failed from {} for {} seconds.".format(begin, seconds))
+            break
 
         # check if all data was cached
         today = datetime.date.today()
-        if today == remote.begin.date():
+        if today == end.date():
             print("All data were cached until yesterday.")
             break
 
@@ -89,6 +364,22 @@ def main():
             print("interrupted")
             break
 
+    # stop fetching the windows in flight
+    windows.close()
+
+    if local is not None:
+        local.close()
+        compact_journal(remote.journal, db_date)
+        metrics.flush("cache", db_date.isoformat())
+
+        # the last day is put in place if it was cached to the end
+        finish_days(remote.journal, remote.origin)
+
+    if book is not None:
+        book.close()
+
+    remote.close()
+
     print("Bye")
 
 
@@ -1,9 +1,20 @@
 from configuration import Config
-from libs.local import LocalCache, LocalCalc
+from libs.local import LocalCache
+from libs.columnar import ColumnarCalc
+from libs.history import HistoryStore
+from libs.journal import Journal
+from libs.metrics import metrics
+from libs.parallel import ParallelCalc
+from libs.prefetch import ShardPrefetcher, read_logs
+from libs.shard import open_shard, shard_file
+from libs.sqlite_calc import SQLiteCalc, open_calc
+from libs.sweep import RangeSweep
+import argparse
 import datetime
 import signal
 import sys
 import os
+import time
 
 # terminate flag
 terminate = False
@@ -24,15 +35,19 @@ def signal_handler(signum, frame):
     terminate = True
 
 
-def load_date():
+# the first date to be calc(ethereum's birthday)
+BIRTH = datetime.date(2015, 7, 30)
+
+
+def load_date(journal):
     """
-    Load last calculated date from file
+    Load the first date that is not calculated yet from the journal.
+    The last calculated date of the old status file is moved into an empty journal at first.
+
+    :param journal: Journal object
     :return: datetime.date object
     """
 
-    # the first date to be calc(ethereum's birthday)
-    birth = "2015-07-30"
-
     contents = ""
 
     try:
@@ -41,15 +56,15 @@ def load_date():
     except IOError as e:
         print(e)
 
-    if contents == "":
-        contents = birth
+    if contents != "":
+        journal.migrate(BIRTH, datetime.date.fromisoformat(contents))
 
-    return datetime.date.fromisoformat(contents)
+    return journal.lowest_unfinished(BIRTH)
 
 
 def save_date(date):
     """
-    Save last calculated date to file
+    Save last calculated date to file, as a readable copy of the journal
 
     :param date: datetime.date object
         the date to save
@@ -78,10 +93,213 @@ def draw_progress_bar(dt_string, percent, bar_len=20):
     sys.stdout.flush()
 
 
+def split_lth_sth(rows):
+    """
+    Split the (wallet, balance) rows into LTH and STH balances
+    :param rows: array
+        rows of get_lth_sth or get_active_lth_sth
+    :return: (lth, sth)
+    """
+
+    lth = 0
+    sth = 0
+    for row in rows:
+        if row[0] == 'S':
+            sth = row[1]
+        if row[0] == 'L':
+            lth = row[1]
+
+    return lth, sth
+
+
+def count_logs(logs, counter):
+    """
+    Pass the logs through, counting them
+    :param logs: iterable
+        the logs or the cache rows of a day
+    :param counter: list
+        counter[0] is increased by the number of the logs
+    :return: generator of the logs
+    """
+
+    for log in logs:
+        counter[0] += 1
+        yield log
+
+
+def calculate_addresses(calculator, dt, date_string):
+    """
+    Calculate LTH/STH for every address one by one
+    :param calculator: LocalCalc object
+    :param dt: datetime.date object
+        the date to calculate
+    :param date_string: str
+        the date string for the progress bar
+    :return: boolean
+    """
+
+    count = calculator.get_address_count()
+    if count is False:
+        return False
+
+    offset = 0
+
+    for rows in calculator.iter_addresses(Config.CALC_CHUNK_SIZE):
+
+        for i, (address, balance, _) in enumerate(rows):
+            # get wallet for an address
+            wallet = calculator.calculate_lth_sth(address, dt, balance)
+
+            # set wallet for an address
+            calculator.update_address_wallet(address, wallet)
+
+            # print progress
+            percent = (offset + i) / count
+            draw_progress_bar(date_string, percent)
+
+        # next chunk
+        offset = offset + len(rows)
+
+    return True
+
+
+def calculate_rolling(calculator, dt, rebuild, check):
+    """
+    Slide the rolling window of every address and calculate LTH/STH from it
+    :param calculator: LocalCalc object
+    :param dt: datetime.date object
+        the date to calculate
+    :param rebuild: boolean
+        rebuild the window from the logs instead of sliding it
+    :param check: boolean
+        check the window against a rebuild from the logs
+    :return: boolean
+    """
+
+    if rebuild:
+        ret = calculator.rebuild_address_stats(dt)
+    else:
+        ret = calculator.update_address_stats(dt)
+
+    if ret is False:
+        return False
+
+    if check:
+        mismatches = calculator.check_address_stats(dt)
+        if mismatches is False:
+            return False
+
+        print("\r{} addresses differ in the rolling window for {}.".format(mismatches, dt.isoformat()))
+
+    return calculator.classify_addresses(dt, rolling=True)
+
+
+def calculate_range(calculator, journal, begin, end, prefetcher=None):
+    """
+    Calculate the days from begin to end in one pass with RangeSweep.
+    Every Config.CALC_RANGE_DAYS days are written and recorded in a transaction,
+    so an interrupted range resumes at the first day that was not written,
+    from the snapshot of the state if it was saved after that day.
+
+    :param calculator: LocalCalc object
+    :param journal: Journal object
+    :param begin: datetime.date object
+        the first day, every day before must be calculated
+    :param end: datetime.date object
+        the last day
+    :param prefetcher: ShardPrefetcher object
+        reads the logs of the next days ahead, or None
+    :return: void
+    """
+
+    print("Loading the addresses and the window before {}...".format(begin.isoformat()))
+    sweep = RangeSweep(calculator, begin)
+    if not sweep.load():
+        print("Loading failed.")
+        return
+
+    history = []
+    results = []
+    dt = begin
+    snapshot_dt = begin
+    stop = False
+
+    while not stop:
+        if prefetcher is not None:
+            logs = prefetcher.get(dt)
+        else:
+            logs = read_logs(dt)
+        if logs is False:
+            stop = True
+        else:
+            sweep.add_logs(logs)
+            lth, sth = sweep.classify(dt)
+
+            history.append((dt, lth * Config.UNIT_CALC, sth * Config.UNIT_CALC))
+            results.append((dt, len(logs), Journal.checksum((lth, sth))))
+            print("{} calculated.".format(dt.isoformat()))
+
+            dt = dt + datetime.timedelta(days=1)
+            stop = dt > end or dt == datetime.date.today() or terminate
+
+        if results and (stop or len(results) >= Config.CALC_RANGE_DAYS):
+            if not sweep.save(history):
+                print("Writing failed for {} - {}.".format(results[0][0].isoformat(), results[-1][0].isoformat()))
+                return
+
+            # record the days after they were committed
+            for day, count, checksum in results:
+                if not journal.complete(day, day + datetime.timedelta(days=1), count, checksum):
+                    print("Recording the day failed for {}.".format(day.isoformat()))
+                    return
+
+            save_date(dt)
+            HistoryStore.invalidate()
+
+            if Config.STATE_SNAPSHOT_DAYS > 0 and (stop or (dt - snapshot_dt).days >= Config.STATE_SNAPSHOT_DAYS):
+                sweep.snapshot()
+                snapshot_dt = dt
+
+            metrics.count("calc.days", len(results))
+            metrics.flush("calc", "{}/{}".format(results[0][0].isoformat(), results[-1][0].isoformat()))
+
+            print("{} - {} written.".format(results[0][0].isoformat(), results[-1][0].isoformat()))
+            history = []
+            results = []
+
+    if terminate:
+        print("interrupted")
+
+
+def parse_args():
+    """
+    Parse the command line arguments
+    :return: argparse.Namespace
+    """
+
+    parser = argparse.ArgumentParser(description="Calculate LTH/STH from the cached db files.")
+    parser.add_argument("--rebuild-stats", action="store_true",
+                        help="rebuild the rolling window of the addresses from the logs at the first day")
+    parser.add_argument("--check-stats", action="store_true",
+                        help="check the rolling window of the addresses against the logs every day")
+    parser.add_argument("--from", dest="begin", type=datetime.date.fromisoformat,
+                        help="the first day of the range mode, the first day that is not calculated by default")
+    parser.add_argument("--to", dest="end", type=datetime.date.fromisoformat,
+                        help="calculate the days until this day in one pass, keeping the addresses in memory")
+
+    return parser.parse_args()
+
+
 def main():
 
+    args = parse_args()
+
+    if Config.CALC_BACKEND == "sqlite" and Config.CALC_ENGINE not in SQLiteCalc.ENGINES:
+        print("The {} engine needs the PostgreSQL backend.".format(Config.CALC_ENGINE))
+        return
+
     # connect to the main db
-    calculator = LocalCalc()
+    calculator = open_calc()
     if calculator.conn is None:
         print("Cannot open main sqlite file.")
         return
@@ -89,65 +307,142 @@ def main():
     # create tables
     calculator.create_tables()
 
+    # start the worker processes before the handler, they ignore the signal
+    parallel = None
+    if Config.CALC_ENGINE == "parallel":
+        parallel = ParallelCalc(calculator)
+
     # register the SIGKILL (Ctrl + C) handler
     signal.signal(signal.SIGINT, signal_handler)
 
-    dt = load_date()
+    # the calculated days
+    journal = Journal("calc", datetime.date)
 
-    while True:
-        # compose the cache db file name
-        cache_file = "dbs/cache-{}-{}-{}.sqlite".format(dt.year, dt.month, dt.day)
+    dt = load_date(journal)
 
-        # check if the db file exists
-        if not os.path.isfile(cache_file):
-            print("cache db file does not exist: {}\nQuit.".format(cache_file))
-            break
-
-        # open the cache db
-        cache = LocalCache(cache_file)
+    # read the next days in the worker processes while a day is calculated
+    prefetcher = None
+    if Config.PREFETCH_WORKERS > 0:
+        prefetcher = ShardPrefetcher(dt, args.end)
 
-        date_string = dt.isoformat()
+    if args.end is not None:
+        # the range starts from the state after the last calculated day
+        if args.begin is not None and args.begin != dt:
+            print("The range must begin at the first day that is not calculated: {}.".format(dt.isoformat()))
+        else:
+            calculate_range(calculator, journal, dt, args.end, prefetcher)
+
+        if parallel is not None:
+            parallel.close()
+        if prefetcher is not None:
+            prefetcher.close()
+        journal.close()
+        print("Bye")
+        return
 
-        # adding daily logs into calculator
-        print("Calculating for {}: merging data...".format(date_string), end='')
-        data = cache.get_all()
-        if data is False:
-            print("{} file was corrupted.".format(cache_file))
-            break
+    # running LTH/STH totals of the incremental engine
+    lth, sth = 0, 0
+    if Config.CALC_ENGINE == "incremental":
+        lth, sth = split_lth_sth(calculator.get_lth_sth())
 
-        calculator.add_logs(data)
+    # the rolling window is built from the logs at the first day if it was never built
+    rebuild_stats = False
+    if Config.CALC_ENGINE == "rolling":
+        rebuild_stats = args.rebuild_stats or calculator.is_address_stats_empty()
 
-        # calculating lth/sth for every address
-        count = calculator.get_address_count()
-        offset = 0
+    while True:
+        started = time.perf_counter()
+        date_string = dt.isoformat()
 
-        while offset < count:
+        if prefetcher is not None:
+            # the logs of the day were read ahead
+            cache = None
+            data = prefetcher.get(dt)
+            if data is False:
+                print("Quit.")
+                break
 
-            addresses, balances = calculator.get_addresses(offset, Config.CALC_CHUNK_SIZE)
+            print("Calculating for {}: merging data...".format(date_string), end='')
 
-            for i, address in enumerate(addresses):
-                # get wallet for an address
-                wallet = calculator.calculate_lth_sth(address, dt, balances[i])
+        else:
+            # compose the cache db file name
+            cache_file = shard_file(dt, Config.CACHE_BACKEND)
+
+            # the sqlite file of the day may not be converted yet
+            if not os.path.isfile(cache_file):
+                cache_file = shard_file(dt)
+
+            # check if the db file exists
+            if not os.path.isfile(cache_file):
+                print("cache db file does not exist: {}\nQuit.".format(cache_file))
+                break
+
+            # open the cache db
+            cache = open_shard(cache_file)
+
+            # adding daily logs into calculator
+            print("Calculating for {}: merging data...".format(date_string), end='')
+            if isinstance(cache, LocalCache):
+                data = cache.iter_all()
+            else:
+                # columnar files are converted into the logs with vectorized operations
+                data = cache.get_logs()
+
+            if data is False:
+                print("{} file was corrupted.".format(cache_file))
+                break
+
+        if Config.CALC_ENGINE == "incremental":
+            # the balances of the addresses that can change today, before merging
+            if isinstance(cache, LocalCache):
+                addresses = (row[1] for row in cache.iter_all())
+            else:
+                addresses = (log[0] for log in data)
+            rows = calculator.begin_active_addresses(dt, addresses)
+            if rows is False:
+                print("\rCalculating failed for {}.".format(date_string))
+                break
+            before_lth, before_sth = split_lth_sth(rows)
+
+        # the merged logs are counted for the journal
+        merged = [0]
+        if isinstance(cache, LocalCache):
+            ret = calculator.add_logs(count_logs(data, merged))
+        else:
+            ret = calculator.merge_logs(count_logs(data, merged))
 
-                # set wallet for an address
-                calculator.update_address_wallet(address, wallet)
+        # a failed merge was rolled back, the day is not classified nor recorded
+        if ret is False:
+            print("\rCalculating failed for {}.".format(date_string))
+            break
 
-                # print progress
-                percent = (offset + i) / count
-                draw_progress_bar(date_string, percent)
+        # calculating lth/sth for every address
+        if Config.CALC_ENGINE == "set":
+            ret = calculator.classify_addresses(dt)
+        elif Config.CALC_ENGINE == "incremental":
+            ret = calculator.classify_addresses(dt, active=True)
+        elif Config.CALC_ENGINE == "numpy":
+            ret = ColumnarCalc(calculator).classify_addresses(dt)
+        elif Config.CALC_ENGINE == "parallel":
+            ret = parallel.classify_addresses(dt, lambda percent: draw_progress_bar(date_string, percent))
+        elif Config.CALC_ENGINE == "rolling":
+            ret = calculate_rolling(calculator, dt, rebuild_stats, args.check_stats)
+            rebuild_stats = False
+        else:
+            ret = calculate_addresses(calculator, dt, date_string)
 
-            # next chunk
-            offset = offset + Config.CALC_CHUNK_SIZE
+        if ret is False:
+            print("\rCalculating failed for {}.".format(date_string))
+            break
 
         # calculate LTH and STH balance
-        lth = 0
-        sth = 0
-        rows = calculator.get_lth_sth()
-        for row in rows:
-            if row[0] == 'S':
-                sth = row[1]
-            if row[0] == 'L':
-                lth = row[1]
+        if Config.CALC_ENGINE == "incremental":
+            # only the active addresses change the running totals
+            after_lth, after_sth = split_lth_sth(calculator.get_active_lth_sth())
+            lth = lth + after_lth - before_lth
+            sth = sth + after_sth - before_sth
+        else:
+            lth, sth = split_lth_sth(calculator.get_lth_sth())
 
         # store the lth/sth balances into history
         calculator.add_history(dt, lth * Config.UNIT_CALC, sth * Config.UNIT_CALC)
@@ -157,10 +452,22 @@ def main():
         print("\r{} finished.                                                                   "
               .format(date_string))
 
-        # save the next date
-        dt = dt + datetime.timedelta(days=1)
+        # record the day after it was committed, and save the next date
+        next_dt = dt + datetime.timedelta(days=1)
+        if not journal.complete(dt, next_dt, merged[0], Journal.checksum((lth, sth))):
+            print("Recording the day failed for {}.".format(date_string))
+            break
+
+        metrics.observe("calc.day", time.perf_counter() - started)
+        metrics.count("calc.days")
+        metrics.flush("calc", date_string)
+
+        dt = next_dt
         save_date(dt)
 
+        # the analysis reads the new day
+        HistoryStore.invalidate()
+
         # check if date is today, finish it
         today = datetime.date.today()
         if today == dt:
@@ -171,6 +478,14 @@ def main():
             print("interrupted")
             break
 
+    if parallel is not None:
+        parallel.close()
+
+    if prefetcher is not None:
+        prefetcher.close()
+
+    journal.close()
+
     print("Bye")
 
 
@@ -0,0 +1,59 @@
+from configuration import Config
+from libs.shard import convert_shard
+import argparse
+import datetime
+import glob
+import os
+import re
+
+
+def load_cached_date():
+    """
+    Load the date which is being cached now from the status file
+    :return: datetime.date object, or None
+    """
+
+    try:
+        with open(Config.STATUS_CACHE, "r") as f:
+            return datetime.datetime.fromisoformat(f.read()).date()
+    except (IOError, ValueError) as e:
+        print(e)
+
+    return None
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Convert the sqlite cache files into parquet or arrow cache files.")
+    parser.add_argument("--keep", action="store_true", help="keep the sqlite files after converting")
+    parser.add_argument("--format", choices=("parquet", "arrow"), default="parquet", help="format of the new files")
+    args = parser.parse_args()
+
+    # the day being cached is not finished yet
+    cached = load_cached_date()
+
+    count = 0
+    for sqlite_file in sorted(glob.glob("dbs/cache-*.sqlite")):
+        match = re.match(r"cache-(\d+)-(\d+)-(\d+)\.sqlite$", os.path.basename(sqlite_file))
+        if match is None:
+            continue
+
+        day = datetime.date(*(int(g) for g in match.groups()))
+        if cached is not None and day >= cached:
+            continue
+
+        shard = "{}.{}".format(os.path.splitext(sqlite_file)[0], args.format)
+        size = os.path.getsize(sqlite_file)
+        print("Converting {}...".format(sqlite_file), end='')
+        if not convert_shard(sqlite_file, shard, args.keep):
+            print("  failed.")
+            break
+
+        print("  {:.1f}KB -> {:.1f}KB".format(size / 1024, os.path.getsize(shard) / 1024))
+        count += 1
+
+    print("{} files were converted.".format(count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import sqlite3
+
+from configuration import Config
+
+
+class AddressBook:
+    """
+    A class that represents the persistent address dictionary.
+    Every ethereum address gets an integer id, which the cache and calc dbs store instead of the text.
+    The address is kept as its raw 20 bytes, and decoded only for presentation.
+
+    ATTRIBUTES
+    ----------
+    conn: object
+        sqlite3 connection object
+    ids: dict
+        address to id cache of the addresses already seen
+    """
+
+    def __init__(self, db_file=""):
+        """
+        Constructor. connects to the dictionary sqlite file
+        :param db_file: str
+            sqlite db file name. If not specified, use the default value: Config.ADDRESS_BOOK
+        """
+
+        self.conn = None
+        self.ids = {}
+
+        db = db_file
+        if db == "":
+            db = Config.ADDRESS_BOOK
+
+        try:
+            # several processes may add addresses at the same time
+            self.conn = sqlite3.connect(db, timeout=60)
+
+            sql = "CREATE TABLE IF NOT EXISTS address (" \
+                  "id INTEGER PRIMARY KEY," \
+                  "key BLOB NOT NULL UNIQUE)"
+            self.conn.execute(sql)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            print(e)
+
+    @staticmethod
+    def to_key(address):
+        """
+        convert an address into its raw bytes
+        :param address: str
+            0x prefixed hex address
+        :return: bytes
+        """
+
+        try:
+            if len(address) == 42 and address.startswith("0x"):
+                return bytes.fromhex(address[2:])
+        except ValueError:
+            pass
+
+        # not a hex address, keep the text itself
+        return address.encode()
+
+    @staticmethod
+    def to_address(key):
+        """
+        convert the raw bytes into an address
+        :param key: bytes
+        :return: str
+        """
+
+        if len(key) == 20:
+            return "0x" + key.hex()
+
+        return key.decode()
+
+    def encode(self, addresses):
+        """
+        get the ids of addresses, adding the new addresses into the dictionary
+        :param addresses: array(str)
+        :return: array(int), or False
+        """
+
+        # the ids of the batch, the cache may be reset below
+        ids = {}
+        missing = {}
+        for address in addresses:
+            if address in self.ids:
+                ids[address] = self.ids[address]
+            else:
+                missing[address] = self.to_key(address)
+
+        if missing:
+            try:
+                cursor = self.conn.cursor()
+                cursor.executemany("INSERT OR IGNORE INTO address (key) VALUES (?)",
+                                   ((key,) for key in missing.values()))
+                self.conn.commit()
+
+                keys = list(missing.values())
+                found = {}
+                for i in range(0, len(keys), Config.CALC_CHUNK_SIZE):
+                    chunk = keys[i:i + Config.CALC_CHUNK_SIZE]
+                    cursor.execute("SELECT key, id FROM address WHERE key IN ({})".format(",".join("?" * len(chunk))),
+                                   chunk)
+                    found.update(cursor.fetchall())
+
+            except sqlite3.Error as e:
+                print(e)
+                self.conn.rollback()
+                return False
+
+            # forget the old addresses if the cache grows too much
+            if len(self.ids) + len(missing) > Config.ADDRESS_CACHE_SIZE:
+                self.ids = {}
+
+            for address, key in missing.items():
+                ids[address] = self.ids[address] = found[key]
+
+        return [ids[address] for address in addresses]
+
+    def encode_rows(self, rows, column=1):
+        """
+        replace the address column of rows with the ids, chunk by chunk
+        :param rows: iterable
+            rows that have an address in the column
+        :param column: int
+            the index of the address column
+        :return: generator of rows
+        """
+
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= Config.CALC_CHUNK_SIZE * 10:
+                yield from self.encode_chunk(chunk, column)
+                chunk = []
+
+        yield from self.encode_chunk(chunk, column)
+
+    def encode_chunk(self, rows, column):
+        """
+        replace the address column of rows with the ids
+        :param rows: array
+        :param column: int
+            the index of the address column
+        :return: generator of rows
+        """
+
+        # ids of the encoded cache files pass through
+        addresses = [row[column] for row in rows if isinstance(row[column], str)]
+        encoded = self.encode(addresses)
+        if encoded is False:
+            raise sqlite3.Error("cannot encode the addresses")
+
+        ids = dict(zip(addresses, encoded))
+
+        for row in rows:
+            address = row[column]
+            if isinstance(address, str):
+                row = tuple(row[:column]) + (ids[address],) + tuple(row[column + 1:])
+
+            yield row
+
+    def decode(self, ids):
+        """
+        get the addresses of ids
+        :param ids: array(int)
+        :return: array(str), or False
+        """
+
+        ids = list(ids)
+        found = {}
+
+        try:
+            cursor = self.conn.cursor()
+            for i in range(0, len(ids), Config.CALC_CHUNK_SIZE):
+                chunk = ids[i:i + Config.CALC_CHUNK_SIZE]
+                cursor.execute("SELECT id, key FROM address WHERE id IN ({})".format(",".join("?" * len(chunk))),
+                               chunk)
+                found.update(cursor.fetchall())
+
+        except sqlite3.Error as e:
+            print(e)
+            return False
+
+        return [self.to_address(found[i]) if i in found else str(i) for i in ids]
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
@@ -0,0 +1,214 @@
+import asyncio
+import collections
+import datetime
+import random
+import threading
+
+import asyncpg
+
+from configuration import Config
+from libs.metrics import metrics, timed
+from libs.remote import RemoteServer
+
+# the errors that can pass by retrying the query later
+TRANSIENT_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.InterfaceError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.InsufficientResourcesError,
+    asyncpg.QueryCanceledError,
+    asyncpg.CannotConnectNowError,
+)
+
+
+class AsyncRemoteServer(RemoteServer):
+    """
+    A class to represent the anyblock.net postgreSQL client over asyncio and asyncpg.
+    Many windows are queried at the same time on a small pool of connections,
+    so the latency of a far server is paid once for many windows.
+    A query failed by the network or the server load is retried with an exponential backoff.
+
+    The event loop runs in its own thread, so the queries go on while do_cache stores the windows.
+    It has the interface of RemoteServer, and do_cache drives it the same way.
+
+    ATTRIBUTES
+    ----------
+    conn: Object
+        asyncpg connection pool
+    loop: Object
+        asyncio event loop running the queries
+    thread: Object
+        the thread running the event loop
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        Starts the event loop, connects the pool to the remote server and loads the lastly cached time
+        """
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        super().__init__()
+
+    def run(self, coroutine):
+        """
+        schedule a coroutine on the event loop
+        :param coroutine: coroutine object
+        :return: concurrent.futures.Future
+        """
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def connect(self):
+        """
+        Connect the pool of Config.FETCH_CONNECTIONS connections to the remote server
+        :return: asyncpg pool, or None
+        """
+
+        try:
+            return self.run(self.create_pool()).result()
+        except (asyncpg.PostgresError,) + TRANSIENT_ERRORS as e:
+            print(e)
+
+        return None
+
+    @staticmethod
+    async def create_pool():
+        """
+        create the pool in the event loop
+        :return: asyncpg pool
+        """
+
+        return await asyncpg.create_pool(
+            host=Config.ANY_SERVER,
+            port=Config.ANY_PORT,
+            user=Config.ANY_USER,
+            password=Config.ANY_PASSWORD,
+            database=Config.ANY_DB,
+            min_size=1,
+            max_size=Config.FETCH_CONNECTIONS
+        )
+
+    def close(self):
+        """
+        Close the pool and stop the event loop
+        :return: void
+        """
+
+        if self.conn is not None:
+            self.run(self.conn.close()).result()
+            self.conn = None
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+        self.journal.close()
+
+    @timed("remote.fetch_data")
+    async def fetch_window(self, begin, end):
+        """
+        Fetch data from the server between begin and end.
+        Up to Config.FETCH_RETRIES retries wait Config.FETCH_BACKOFF seconds doubled every time,
+        with a random jitter so the failed windows do not come back at once.
+
+        :param begin: datetime
+            specifies from when to fetch
+        :param end: datetime
+            specifies till when to fetch, not included
+        :return: 2D array, or false
+        """
+
+        sql = "SELECT block_number, address, balance, timestamp FROM {} " \
+              "WHERE timestamp >= $1 AND timestamp < $2".format(self.table)
+
+        for attempt in range(Config.FETCH_RETRIES + 1):
+            try:
+                async with self.conn.acquire() as conn:
+                    rows = await conn.fetch(sql, begin, end, timeout=Config.FETCH_TIMEOUT)
+                return [tuple(row) for row in rows]
+
+            except TRANSIENT_ERRORS as e:
+                print(e)
+
+            except asyncpg.PostgresError as e:
+                # the query itself is wrong, retrying does not help
+                print(e)
+                break
+
+            if attempt < Config.FETCH_RETRIES:
+                metrics.count("remote.retries")
+                delay = min(Config.FETCH_BACKOFF * 2 ** attempt, Config.FETCH_BACKOFF_MAX)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+
+        return False
+
+    def fetch_data(self, begin, end, conn=None):
+        """
+        Fetch data from the server between begin and end, and wait for it
+        :param begin: datetime
+            specifies from when to fetch
+        :param end: datetime
+            specifies till when to fetch, not included
+        :param conn: not used, the pool hands out the connection
+        :return: 2D array, or false
+        """
+
+        return self.run(self.fetch_window(begin, end)).result()
+
+    def stream_data(self, begin, end):
+        """
+        asyncpg fetches a window as a whole, so it is the same as fetch_data
+        :param begin: datetime
+        :param end: datetime
+        :return: 2D array, or false
+        """
+
+        return self.fetch_data(begin, end)
+
+    def parallel_fetch(self, workers):
+        """
+        fetch the following windows since the last caching with many queries in flight.
+        The windows are handed out in timestamp order, and self.begin moves to the end of a window
+        only when it is handed out, so save_time never passes a window that is still in flight.
+        It stops before today's windows.
+
+        :param workers: int
+            the number of windows in flight, they share the Config.FETCH_CONNECTIONS connections
+        :return: generator of (begin, end, 2D array or false)
+        """
+
+        pending = collections.deque()
+        scheduled = self.begin
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+
+        try:
+            while True:
+                # keep the windows in flight
+                while len(pending) < workers and self.skip_done(scheduled) < today:
+                    scheduled = self.skip_done(scheduled)
+                    end = self.window_end(scheduled)
+                    pending.append((scheduled, end, self.run(self.fetch_window(scheduled, end))))
+                    scheduled = end
+
+                if not pending:
+                    return
+
+                # hand out the oldest window
+                begin, end, future = pending.popleft()
+                data = future.result()
+                if data is not False:
+                    self.begin = end
+
+                yield begin, end, data
+
+                if data is False:
+                    return
+
+        finally:
+            for _, _, future in pending:
+                future.cancel()
@@ -0,0 +1,147 @@
+import datetime
+import os
+import signal
+import time
+
+import psycopg2
+
+from configuration import Config
+from libs.addressbook import AddressBook
+from libs.local import LocalCache
+from libs.remote import RemoteServer
+from libs.shard import finish_shard, shard_file
+
+# the server connection and the address dictionary of a worker process
+remote = None
+book = None
+
+
+def init_worker():
+    """
+    Initialize a worker process of the back-fill pool.
+    It opens its own connection, and ignores the SIGINT(Ctrl+C) signal,
+    so only the main process handles it and the days in flight are finished.
+    :return: void
+    """
+
+    global remote, book
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    remote = RemoteServer()
+    book = AddressBook() if Config.ADDRESS_IDS else None
+
+
+def day_bounds(day, origin):
+    """
+    the interval of a day in the journal
+    :param day: datetime.date
+    :param origin: datetime
+        from when the data begin
+    :return: (begin, end)
+    """
+
+    begin = datetime.datetime.combine(day, datetime.time())
+    end = begin + datetime.timedelta(days=1)
+
+    return max(begin, origin), end
+
+
+def missing_days(journal, origin, until):
+    """
+    list the days that none of their windows is in the journal
+    :param journal: Journal object
+        the journal of the cached windows
+    :param origin: datetime
+        from when the data begin
+    :param until: datetime.date
+        the day after the last day
+    :return: list of datetime.date
+    """
+
+    days = []
+    for begin, end in journal.gaps(origin, datetime.datetime.combine(until, datetime.time())):
+        day = begin.date()
+        while day < end.date():
+            day_begin, day_end = day_bounds(day, origin)
+            if begin <= day_begin and day_end <= end:
+                days.append(day)
+            day += datetime.timedelta(days=1)
+
+    return days
+
+
+def remove_files(file):
+    """
+    remove a sqlite file and its WAL files
+    :param file: str
+    :return: void
+    """
+
+    for name in (file, file + "-wal", file + "-shm"):
+        if os.path.isfile(name):
+            os.remove(name)
+
+
+def cache_day(day):
+    """
+    Cache all windows of a day into its own file.
+    The day is claimed in the journal, so no other worker caches it at the same time.
+    The file is written under a temporary name and renamed at the end,
+    so a reader never sees a half written day, then the day is recorded in the journal.
+
+    :param day: datetime.date
+    :return: int, the number of the stored rows, None if the day was claimed by another worker, or False
+    """
+
+    begin, end = day_bounds(day, remote.origin)
+    if not remote.journal.claim(begin, end, "backfill-{}".format(os.getpid())):
+        return None
+
+    temp_file = shard_file(day) + ".tmp"
+
+    # the file of a worker that died on this day
+    remove_files(temp_file)
+
+    local = LocalCache(temp_file, book)
+    local.create_table()
+
+    rows = 0
+    checksum = 0
+    window = begin
+    ret = True
+
+    while window < end:
+        started = time.time()
+        window_end = remote.window_end(window)
+
+        if Config.FETCH_ITERSIZE > 0:
+            data = remote.stream_data(window, window_end)
+        else:
+            data = remote.fetch_data(window, window_end)
+
+        try:
+            ret = data is not False and local.proc_record(data)
+        except psycopg2.Error as e:
+            print(e)
+            ret = False
+
+        if ret is False:
+            print("Caching failed from {} for {} seconds.".format(window, (window_end - window).total_seconds()))
+            break
+
+        rows += local.count
+        checksum = (checksum + local.checksum) & 0xFFFFFFFF
+        remote.adapt_gap(window, window_end, local.count, time.time() - started)
+        window = window_end
+
+    local.close()
+
+    if ret is not False:
+        ret = finish_shard(temp_file, day)
+
+    if ret is False or not remote.journal.complete(begin, end, rows, checksum):
+        remove_files(temp_file)
+        remote.journal.release(begin)
+        return False
+
+    return rows
@@ -0,0 +1,132 @@
+import datetime
+
+import numpy as np
+import psycopg2
+
+from configuration import Config
+from libs.metrics import timed
+
+
+class ColumnarCalc:
+    """
+    A class that calculates LTH/STH for all addresses at once with NumPy.
+    It loads the window of the logs table into columns sorted by address,
+    and evaluates the weighted RMS balance test of calculate_lth_sth with grouped array operations.
+
+    ATTRIBUTES
+    ----------
+    calc: LocalCalc
+        the calculation db
+    """
+
+    def __init__(self, calc):
+        """
+        Constructor
+        :param calc: LocalCalc
+            the calculation db to read the logs from and to write the wallets into
+        """
+
+        self.calc = calc
+
+    def load_window(self, dt):
+        """
+        Load the logs of the Stage 2) window before dt into columns sorted by address
+
+        :param dt: datetime.date object
+            current date
+        :return: (addresses, days, balances, currents) arrays, or False
+            days is the number of days between the log and dt,
+            currents is the current balance of the address of the log
+        """
+
+        end_dt = dt + datetime.timedelta(days=-1)
+        begin_dt = end_dt + datetime.timedelta(days=-Config.WINDOW_SIZE)
+
+        sql = "SELECT l.address, %s - l.ts, l.balance, a.balance " \
+              f"FROM {Config.TABLE_LOG} l JOIN {Config.TABLE_ADDRESS} a ON a.address=l.address " \
+              "WHERE l.ts BETWEEN %s AND %s ORDER BY l.address"
+
+        addresses, days, balances, currents = [], [], [], []
+
+        try:
+            cursor = self.calc.conn.cursor(name="calc_window")
+            cursor.execute(sql, (dt, begin_dt, end_dt))
+
+            while True:
+                rows = cursor.fetchmany(Config.CALC_CHUNK_SIZE * 100)
+                if not rows:
+                    break
+
+                columns = list(zip(*rows))
+                # text addresses, or int64 ids when they are dictionary encoded
+                addresses.append(np.array(columns[0]))
+                days.append(np.array(columns[1], dtype=np.int64))
+                balances.append(np.array(columns[2], dtype=np.float64))
+                currents.append(np.array(columns[3], dtype=np.float64))
+
+            cursor.close()
+
+        except psycopg2.Error as e:
+            print(e)
+            return False
+
+        if not addresses:
+            return np.array([]), np.array([], dtype=np.int64), np.array([]), np.array([])
+
+        return np.concatenate(addresses), np.concatenate(days), np.concatenate(balances), np.concatenate(currents)
+
+    @staticmethod
+    def classify_window(addresses, days, balances, currents):
+        """
+        Calculate LTH or STH for every address of the window columns.
+
+        :param addresses: array
+            address of every log, sorted
+        :param days: array(int)
+            days between every log and the current date, from 1 to WINDOW_SIZE + 1
+        :param balances: array(float)
+            balance of every log
+        :param currents: array(float)
+            current balance of the address of every log
+        :return: (addresses, wallets) arrays of the addresses that have records in recent 155 days
+        """
+
+        if len(addresses) == 0:
+            return addresses, np.array([], dtype='<U1')
+
+        # first row of every address
+        starts = np.flatnonzero(np.concatenate(([True], addresses[1:] != addresses[:-1])))
+
+        # Stage 1)
+        # If there is no records in recent 155 days, it is LTH
+        active = np.logical_or.reduceat(days <= Config.WALLET_THRESHOLD + 1, starts)
+
+        # Stage 2)
+        # balance <= 2 * Weighed_RSM for 6 month, it is LTH
+        weights = 1 - np.log(days) / np.log(180)
+        weight_sums = np.add.reduceat(weights, starts)
+        levels = 2 * np.sqrt(np.add.reduceat(balances * balances * weights, starts)) / weight_sums
+
+        lth = currents[starts] <= levels
+        wallets = np.where(lth, 'L', 'S')
+
+        return addresses[starts][active], wallets[active]
+
+    @timed("calc.classify_addresses")
+    def classify_addresses(self, dt):
+        """
+        Calculate LTH or STH for every address and update the addresses table in bulk.
+        It gives the same wallets as calling calculate_lth_sth for every address.
+
+        :param dt: datetime.date object
+            current date
+        :return: boolean
+        """
+
+        columns = self.load_window(dt)
+        if columns is False:
+            return False
+
+        addresses, wallets = self.classify_window(*columns)
+
+        return self.calc.update_wallets(zip(addresses, wallets))
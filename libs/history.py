@@ -0,0 +1,197 @@
+import os
+
+import numpy as np
+
+from configuration import Config
+
+
+class HistoryStore:
+    """
+    A class that represents the LTH/STH history as NumPy columns for the analysis.
+    The history table is read once and kept in the Config.HISTORY_CACHE file with its weekly and monthly samples,
+    so a query is a slice of the arrays whatever the length of the history is.
+    do_calc drops the file when it writes new days.
+
+    ATTRIBUTES
+    ----------
+    calc: LocalCalc
+        the local calc db that has the history table
+    file: str
+        the cache file name
+    frames: dict
+        (dates, lth, sth) arrays of every frequency, "D": daily, "W": weekly, "M": monthly.
+        A week or a month is sampled at its last calculated day.
+    """
+
+    FREQUENCIES = ("D", "W", "M")
+
+    def __init__(self, calc, file=""):
+        """
+        Constructor. loads the cache file, or builds it from the history table
+        :param calc: LocalCalc
+        :param file: str
+            the cache file name. If not specified, use the default value: Config.HISTORY_CACHE
+        """
+
+        self.calc = calc
+
+        self.file = file
+        if self.file == "":
+            self.file = Config.HISTORY_CACHE
+
+        self.frames = self.load()
+
+    def load(self):
+        """
+        load the frames from the cache file if it is up to date with the history table
+        :return: dict of frames
+        """
+
+        last = self.calc.get_last_history() or None
+
+        try:
+            with np.load(self.file) as data:
+                frames = {freq: (data[freq + "_dates"], data[freq + "_lth"], data[freq + "_sth"])
+                          for freq in self.FREQUENCIES}
+
+            dates, lth, sth = frames["D"]
+            if last is None and len(dates) == 0:
+                return frames
+            if last is not None and len(dates) > 0 and \
+                    (dates[-1], lth[-1], sth[-1]) == (np.datetime64(last[0], "D"), last[1], last[2]):
+                return frames
+
+        except (IOError, ValueError, KeyError):
+            pass
+
+        frames = self.build()
+        self.save(frames)
+
+        return frames
+
+    def build(self):
+        """
+        read the history table into the frames
+        :return: dict of frames
+        """
+
+        rows = self.calc.get_history() or []
+
+        dates = np.array([row[0] for row in rows], dtype="datetime64[D]")
+        lth = np.array([row[1] for row in rows], dtype=np.float64)
+        sth = np.array([row[2] for row in rows], dtype=np.float64)
+
+        days = dates.astype(np.int64)
+        periods = {
+            "D": days,
+            # weeks from monday, 1970-01-05 is the first monday
+            "W": (days + 3) // 7,
+            "M": dates.astype("datetime64[M]").astype(np.int64),
+        }
+
+        frames = {}
+        for freq in self.FREQUENCIES:
+            # the last day of every period
+            last = np.append(np.flatnonzero(np.diff(periods[freq])), len(days) - 1) if len(days) else days
+            frames[freq] = (dates[last], lth[last], sth[last])
+
+        return frames
+
+    def save(self, frames):
+        """
+        save the frames into the cache file.
+        It is written into a temporary file and renamed, so a reader never sees a half written file.
+        :param frames: dict of frames
+        :return: boolean
+        """
+
+        arrays = {}
+        for freq, (dates, lth, sth) in frames.items():
+            arrays[freq + "_dates"] = dates
+            arrays[freq + "_lth"] = lth
+            arrays[freq + "_sth"] = sth
+
+        temp_file = self.file + ".tmp.npz"
+
+        try:
+            np.savez(temp_file, **arrays)
+            os.replace(temp_file, self.file)
+        except IOError as e:
+            print(e)
+            return False
+
+        return True
+
+    @staticmethod
+    def invalidate(file=""):
+        """
+        drop the cache file after the history table was changed
+        :param file: str
+            the cache file name. If not specified, use the default value: Config.HISTORY_CACHE
+        :return: boolean
+        """
+
+        if file == "":
+            file = Config.HISTORY_CACHE
+
+        try:
+            if os.path.isfile(file):
+                os.remove(file)
+        except IOError as e:
+            print(e)
+            return False
+
+        return True
+
+    def query(self, begin=None, end=None, freq="D"):
+        """
+        get the history between begin and end
+        :param begin: datetime.date
+            the first day. If not specified, from the first day of the history
+        :param end: datetime.date
+            the last day. If not specified, till the last day of the history
+        :param freq: str
+            "D", "W", or "M"
+        :return: (dates, lth, sth) arrays
+        """
+
+        dates, lth, sth = self.frames[freq]
+
+        low = 0 if begin is None else np.searchsorted(dates, np.datetime64(begin, "D"), side="left")
+        high = len(dates) if end is None else np.searchsorted(dates, np.datetime64(end, "D"), side="right")
+
+        return dates[low:high], lth[low:high], sth[low:high]
+
+    def auto_freq(self, begin=None, end=None, max_points=None):
+        """
+        get the finest frequency that has at most max_points days between begin and end
+        :param begin: datetime.date
+        :param end: datetime.date
+        :param max_points: int
+            If not specified, use Config.HISTORY_MAX_POINTS. 0 for the daily points always
+        :return: str
+        """
+
+        if max_points is None:
+            max_points = Config.HISTORY_MAX_POINTS
+
+        if max_points <= 0:
+            return "D"
+
+        for freq in self.FREQUENCIES:
+            if len(self.query(begin, end, freq)[0]) <= max_points:
+                return freq
+
+        return self.FREQUENCIES[-1]
+
+    def get_last(self):
+        """
+        get the last day of the history
+        :return: (datetime.date, lth, sth), or None
+        """
+
+        dates, lth, sth = self.frames["D"]
+        if len(dates) == 0:
+            return None
+
+        return dates[-1].item(), float(lth[-1]), float(sth[-1])
@@ -0,0 +1,308 @@
+import sqlite3
+import time
+import zlib
+
+from configuration import Config
+
+
+class Journal:
+    """
+    A class that represents the checkpoint journal of a stage.
+    The done and claimed pieces of work are intervals [begin, end) with the row count and checksum of the result,
+    so the work can be done in any order by any number of workers, and a resume starts at the exact first gap.
+    A piece is completed only after its result was committed, so a crash replays it but never skips it.
+
+    ATTRIBUTES
+    ----------
+    conn: object
+        sqlite3 connection object
+    stage: str
+        "cache" for the windows of do_cache, "calc" for the days of do_calc
+    kind: type
+        datetime.datetime or datetime.date, the type of the interval bounds
+    """
+
+    def __init__(self, stage, kind, db_file=""):
+        """
+        Constructor. connects to the journal sqlite file
+        :param stage: str
+            the stage name
+        :param kind: type
+            datetime.datetime or datetime.date
+        :param db_file: str
+            sqlite db file name. If not specified, use the default value: Config.JOURNAL_FILE
+        """
+
+        self.conn = None
+        self.stage = stage
+        self.kind = kind
+
+        db = db_file
+        if db == "":
+            db = Config.JOURNAL_FILE
+
+        try:
+            # several processes may claim and complete at the same time,
+            # the transactions are begun explicitly
+            self.conn = sqlite3.connect(db, timeout=60, isolation_level=None)
+
+            sql = "CREATE TABLE IF NOT EXISTS journal (" \
+                  "stage TEXT NOT NULL," \
+                  "begin TEXT NOT NULL," \
+                  "end TEXT NOT NULL," \
+                  "state TEXT NOT NULL," \
+                  "rows INTEGER," \
+                  "checksum INTEGER," \
+                  "owner TEXT," \
+                  "updated REAL NOT NULL," \
+                  "PRIMARY KEY (stage, begin, state))"
+            self.conn.execute(sql)
+        except sqlite3.Error as e:
+            print(e)
+
+    @staticmethod
+    def checksum(values):
+        """
+        the checksum of a result
+        :param values: iterable
+            the values of a result
+        :return: int
+        """
+
+        return zlib.crc32(repr(tuple(values)).encode())
+
+    def claim(self, begin, end, owner=""):
+        """
+        claim an interval for a worker.
+        It fails when the interval overlaps a done interval or a claim of another worker,
+        except the claims older than Config.JOURNAL_CLAIM_TIMEOUT seconds, which are taken over.
+        The claims of the same owner, left by its last run, are taken over too.
+
+        :param begin: datetime or date
+        :param end: datetime or date
+        :param owner: str
+            the name of the worker
+        :return: boolean
+        """
+
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+
+            # the claims of the dead workers
+            sql = "DELETE FROM journal WHERE stage=? AND state='claimed' AND (updated<? OR owner=?)"
+            cursor.execute(sql, (self.stage, time.time() - Config.JOURNAL_CLAIM_TIMEOUT, owner))
+
+            sql = "SELECT COUNT(*) FROM journal WHERE stage=? AND begin<? AND ?<end"
+            cursor.execute(sql, (self.stage, end.isoformat(), begin.isoformat()))
+
+            if cursor.fetchone()[0] > 0:
+                cursor.execute("ROLLBACK")
+                return False
+
+            sql = "INSERT INTO journal (stage, begin, end, state, owner, updated) VALUES (?, ?, ?, 'claimed', ?, ?)"
+            cursor.execute(sql, (self.stage, begin.isoformat(), end.isoformat(), owner, time.time()))
+            cursor.execute("COMMIT")
+
+        except sqlite3.Error as e:
+            print(e)
+            self.rollback()
+            return False
+
+        return True
+
+    def release(self, begin):
+        """
+        give up a claimed interval
+        :param begin: datetime or date
+        :return: boolean
+        """
+
+        try:
+            sql = "DELETE FROM journal WHERE stage=? AND begin=? AND state='claimed'"
+            self.conn.execute(sql, (self.stage, begin.isoformat()))
+        except sqlite3.Error as e:
+            print(e)
+            return False
+
+        return True
+
+    def complete(self, begin, end, rows=None, checksum=None):
+        """
+        record a done interval after its result was committed, dropping its claim.
+        A replayed interval whose result differs from the recorded one is reported.
+
+        :param begin: datetime or date
+        :param end: datetime or date
+        :param rows: int
+            the number of rows of the result
+        :param checksum: int
+            the checksum of the result
+        :return: boolean
+        """
+
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+
+            sql = "SELECT end, rows, checksum FROM journal WHERE stage=? AND begin=? AND state='done'"
+            cursor.execute(sql, (self.stage, begin.isoformat()))
+            done = cursor.fetchone()
+            if done is not None and done != (end.isoformat(), rows, checksum):
+                print("{} {} was done as {}, now {}.".format(self.stage, begin, done, (end.isoformat(), rows,
+                                                                                        checksum)))
+
+            sql = "DELETE FROM journal WHERE stage=? AND begin=?"
+            cursor.execute(sql, (self.stage, begin.isoformat()))
+
+            sql = "INSERT INTO journal (stage, begin, end, state, rows, checksum, updated) " \
+                  "VALUES (?, ?, ?, 'done', ?, ?, ?)"
+            cursor.execute(sql, (self.stage, begin.isoformat(), end.isoformat(), rows, checksum, time.time()))
+            cursor.execute("COMMIT")
+
+        except sqlite3.Error as e:
+            print(e)
+            self.rollback()
+            return False
+
+        return True
+
+    def rollback(self):
+        """
+        roll back the open transaction, if any
+        :return: void
+        """
+
+        try:
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK")
+        except sqlite3.Error as e:
+            print(e)
+
+    def get_intervals(self, state="done"):
+        """
+        get the intervals of a state
+        :param state: str
+            "done" or "claimed"
+        :return: list of (begin, end, rows, checksum) ordered by begin
+        """
+
+        try:
+            sql = "SELECT begin, end, rows, checksum FROM journal WHERE stage=? AND state=? ORDER BY begin"
+            cursor = self.conn.execute(sql, (self.stage, state))
+            return [(self.kind.fromisoformat(begin), self.kind.fromisoformat(end), rows, checksum)
+                    for begin, end, rows, checksum in cursor.fetchall()]
+        except sqlite3.Error as e:
+            print(e)
+
+        return []
+
+    def gaps(self, origin, until=None):
+        """
+        list the intervals that are not done
+        :param origin: datetime or date
+            from when the work begins
+        :param until: datetime or date
+            till when to list. If not specified, till the end of the last done interval
+        :return: list of (begin, end)
+        """
+
+        gaps = []
+        point = origin
+        last = origin
+        for begin, end, _, _ in self.get_intervals():
+            if point < begin:
+                gaps.append((point, begin))
+            point = max(point, end)
+            last = max(last, end)
+
+        if until is None:
+            until = last
+
+        return [(begin, min(end, until)) for begin, end in gaps if begin < until] + \
+            ([(point, until)] if point < until else [])
+
+    def lowest_unfinished(self, origin):
+        """
+        get the first point that is not done
+        :param origin: datetime or date
+            from when the work begins
+        :return: datetime or date
+        """
+
+        point = origin
+        for begin, end, _, _ in self.get_intervals():
+            if point < begin:
+                break
+            point = max(point, end)
+
+        return point
+
+    def compact(self, begin, end):
+        """
+        merge the consecutive done intervals within [begin, end) into one,
+        so the journal keeps a row per day instead of a row per window.
+        The row counts are added up, and the checksums too, as the checksums of the rows are added up.
+
+        :param begin: datetime or date
+        :param end: datetime or date
+        :return: boolean
+        """
+
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+
+            sql = "SELECT begin, end, rows, checksum FROM journal " \
+                  "WHERE stage=? AND state='done' AND begin>=? AND end<=? ORDER BY begin"
+            cursor.execute(sql, (self.stage, begin.isoformat(), end.isoformat()))
+
+            # runs of consecutive intervals
+            runs = []
+            for row in cursor.fetchall():
+                if runs and runs[-1][-1][1] == row[0]:
+                    runs[-1].append(row)
+                else:
+                    runs.append([row])
+
+            for run in runs:
+                if len(run) < 2:
+                    continue
+
+                rows = None if any(row[2] is None for row in run) else sum(row[2] for row in run)
+                checksum = None if any(row[3] is None for row in run) else sum(row[3] for row in run) & 0xFFFFFFFF
+
+                sql = "DELETE FROM journal WHERE stage=? AND state='done' AND begin>=? AND end<=?"
+                cursor.execute(sql, (self.stage, run[0][0], run[-1][1]))
+
+                sql = "INSERT INTO journal (stage, begin, end, state, rows, checksum, updated) " \
+                      "VALUES (?, ?, ?, 'done', ?, ?, ?)"
+                cursor.execute(sql, (self.stage, run[0][0], run[-1][1], rows, checksum, time.time()))
+
+            cursor.execute("COMMIT")
+
+        except sqlite3.Error as e:
+            print(e)
+            self.rollback()
+            return False
+
+        return True
+
+    def migrate(self, origin, point):
+        """
+        record the work done until point by the old status file, if the journal of the stage is empty
+        :param origin: datetime or date
+            from when the work began
+        :param point: datetime or date
+            the point of the status file, or None
+        :return: boolean
+        """
+
+        if point is None or point <= origin or self.get_intervals() or self.get_intervals("claimed"):
+            return False
+
+        return self.complete(origin, point)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
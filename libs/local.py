@@ -2,11 +2,62 @@ import datetime
 import sqlite3
 
 import psycopg2
+from psycopg2.extras import execute_values
 
 from configuration import Config
+from libs.journal import Journal
+from libs.metrics import cursor_factory, sqlite_factory, timed
 import time
 
 
+class CopyStream:
+    """
+    A file-like object that streams rows in the text format of COPY FROM STDIN,
+    so the rows never have to be in memory all at once.
+
+    ATTRIBUTES
+    ----------
+    lines: generator
+        a tab separated line for every row
+    buffer: str
+        the rest of the lines that was not read yet
+    """
+
+    def __init__(self, rows):
+        """
+        Constructor
+        :param rows: iterable
+            rows of fields which str() gives the COPY text of
+        """
+
+        self.lines = ("\t".join(str(field) for field in row) + "\n" for row in rows)
+        self.buffer = ""
+
+    def read(self, size=-1):
+        """
+        read the next size characters
+        :param size: int
+            the number of characters to read. If negative, read all.
+        :return: str
+        """
+
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        for line in self.lines:
+            chunks.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+
+        data = "".join(chunks)
+        if size < 0:
+            self.buffer = ""
+            return data
+
+        self.buffer = data[size:]
+        return data[:size]
+
+
 class LocalCache:
     """
     A class that represents the local caching sqlite interface.
@@ -20,16 +71,30 @@ class LocalCache:
         sqlite3 connection object
     table: str
         balance, the table name
+    count: int
+        the number of records processed by the last proc_record
+    checksum: int
+        the checksum of the records processed by the last proc_record, which does not depend on their order
+    book: AddressBook
+        the address dictionary to store ids instead of addresses, or None
+    writer: boolean
+        the file was opened to be written, and tuned for bulk writes
     """
 
-    def __init__(self, db_file=""):
+    def __init__(self, db_file="", book=None):
         """
         Constructor. connects to the sqlite file
         :param db_file: str
             sqlite db file name. If not specified, use the default value: cache.sqlite
+        :param book: AddressBook
+            the address dictionary. If specified, addresses are stored as ids
         """
 
         self.conn = None
+        self.count = 0
+        self.checksum = 0
+        self.book = book
+        self.writer = False
 
         # default DB file name
         self.table = Config.DB_NAME
@@ -42,7 +107,7 @@ class LocalCache:
 
         # open the db file
         try:
-            self.conn = sqlite3.connect(db)
+            self.conn = sqlite3.connect(db, factory=sqlite_factory())
         except sqlite3.Error as e:
             print(e)
 
@@ -54,12 +119,22 @@ class LocalCache:
 
         sql = "CREATE TABLE IF NOT EXISTS {} (" \
               "block INTEGER NOT NULL," \
-              "address text NOT NULL," \
+              "address {} NOT NULL," \
               "balance REAL NOT NULL," \
-              "timestamp INTEGER NOT NULL); ".format(self.table)
+              "timestamp INTEGER NOT NULL); ".format(self.table, "INTEGER" if self.book else "text")
 
         try:
             cursor = self.conn.cursor()
+
+            # tune the daily cache file for bulk writes, only the writer does
+            for name, value in Config.CACHE_PRAGMAS.items():
+                cursor.execute("PRAGMA {}={}".format(name, value))
+            self.writer = True
+
+            cursor.execute(sql)
+
+            # every address has only one record
+            sql = "CREATE UNIQUE INDEX IF NOT EXISTS address_idx ON {} (address)".format(self.table)
             cursor.execute(sql)
         except sqlite3.Error as e:
             print(e)
@@ -67,19 +142,32 @@ class LocalCache:
 
         return True
 
+    @timed("cache.proc_record")
     def proc_record(self, data):
         """
         process balance records from the anyblock postgreSQL server
-        :param data: array
-            2D array that are fetched from the remote server.
+        :param data: iterable
+            2D array or iterator of rows that are fetched from the remote server.
             array of [block(int), address(str), balance(double), timestamp(datetime)]
         :return: boolean
         """
 
+        if self.book is not None:
+            data = self.book.encode_rows(data)
+
+        if Config.CACHE_BULK_INGEST:
+            # For local cache, the balance is stored in Szabo unit
+            return self.merge_records((int(row[0]), row[1], float(row[2]) * Config.UNIT_TRANS,
+                                       time.mktime(row[3].timetuple())) for row in data)
+
+        self.count = 0
+        self.checksum = 0
+
         try:
             cursor = self.conn.cursor()
 
             for row in data:
+                self.count += 1
 
                 # retrieve data from row
                 block = int(row[0])
@@ -88,6 +176,9 @@ class LocalCache:
                 balance = float(row[2]) * Config.UNIT_TRANS
                 timestamp = row[3]
 
+                record = (block, address, balance, time.mktime(timestamp.timetuple()))
+                self.checksum = (self.checksum + Journal.checksum(record)) & 0xFFFFFFFF
+
                 # if balance == 0 remove that record
                 if balance == 0:
                     sql = "DELETE FROM {} WHERE address=?".format(self.table)
@@ -130,10 +221,19 @@ class LocalCache:
         :return: boolean
         """
 
+        if self.book is not None:
+            data = self.book.encode_rows(data)
+
+        if Config.CACHE_BULK_INGEST:
+            return self.merge_records((int(row[0]), row[1], float(row[2]), row[3]) for row in data)
+
+        self.count = 0
+
         try:
             cursor = self.conn.cursor()
 
             for row in data:
+                self.count += 1
                 block = int(row[0])
                 address = row[1]
                 # For local cache, the balance is stored in Szabo unit
@@ -170,6 +270,49 @@ class LocalCache:
 
         return True
 
+    def merge_records(self, records):
+        """
+        Merge balance records into the table in one transaction.
+        Only the last record of every address is kept,
+        then it is deleted when the balance is 0, or upserted.
+
+        :param records: iterable
+            converted records of (block(int), address(str or int), balance(float), timestamp(int))
+        :return: boolean
+        """
+
+        try:
+            # the last record wins, as if they were processed one by one
+            self.count = 0
+            self.checksum = 0
+            last = {}
+            for record in records:
+                self.count += 1
+                self.checksum = (self.checksum + Journal.checksum(record)) & 0xFFFFFFFF
+                last[record[1]] = record
+
+            deletes = [(record[1],) for record in last.values() if record[2] == 0]
+            upserts = [record for record in last.values() if record[2] != 0]
+
+            cursor = self.conn.cursor()
+
+            sql = "DELETE FROM {} WHERE address=?".format(self.table)
+            cursor.executemany(sql, deletes)
+
+            sql = "INSERT INTO {} (block, address, balance, timestamp) VALUES (?, ?, ?, ?) " \
+                  "ON CONFLICT (address) DO UPDATE SET " \
+                  "block=excluded.block, balance=excluded.balance, timestamp=excluded.timestamp".format(self.table)
+            cursor.executemany(sql, upserts)
+
+            self.conn.commit()
+
+        except sqlite3.Error as e:
+            print(e)
+            self.conn.rollback()
+            return False
+
+        return True
+
     def get_all(self):
         """
         get all data from a sqlite chunk file
@@ -184,6 +327,38 @@ class LocalCache:
 
         return False
 
+    def iter_all(self, size=Config.CALC_CHUNK_SIZE):
+        """
+        iterate all data from a sqlite chunk file, fetching size rows at a time
+        :param size: int
+            the number of rows to fetch at once
+        :return: iterator of rows, or False
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT * FROM {}".format(self.table))
+        except sqlite3.Error as e:
+            print(e)
+            return False
+
+        return self.iter_cursor(cursor, size)
+
+    @staticmethod
+    def iter_cursor(cursor, size):
+        """
+        iterate the rows of an executed cursor with fetchmany
+        :param cursor: sqlite3 cursor
+        :param size: int
+            the number of rows to fetch at once
+        :return: generator of rows
+        """
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+
+            yield from rows
+
     def get_record_count(self):
         """
         get the record count in a sqlite chunk file
@@ -192,7 +367,7 @@ class LocalCache:
         try:
             cursor = self.conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM {}".format(self.table))
-            return cursor.fetchone()
+            return cursor.fetchone()[0]
         except sqlite3.Error as e:
             print(e)
 
@@ -210,15 +385,49 @@ class LocalCache:
 
         try:
             cursor = self.conn.cursor()
-            cursor.execute("SELECT * FROM {} ORDER BY timestamp OFFSET ? LIMIT ?".format(self.table), (offset, count))
+            cursor.execute("SELECT * FROM {} ORDER BY timestamp LIMIT ? OFFSET ?".format(self.table), (count, offset))
             return cursor.fetchall()
         except sqlite3.Error as e:
             print(e)
 
         return False
 
+    def iter_chunks(self, count):
+        """
+        iterate the data of a sqlite chunk file in chunks ordered by timestamp.
+        It pages by the (timestamp, rowid) of the last row of the previous chunk instead of OFFSET.
+        :param count: int
+            the number of rows of a chunk
+        :return: generator of array
+        """
+
+        cursor = self.conn.cursor()
+
+        try:
+            cursor.execute("SELECT rowid, * FROM {} ORDER BY timestamp, rowid LIMIT ?".format(self.table), (count,))
+
+            while True:
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+
+                yield [row[1:] for row in rows]
+
+                cursor.execute("SELECT rowid, * FROM {} WHERE (timestamp, rowid) > (?, ?) "
+                               "ORDER BY timestamp, rowid LIMIT ?".format(self.table),
+                               (rows[-1][4], rows[-1][0], count))
+
+        except sqlite3.Error as e:
+            print(e)
+
     def close(self):
         if self.conn:
+            if self.writer:
+                # a finished file is read without the WAL files
+                try:
+                    self.conn.execute("PRAGMA journal_mode=DELETE")
+                except sqlite3.Error as e:
+                    print(e)
             self.conn.close()
 
 
@@ -233,6 +442,9 @@ class LocalCalc:
         sqlite3 connection object
     """
 
+    # the errors of the db driver, which the methods report and return False for
+    ERRORS = (psycopg2.Error,)
+
     def __init__(self):
         """
         Constructor
@@ -246,14 +458,15 @@ class LocalCalc:
                 port=Config.LOCAL_PORT,
                 user=Config.LOCAL_USER,
                 password=Config.LOCAL_PASSWORD,
-                dbname=Config.LOCAL_DB
+                dbname=Config.LOCAL_DB,
+                cursor_factory=cursor_factory("sql.local")
             )
         except psycopg2.Error as e:
             print(e)
 
     def create_tables(self):
         """
-        Creates 3 tables
+        Creates 4 tables
         :return: boolean
         """
 
@@ -269,10 +482,13 @@ class LocalCalc:
             it stores only the last balance information.
             """
 
+            # addresses are ids of the AddressBook when they are dictionary encoded
+            address_type = "BIGINT" if Config.ADDRESS_IDS else "TEXT"
+
             sql = "CREATE TABLE IF NOT EXISTS {} (" \
-                  "address TEXT NOT NULL," \
+                  "address {} NOT NULL," \
                   "balance DOUBLE PRECISION NOT NULL," \
-                  "ts DATE NOT NULL); ".format(Config.TABLE_LOG)
+                  "ts DATE NOT NULL); ".format(Config.TABLE_LOG, address_type)
             cursor.execute(sql)
 
             # create indexes on logs table
@@ -282,27 +498,32 @@ class LocalCalc:
             sql = "CREATE INDEX IF NOT EXISTS address_time_idx ON {} (address, ts)".format(Config.TABLE_LOG)
             cursor.execute(sql)
 
+            # the set-based calculation scans the logs by date window
+            sql = "CREATE INDEX IF NOT EXISTS time_log_idx ON {} (ts)".format(Config.TABLE_LOG)
+            cursor.execute(sql)
+
             """
             addresses table
             It is the last status of all addresses.
             
             FIELDS
             ------
-            address: str
-                unique address
+            address: str or int
+                unique address, or its AddressBook id
             balance: float
                 final balance of the address
             wallet: str
                 'L' for LTH, 'S' for STH
             """
             sql = "CREATE TABLE IF NOT EXISTS {} (" \
-                  "address TEXT NOT NULL," \
+                  "address {} NOT NULL," \
                   "balance DOUBLE PRECISION NOT NULL," \
-                  "wallet TEXT NOT NULL); ".format(Config.TABLE_ADDRESS)
+                  "wallet TEXT NOT NULL); ".format(Config.TABLE_ADDRESS, address_type)
             cursor.execute(sql)
 
             # create indexes on addresses table
-            sql = "CREATE UNIQUE INDEX IF NOT EXISTS address_idx ON {} (address)".format(Config.TABLE_ADDRESS)
+            # index names are shared in the schema, so it must differ from address_idx of the logs table
+            sql = "CREATE UNIQUE INDEX IF NOT EXISTS address_unique_idx ON {} (address)".format(Config.TABLE_ADDRESS)
             cursor.execute(sql)
 
             sql = "CREATE INDEX IF NOT EXISTS wallet_idx ON {} (wallet)".format(Config.TABLE_ADDRESS)
@@ -332,9 +553,46 @@ class LocalCalc:
             sql = "CREATE UNIQUE INDEX IF NOT EXISTS time_idx ON {} (timestamp)".format(Config.TABLE_HISTORY)
             cursor.execute(sql)
 
+            """
+            address_stats table
+            It is the rolling window of every address that has records in the Stage 2) window,
+            so the calculation reads a row of an address instead of scanning its logs.
+
+            FIELDS
+            ------
+            address: str or int
+                unique address
+            last_ts: date
+                the date of the last record
+            first_ts: date
+                the date of the first record in the window
+            days: date[]
+                dates of the records in the window, sorted
+            balances: float[]
+                balances of the records in the window, in the same order
+            """
+
+            sql = "CREATE TABLE IF NOT EXISTS {} (" \
+                  "address {} NOT NULL," \
+                  "last_ts DATE NOT NULL," \
+                  "first_ts DATE NOT NULL," \
+                  "days DATE[] NOT NULL," \
+                  "balances DOUBLE PRECISION[] NOT NULL); ".format(Config.TABLE_STATS, address_type)
+            cursor.execute(sql)
+
+            # create indexes on address_stats table
+            sql = "CREATE UNIQUE INDEX IF NOT EXISTS stats_address_idx ON {} (address)".format(Config.TABLE_STATS)
+            cursor.execute(sql)
+
+            sql = "CREATE INDEX IF NOT EXISTS stats_last_idx ON {} (last_ts)".format(Config.TABLE_STATS)
+            cursor.execute(sql)
+
+            sql = "CREATE INDEX IF NOT EXISTS stats_first_idx ON {} (first_ts)".format(Config.TABLE_STATS)
+            cursor.execute(sql)
+
             self.conn.commit()
 
-        except psycopg2.Error as e:
+        except self.ERRORS as e:
             print(e)
             return False
 
@@ -350,7 +608,7 @@ class LocalCalc:
             cursor = self.conn.cursor()
             cursor.execute("SELECT * FROM {} ORDER BY timestamp".format(Config.TABLE_HISTORY))
             return cursor.fetchall()
-        except psycopg2.Error as e:
+        except self.ERRORS as e:
             print(e)
 
         return False
@@ -365,11 +623,12 @@ class LocalCalc:
             cursor = self.conn.cursor()
             cursor.execute("SELECT * FROM {} ORDER BY timestamp DESC LIMIT 1".format(Config.TABLE_HISTORY))
             return cursor.fetchone()
-        except psycopg2.Error as e:
+        except self.ERRORS as e:
             print(e)
 
         return False
 
+    @timed("calc.add_history")
     def add_history(self, timestamp, lth, sth):
         """
         Add a new day's LTH, STH balance.
@@ -403,7 +662,28 @@ class LocalCalc:
                     .format(Config.TABLE_HISTORY)
                 cursor.execute(sql, (timestamp, lth, sth))
 
-        except psycopg2.Error as e:
+        except self.ERRORS as e:
+            print(e)
+            return False
+
+        return True
+
+    def add_histories(self, rows):
+        """
+        Add or update the LTH, STH balances of many days in a statement
+
+        :param rows: iterable(Union[datetime.date, float, float])
+            (day, lth, sth) of every day
+        :return: boolean
+        """
+
+        try:
+            cursor = self.conn.cursor()
+            sql = "INSERT INTO {} (timestamp, lth, sth) VALUES %s " \
+                  "ON CONFLICT (timestamp) DO UPDATE SET lth=EXCLUDED.lth, sth=EXCLUDED.sth".format(Config.TABLE_HISTORY)
+            execute_values(cursor, sql, rows, page_size=Config.CALC_CHUNK_SIZE)
+
+        except self.ERRORS as e:
             print(e)
             return False
 
@@ -422,11 +702,12 @@ class LocalCalc:
             cursor.execute("SELECT wallet, SUM(balance) FROM {} GROUP BY wallet ORDER BY wallet".
                            format(Config.TABLE_ADDRESS))
             return cursor.fetchall()
-        except psycopg2.Error as e:
+        except self.ERRORS as e:
             print(e)
 
         return False
 
+    @timed("calc.update_address_wallet")
     def update_address_wallet(self, address, wallet):
         """
         Update the addresses table.
@@ -446,7 +727,46 @@ class LocalCalc:
                 .format(Config.TABLE_ADDRESS)
             cursor.execute(sql, (wallet, address))
 
-        except psycopg2.Error as e:
+        except self.ERRORS as e:
+            print(e)
+            return False
+
+        return True
+
+    @timed("calc.update_wallets")
+    def update_wallets(self, wallets, others=True):
+        """
+        Update the wallets of all addresses in bulk.
+        The addresses that have records in recent 155 days come with their wallets,
+        every other address is LTH.
+
+        :param wallets: iterable(Union[str, str])
+            (address, wallet) of the addresses that have records in recent 155 days
+        :param others: boolean
+            set every other address to LTH. If False, only the given wallets are updated.
+        :return: boolean
+        """
+
+        try:
+            cursor = self.conn.cursor()
+
+            cursor.execute("DROP TABLE IF EXISTS calc_wallets")
+            cursor.execute(f"CREATE TEMP TABLE calc_wallets AS SELECT address, wallet FROM {Config.TABLE_ADDRESS} "
+                           "WITH NO DATA")
+            cursor.copy_expert("COPY calc_wallets (address, wallet) FROM STDIN", CopyStream(wallets))
+
+            if others:
+                sql = f"UPDATE {Config.TABLE_ADDRESS} a SET wallet='L' " \
+                      "WHERE a.wallet<>'L' AND NOT EXISTS (SELECT 1 FROM calc_wallets w WHERE w.address=a.address)"
+                cursor.execute(sql)
+
+            sql = f"UPDATE {Config.TABLE_ADDRESS} a SET wallet=w.wallet FROM calc_wallets w " \
+                  "WHERE a.address=w.address AND a.wallet<>w.wallet"
+            cursor.execute(sql)
+
+            cursor.execute("DROP TABLE calc_wallets")
+
+        except self.ERRORS as e:
             print(e)
             return False
 
@@ -483,7 +803,7 @@ class LocalCalc:
                     .format(Config.TABLE_ADDRESS)
                 cursor.execute(sql, (balance, address))
 
-        except psycopg2.Error as e:
+        except self.ERRORS as e:
             print(e)
             return False
 
@@ -494,12 +814,17 @@ class LocalCalc:
         Return the row count of addresses table
         Returns
         -------
-        row count
+        row count, or False
         """
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM {}".format(Config.TABLE_ADDRESS))
-        row = cursor.fetchone()
-        return row[0]
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM {}".format(Config.TABLE_ADDRESS))
+            row = cursor.fetchone()
+            return row[0]
+        except self.ERRORS as e:
+            print(e)
+
+        return False
 
     def get_addresses(self, offset, count):
         """
@@ -523,6 +848,84 @@ class LocalCalc:
         res = cursor.fetchall()
         return [r[0] for r in res], [r[1] for r in res]
 
+    @staticmethod
+    def shard_key(shards):
+        """
+        the SQL expression of the hash shard of an address.
+        The shard count is written in the expression, so the planner matches it with the shard index
+        :param shards: int
+            the number of the shards
+        :return: str
+        """
+
+        # the hash is masked to non negative, ABS fails with the smallest integer
+        return "MOD(HASHTEXT(address::TEXT)::BIGINT & 2147483647, {})".format(int(shards))
+
+    def create_shard_index(self, shards):
+        """
+        Create the index of the addresses by their hash shard and address,
+        so iter_addresses scans only the addresses of a shard
+        :param shards: int
+            the number of the shards
+        :return: boolean
+        """
+
+        try:
+            cursor = self.conn.cursor()
+            sql = "CREATE INDEX IF NOT EXISTS address_shard{}_idx ON {} (({}), address)" \
+                .format(int(shards), Config.TABLE_ADDRESS, self.shard_key(shards))
+            cursor.execute(sql)
+            self.conn.commit()
+        except self.ERRORS as e:
+            print(e)
+            self.conn.rollback()
+            return False
+
+        return True
+
+    def iter_addresses(self, count, shard=None):
+        """
+        Iterate the addresses table in chunks ordered by address.
+        It pages by the last address of the previous chunk instead of OFFSET,
+        so every chunk is an index range scan of the same cost.
+
+        Parameters
+        ----------
+        count: int
+            number of addresses of a chunk
+        shard: (int, int)
+            (shard index, shard count) to iterate only the addresses of a hash shard, over create_shard_index
+
+        Returns
+        -------
+        generator of array(address, balance, wallet)
+        """
+
+        where = ""
+        params = ()
+        if shard is not None:
+            where = " AND {}=%s".format(self.shard_key(shard[1]))
+            params = (shard[0],)
+
+        cursor = self.conn.cursor()
+
+        # the first chunk
+        cursor.execute("SELECT address, balance, wallet FROM {} WHERE TRUE{} ORDER BY address LIMIT %s"
+                       .format(Config.TABLE_ADDRESS, where),
+                       params + (count,))
+
+        while True:
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            yield rows
+
+            # the next chunk after the last address
+            cursor.execute("SELECT address, balance, wallet FROM {} WHERE address > %s{} ORDER BY address LIMIT %s"
+                           .format(Config.TABLE_ADDRESS, where),
+                           (rows[-1][0],) + params + (count,))
+
     def add_log(self, address, balance, timestamp):
         """
         Add a record from the caches into log table
@@ -547,25 +950,30 @@ class LocalCalc:
             sql = "INSERT INTO {} (address, balance, ts) VALUES (%s, %s, %s)".format(Config.TABLE_LOG)
             cursor.execute(sql, (address, balance, timestamp))
 
-        except psycopg2.Error as e:
+        except self.ERRORS as e:
             print(e)
             return False
 
         return True
 
+    @timed("calc.add_logs")
     def add_logs(self, data):
         """
         Add the whole logs from a day
         Parameters
         ----------
-        data: array(Union[int, str, float, int])
-            fetchall() data
+        data: iterable(Union[int, str, float, int])
+            fetchall() data or iterator of rows
 
         Returns
         -------
         boolean
         """
 
+        if Config.CALC_BULK_MERGE:
+            return self.merge_logs((row[1], float(row[2]), datetime.datetime.utcfromtimestamp(int(row[3])).date())
+                                   for row in data)
+
         try:
             for row in data:
                 # convert fields from row
@@ -584,11 +992,250 @@ class LocalCalc:
             self.conn.commit()
             return True
 
-        except psycopg2.Error as e:
+        except self.ERRORS as e:
             print(e)
 
         return False
 
+    @timed("calc.merge_logs")
+    def merge_logs(self, logs, commit=True):
+        """
+        Add the whole logs from a day in bulk.
+        The logs are streamed into a staging table with COPY,
+        then merged into the addresses and logs tables with 2 statements.
+        It gives the same result as check_address and add_log for every log.
+
+        Parameters
+        ----------
+        logs: iterable(Union[str, float, datetime.date])
+            (address, balance, day) of every log
+        commit: boolean
+            commit the merge. If False, the caller commits it with its other changes
+
+        Returns
+        -------
+        boolean
+        """
+
+        try:
+            cursor = self.conn.cursor()
+
+            # staging table with the same column types as the logs table
+            cursor.execute("DROP TABLE IF EXISTS logs_stage")
+            cursor.execute(f"CREATE TEMP TABLE logs_stage AS SELECT address, balance, ts FROM {Config.TABLE_LOG} "
+                           "WITH NO DATA")
+            cursor.execute("ALTER TABLE logs_stage ADD COLUMN seq BIGSERIAL")
+            cursor.copy_expert("COPY logs_stage (address, balance, ts) FROM STDIN", CopyStream(logs))
+
+            # the last balance of an address is its balance, a new address starts with 'S'
+            sql = f"INSERT INTO {Config.TABLE_ADDRESS} (address, balance, wallet) " \
+                  "SELECT DISTINCT ON (address) address, balance, 'S' FROM logs_stage ORDER BY address, seq DESC " \
+                  "ON CONFLICT (address) DO UPDATE SET balance=EXCLUDED.balance"
+            cursor.execute(sql)
+
+            # one log per address/balance/day
+            sql = f"INSERT INTO {Config.TABLE_LOG} (address, balance, ts) " \
+                  "SELECT DISTINCT s.address, s.balance, s.ts FROM logs_stage s " \
+                  f"WHERE NOT EXISTS (SELECT 1 FROM {Config.TABLE_LOG} l " \
+                  "WHERE l.address=s.address AND l.balance=s.balance AND l.ts=s.ts)"
+            cursor.execute(sql)
+
+            cursor.execute("DROP TABLE logs_stage")
+
+            if commit:
+                self.conn.commit()
+            return True
+
+        except self.ERRORS as e:
+            print(e)
+            self.conn.rollback()
+
+        return False
+
+    def iter_logs(self, begin_dt, end_dt):
+        """
+        Iterate the logs between the dates with a server-side cursor, in chunks ordered by date
+
+        Parameters
+        ----------
+        begin_dt: datetime.date object
+            the first date
+        end_dt: datetime.date object
+            the date after the last, not included
+
+        Returns
+        -------
+        generator of array(address, balance, ts), raises psycopg2.Error
+        """
+
+        cursor = self.conn.cursor(name="calc_logs")
+        cursor.execute("SELECT address, balance, ts FROM {} WHERE ts >= %s AND ts < %s ORDER BY ts"
+                       .format(Config.TABLE_LOG), (begin_dt, end_dt))
+
+        while True:
+            rows = cursor.fetchmany(Config.CALC_CHUNK_SIZE * 100)
+            if not rows:
+                break
+
+            yield rows
+
+        cursor.close()
+
+    @timed("calc.update_address_stats")
+    def update_address_stats(self, dt):
+        """
+        Slide the rolling window of the address_stats table to dt.
+        The records since yesterday are taken again from the logs table, with the day's merged logs,
+        and the records that left the Stage 2) window are dropped.
+        Only the addresses that have new records or old records to drop are rewritten.
+
+        Parameters
+        ----------
+        dt: datetime.date object
+            current date, whose logs were merged
+
+        Returns
+        -------
+        boolean
+        """
+
+        # the first date of the window, and the date from which records are taken again
+        begin_dt = dt + datetime.timedelta(days=-(Config.WINDOW_SIZE + 1))
+        recent_dt = dt + datetime.timedelta(days=-1)
+
+        try:
+            cursor = self.conn.cursor()
+
+            cursor.execute("DROP TABLE IF EXISTS stats_targets")
+            sql = f"CREATE TEMP TABLE stats_targets AS SELECT DISTINCT address FROM {Config.TABLE_LOG} WHERE ts >= %s " \
+                  f"UNION SELECT address FROM {Config.TABLE_STATS} WHERE first_ts < %s"
+            cursor.execute(sql, (recent_dt, begin_dt))
+
+            cursor.execute("DROP TABLE IF EXISTS stats_new")
+            sql = "CREATE TEMP TABLE stats_new AS SELECT address, MAX(ts) AS last_ts, MIN(ts) AS first_ts, " \
+                  "ARRAY_AGG(ts ORDER BY ts, balance) AS days, ARRAY_AGG(balance ORDER BY ts, balance) AS balances " \
+                  "FROM (" \
+                  "SELECT s.address, l.ts, l.balance " \
+                  f"FROM {Config.TABLE_STATS} s JOIN stats_targets t ON t.address=s.address, " \
+                  "UNNEST(s.days, s.balances) AS l(ts, balance) " \
+                  "WHERE l.ts >= %s AND l.ts < %s " \
+                  "UNION ALL " \
+                  f"SELECT address, ts, balance FROM {Config.TABLE_LOG} WHERE ts >= %s" \
+                  ") e GROUP BY address"
+            cursor.execute(sql, (begin_dt, recent_dt, recent_dt))
+
+            cursor.execute(f"DELETE FROM {Config.TABLE_STATS} s USING stats_targets t WHERE s.address=t.address")
+            cursor.execute(f"INSERT INTO {Config.TABLE_STATS} (address, last_ts, first_ts, days, balances) "
+                           "SELECT address, last_ts, first_ts, days, balances FROM stats_new")
+
+            cursor.execute("DROP TABLE stats_targets")
+            cursor.execute("DROP TABLE stats_new")
+
+        except self.ERRORS as e:
+            print(e)
+            return False
+
+        return True
+
+    def build_address_stats(self, dt, table):
+        """
+        Build the rolling window of dt from the logs table into a table
+
+        Parameters
+        ----------
+        dt: datetime.date object
+            current date, whose logs were merged
+        table: str
+            the table to fill, with the columns of the address_stats table
+
+        Returns
+        -------
+        None, raises psycopg2.Error
+        """
+
+        begin_dt = dt + datetime.timedelta(days=-(Config.WINDOW_SIZE + 1))
+
+        cursor = self.conn.cursor()
+        sql = f"INSERT INTO {table} (address, last_ts, first_ts, days, balances) " \
+              "SELECT address, MAX(ts), MIN(ts), " \
+              "ARRAY_AGG(ts ORDER BY ts, balance), ARRAY_AGG(balance ORDER BY ts, balance) " \
+              f"FROM {Config.TABLE_LOG} WHERE ts >= %s GROUP BY address"
+        cursor.execute(sql, (begin_dt,))
+
+    def rebuild_address_stats(self, dt):
+        """
+        Rebuild the whole address_stats table from the logs table
+
+        Parameters
+        ----------
+        dt: datetime.date object
+            current date, whose logs were merged
+
+        Returns
+        -------
+        boolean
+        """
+
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(f"TRUNCATE {Config.TABLE_STATS}")
+            self.build_address_stats(dt, Config.TABLE_STATS)
+
+        except self.ERRORS as e:
+            print(e)
+            return False
+
+        return True
+
+    def check_address_stats(self, dt):
+        """
+        Check the address_stats table against a rebuild from the logs table
+
+        Parameters
+        ----------
+        dt: datetime.date object
+            current date, whose logs were merged
+
+        Returns
+        -------
+        int, the number of addresses that differ, or False
+        """
+
+        try:
+            cursor = self.conn.cursor()
+
+            cursor.execute("DROP TABLE IF EXISTS stats_expected")
+            cursor.execute(f"CREATE TEMP TABLE stats_expected AS SELECT * FROM {Config.TABLE_STATS} WITH NO DATA")
+            self.build_address_stats(dt, "stats_expected")
+
+            sql = "SELECT COUNT(DISTINCT address) FROM (" \
+                  f"(SELECT * FROM {Config.TABLE_STATS} EXCEPT SELECT * FROM stats_expected) " \
+                  "UNION ALL " \
+                  f"(SELECT * FROM stats_expected EXCEPT SELECT * FROM {Config.TABLE_STATS})" \
+                  ") d"
+            cursor.execute(sql)
+            row = cursor.fetchone()
+
+            cursor.execute("DROP TABLE stats_expected")
+
+        except self.ERRORS as e:
+            print(e)
+            return False
+
+        return row[0]
+
+    def is_address_stats_empty(self):
+        """
+        Check if the address_stats table has no rows
+        :return: boolean
+        """
+
+        cursor = self.conn.cursor()
+        cursor.execute(f"SELECT NOT EXISTS (SELECT 1 FROM {Config.TABLE_STATS})")
+        row = cursor.fetchone()
+        return row[0]
+
+    @timed("calc.calculate_lth_sth")
     def calculate_lth_sth(self, address, dt, balance):
         """
         Calculate LTH or STH for address
@@ -651,7 +1298,135 @@ class LocalCalc:
             if balance <= pbl:
                 return 'L'
 
-        except psycopg2.Error as e:
+        except self.ERRORS as e:
             return 'S'
 
         return 'S'
+
+    def begin_active_addresses(self, dt, addresses):
+        """
+        Collect the addresses whose wallet can change on dt into the calc_active temp table.
+        It must be called before the day's logs are merged.
+
+        The other addresses have no records since dt - (WALLET_THRESHOLD + 2) days,
+        so they were LTH yesterday, stay LTH today, and their balances don't change.
+
+        Parameters
+        ----------
+        dt: datetime.date object
+            current date
+        addresses: iterable(str)
+            addresses of the day's logs
+
+        Returns
+        -------
+        array(wallet, balance) of the active addresses before the merge, or False
+        """
+
+        active_dt = dt + datetime.timedelta(days=-(Config.WALLET_THRESHOLD + 2))
+
+        try:
+            cursor = self.conn.cursor()
+
+            cursor.execute("DROP TABLE IF EXISTS calc_active")
+            sql = f"CREATE TEMP TABLE calc_active AS SELECT DISTINCT address FROM {Config.TABLE_LOG} WHERE ts >= %s"
+            cursor.execute(sql, (active_dt,))
+            cursor.execute("ALTER TABLE calc_active ADD PRIMARY KEY (address)")
+
+            execute_values(cursor, "INSERT INTO calc_active (address) VALUES %s ON CONFLICT DO NOTHING",
+                           ((address,) for address in addresses), page_size=Config.CALC_CHUNK_SIZE)
+
+        except self.ERRORS as e:
+            print(e)
+            return False
+
+        return self.get_active_lth_sth()
+
+    def get_active_lth_sth(self):
+        """
+        Gets the LTH and STH balances of the addresses in the calc_active temp table.
+        :return: array(wallet, balance)
+        """
+
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT a.wallet, SUM(a.balance) "
+                           f"FROM {Config.TABLE_ADDRESS} a JOIN calc_active c ON a.address=c.address "
+                           "GROUP BY a.wallet ORDER BY a.wallet")
+            return cursor.fetchall()
+        except self.ERRORS as e:
+            print(e)
+
+        return False
+
+    @timed("calc.classify_addresses")
+    def classify_addresses(self, dt, active=False, rolling=False):
+        """
+        Calculate LTH or STH for every address in a few set-based statements.
+        It gives the same wallets as calling calculate_lth_sth for every address,
+        but costs a window scan of the logs table instead of 4 queries per address.
+
+        Parameters
+        ----------
+        dt: datetime.date object
+            current date
+        active: boolean
+            only recalculate the addresses collected by begin_active_addresses
+        rolling: boolean
+            read the window from the address_stats table instead of scanning the logs table
+
+        Returns
+        -------
+        boolean
+        """
+
+        # get time limits
+        end_dt = dt + datetime.timedelta(days=-1)
+        threshold_dt = end_dt + datetime.timedelta(days=-Config.WALLET_THRESHOLD)
+        begin_dt = end_dt + datetime.timedelta(days=-Config.WINDOW_SIZE)
+
+        try:
+            cursor = self.conn.cursor()
+
+            # Stage 2) previous balance level of the addresses which have records in recent 155 days
+            # The weight sum is cast to double precision as calculate_lth_sth does it via float()
+            cursor.execute("DROP TABLE IF EXISTS calc_levels")
+            sql = "CREATE TEMP TABLE calc_levels AS SELECT address, " \
+                  "2 * SQRT(SUM(balance * balance * (1-LOG(180, " \
+                  "CAST(DATE_PART('day', %s::timestamp - ts::timestamp) AS numeric))))) / " \
+                  "CAST(SUM(1-LOG(180, " \
+                  "CAST(DATE_PART('day', %s::timestamp - ts::timestamp) AS numeric))) AS DOUBLE PRECISION) " \
+                  "AS level "
+            if rolling:
+                # only the addresses that have records in recent 155 days are unnested
+                sql += f"FROM {Config.TABLE_STATS} s, UNNEST(s.days, s.balances) AS l(ts, balance) " \
+                       "WHERE s.last_ts >= %s AND "
+                params = (dt, dt, threshold_dt, begin_dt, end_dt, threshold_dt)
+            else:
+                sql += f"FROM {Config.TABLE_LOG} WHERE "
+                params = (dt, dt, begin_dt, end_dt, threshold_dt)
+            sql += "ts BETWEEN %s AND %s GROUP BY address HAVING MAX(ts) >= %s"
+            cursor.execute(sql, params)
+
+            # Stage 1)
+            # If there is no records in recent 155 days, it is LTH
+            sql = f"UPDATE {Config.TABLE_ADDRESS} a SET wallet='L' " \
+                  "WHERE a.wallet<>'L' AND NOT EXISTS (SELECT 1 FROM calc_levels c WHERE c.address=a.address)"
+            if active:
+                sql += " AND a.address IN (SELECT address FROM calc_active)"
+            cursor.execute(sql)
+
+            # balance <= 2 * Weighed_RSM for 6 month, it is LTH
+            sql = f"UPDATE {Config.TABLE_ADDRESS} a " \
+                  "SET wallet=CASE WHEN a.balance <= c.level THEN 'L' ELSE 'S' END " \
+                  "FROM calc_levels c " \
+                  "WHERE a.address=c.address AND a.wallet<>CASE WHEN a.balance <= c.level THEN 'L' ELSE 'S' END"
+            cursor.execute(sql)
+
+            cursor.execute("DROP TABLE calc_levels")
+
+        except self.ERRORS as e:
+            print(e)
+            return False
+
+        return True
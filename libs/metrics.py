@@ -0,0 +1,296 @@
+import asyncio
+import datetime
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import psycopg2.extensions
+
+from configuration import Config
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, float("inf"))
+
+
+class Metrics:
+    """
+    A class that collects the latency histograms and the counters of the hot paths.
+    Every latency is kept for the current day and since the start,
+    a day's summary goes to a JSON line log, and the totals to a Prometheus text file.
+
+    ATTRIBUTES
+    ----------
+    lock: threading.Lock
+        the fetch threads and the writer record at the same time
+    day: dict
+        "latencies" and "counters" of the current day
+    total: dict
+        "latencies" and "counters" since the start
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+
+        self.lock = threading.Lock()
+        self.day = self.new_scope()
+        self.total = self.new_scope()
+
+    @staticmethod
+    def new_scope():
+        """
+        make empty latencies and counters
+        :return: dict
+        """
+
+        return {"latencies": {}, "counters": {}}
+
+    def observe(self, name, seconds):
+        """
+        record a latency
+        :param name: str
+        :param seconds: float
+        :return: void
+        """
+
+        if not Config.METRICS:
+            return
+
+        bucket = next(i for i, bound in enumerate(BUCKETS) if seconds <= bound)
+
+        with self.lock:
+            for scope in (self.day, self.total):
+                # count, sum of seconds, count of every bucket
+                latency = scope["latencies"].setdefault(name, [0, 0.0, [0] * len(BUCKETS)])
+                latency[0] += 1
+                latency[1] += seconds
+                latency[2][bucket] += 1
+
+    def count(self, name, value=1):
+        """
+        add a value to a counter
+        :param name: str
+        :param value: int
+        :return: void
+        """
+
+        if not Config.METRICS:
+            return
+
+        with self.lock:
+            for scope in (self.day, self.total):
+                scope["counters"][name] = scope["counters"].get(name, 0) + value
+
+    def flush(self, stage, label):
+        """
+        write the summary of the current day into Config.METRICS_LOG,
+        and the totals into Config.METRICS_PROM, then begin a new day
+        :param stage: str
+            "cache" or "calc"
+        :param label: str
+            the day
+        :return: boolean
+        """
+
+        if not Config.METRICS:
+            return True
+
+        with self.lock:
+            day, self.day = self.day, self.new_scope()
+            prometheus = self.prometheus_text(self.total)
+
+        summary = {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "stage": stage,
+            "day": label,
+            "latencies": {name: {
+                "count": count,
+                "seconds": round(seconds, 6),
+                "buckets": {str(bound): n for bound, n in zip(BUCKETS, buckets) if n},
+            } for name, (count, seconds, buckets) in sorted(day["latencies"].items())},
+            "counters": dict(sorted(day["counters"].items())),
+        }
+
+        try:
+            with open(Config.METRICS_LOG, "a") as f:
+                f.write(json.dumps(summary) + "\n")
+
+            if Config.METRICS_PROM:
+                # the collector never reads a half written file
+                temp_file = Config.METRICS_PROM + ".tmp"
+                with open(temp_file, "w") as f:
+                    f.write(prometheus)
+                os.replace(temp_file, Config.METRICS_PROM)
+
+        except IOError as e:
+            print(e)
+            return False
+
+        return True
+
+    @staticmethod
+    def prometheus_text(scope):
+        """
+        format the latencies and the counters in the Prometheus text format
+        :param scope: dict
+        :return: str
+        """
+
+        lines = ["# TYPE anyblock_latency_seconds histogram"]
+        for name, (count, seconds, buckets) in sorted(scope["latencies"].items()):
+            cumulative = 0
+            for bound, n in zip(BUCKETS, buckets):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else str(bound)
+                lines.append('anyblock_latency_seconds_bucket{{name="{}",le="{}"}} {}'.format(name, le, cumulative))
+            lines.append('anyblock_latency_seconds_sum{{name="{}"}} {}'.format(name, seconds))
+            lines.append('anyblock_latency_seconds_count{{name="{}"}} {}'.format(name, count))
+
+        lines.append("# TYPE anyblock_total counter")
+        for name, value in sorted(scope["counters"].items()):
+            lines.append('anyblock_total{{name="{}"}} {}'.format(name, value))
+
+        return "\n".join(lines) + "\n"
+
+
+# the metrics of this process
+metrics = Metrics()
+
+
+def timed(name):
+    """
+    a decorator that records the latency of every call of a function or a coroutine.
+    When Config.METRICS is off as the module is imported, the function is left as it is.
+
+    :param name: str
+        the metric name
+    :return: decorator
+    """
+
+    def decorator(func):
+        if not Config.METRICS:
+            return func
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    metrics.observe(name, time.perf_counter() - started)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.observe(name, time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """
+    A psycopg2 cursor that records every SQL round trip into the latency of its metric name
+    """
+
+    metric = "sql"
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.observe(self.metric, time.perf_counter() - started)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            metrics.observe(self.metric, time.perf_counter() - started)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            metrics.observe(self.metric, time.perf_counter() - started)
+
+
+# the cursor classes of every metric name
+cursor_classes = {}
+
+
+def cursor_factory(name):
+    """
+    get the cursor class for psycopg2.connect
+    :param name: str
+        the metric name of the round trips
+    :return: CountingCursor class, or the plain cursor class when Config.METRICS is off
+    """
+
+    if not Config.METRICS:
+        return psycopg2.extensions.cursor
+
+    if name not in cursor_classes:
+        cursor_classes[name] = type("CountingCursor", (CountingCursor,), {"metric": name})
+
+    return cursor_classes[name]
+
+
+class CountingSqliteCursor(sqlite3.Cursor):
+    """
+    A sqlite3 cursor that records every statement into the sql.sqlite latency
+    """
+
+    def execute(self, *args):
+        started = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            metrics.observe("sql.sqlite", time.perf_counter() - started)
+
+    def executemany(self, *args):
+        started = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            metrics.observe("sql.sqlite", time.perf_counter() - started)
+
+
+class CountingSqliteConnection(sqlite3.Connection):
+    """
+    A sqlite3 connection whose cursors are CountingSqliteCursor
+    """
+
+    def cursor(self, factory=CountingSqliteCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+
+def sqlite_factory():
+    """
+    get the connection class for sqlite3.connect
+    :return: CountingSqliteConnection class, or the plain connection class when Config.METRICS is off
+    """
+
+    if not Config.METRICS:
+        return sqlite3.Connection
+
+    return CountingSqliteConnection
@@ -0,0 +1,126 @@
+import multiprocessing
+import signal
+
+import psycopg2
+
+from configuration import Config
+from libs.local import LocalCalc
+from libs.metrics import timed
+
+# the calc db connection of a worker process
+calculator = None
+
+
+def init_worker():
+    """
+    Initialize a worker process of the calculation pool.
+    It opens its own connection, and ignores the SIGINT(Ctrl+C) signal,
+    so only the main process handles it and the workers are stopped cleanly through the pool.
+    :return: void
+    """
+
+    global calculator
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    calculator = LocalCalc()
+
+
+def classify_shard(task):
+    """
+    Calculate LTH or STH for the addresses of a hash shard.
+    It only reads the calc db, the changed wallets are returned to the main process.
+
+    :param task: (datetime.date, int, int)
+        current date, shard index, and shard count
+    :return: array(address, wallet) of the changed wallets in the shard, or False
+    """
+
+    dt, shard, shards = task
+    changes = []
+
+    try:
+        for rows in calculator.iter_addresses(Config.CALC_CHUNK_SIZE, (shard, shards)):
+            for address, balance, wallet in rows:
+                # get wallet for an address
+                new_wallet = calculator.calculate_lth_sth(address, dt, balance)
+                if new_wallet != wallet:
+                    changes.append((address, new_wallet))
+
+    except psycopg2.Error as e:
+        print(e)
+        return False
+
+    finally:
+        # end the read transaction to see the next day's data
+        calculator.conn.rollback()
+
+    return changes
+
+
+class ParallelCalc:
+    """
+    A class that calculates LTH/STH over a pool of worker processes.
+    The address space is split into hash shards. The workers classify the shards with their own connections,
+    and the main process writes all changed wallets in its transaction,
+    so the day is committed at once with the history.
+
+    ATTRIBUTES
+    ----------
+    calc: LocalCalc
+        the calc db of the main process
+    pool: multiprocessing.Pool
+        the worker processes
+    """
+
+    def __init__(self, calc, workers=0):
+        """
+        Constructor. starts the worker processes
+        :param calc: LocalCalc
+            the calc db of the main process
+        :param workers: int
+            the number of worker processes. If not specified, use Config.CALC_WORKERS
+        """
+
+        self.calc = calc
+
+        # the workers scan their shards over the index
+        calc.create_shard_index(Config.CALC_SHARDS)
+
+        self.pool = multiprocessing.Pool(workers or Config.CALC_WORKERS, initializer=init_worker)
+
+    @timed("calc.classify_addresses")
+    def classify_addresses(self, dt, progress=None):
+        """
+        Calculate LTH or STH for every address and update the changed wallets in bulk.
+        The logs of the day must be committed before, so the workers can see them.
+
+        :param dt: datetime.date object
+            current date
+        :param progress: function
+            called with the finished ratio after every shard
+        :return: boolean
+        """
+
+        shards = Config.CALC_SHARDS
+        tasks = [(dt, shard, shards) for shard in range(shards)]
+        changes = []
+
+        for i, result in enumerate(self.pool.imap_unordered(classify_shard, tasks)):
+            if result is False:
+                return False
+
+            changes.extend(result)
+
+            if progress is not None:
+                progress((i + 1) / shards)
+
+        return self.calc.update_wallets(changes, others=False)
+
+    def close(self):
+        """
+        Let the workers finish and stop them
+        :return: void
+        """
+
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,203 @@
+import datetime
+import multiprocessing
+import os
+import signal
+
+from configuration import Config
+from libs.local import LocalCache
+from libs.metrics import timed
+from libs.shard import open_shard, shard_file
+
+# about the bytes of a log tuple with a hex address in memory, to estimate the logs of a day
+LOG_BYTES = 200
+
+EPOCH = datetime.date(1970, 1, 1)
+
+
+def init_worker():
+    """
+    Initialize a worker process of the prefetch pool.
+    It ignores the SIGINT(Ctrl+C) signal, so only the main process handles it.
+    :return: void
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def day_file(day):
+    """
+    the cache file of a day, in Config.CACHE_BACKEND or in sqlite if it was not converted yet
+    :param day: datetime.date
+    :return: str
+    """
+
+    cache_file = shard_file(day, Config.CACHE_BACKEND)
+    if not os.path.isfile(cache_file):
+        cache_file = shard_file(day)
+
+    return cache_file
+
+
+def is_finished(day):
+    """
+    check if the cache file of a day is written to the end.
+    A day is written under a temporary name, and renamed or converted when it is finished.
+    :param day: datetime.date
+    :return: boolean
+    """
+
+    if Config.CACHE_BACKEND != "sqlite":
+        return os.path.isfile(shard_file(day, Config.CACHE_BACKEND))
+
+    return os.path.isfile(shard_file(day))
+
+
+def read_logs(day):
+    """
+    read the logs of a day from its cache file, as LocalCalc.add_logs converts them
+    :param day: datetime.date
+    :return: list of (address, balance, day), or False
+    """
+
+    cache_file = day_file(day)
+    if not os.path.isfile(cache_file):
+        print("cache db file does not exist: {}".format(cache_file))
+        return False
+
+    cache = open_shard(cache_file)
+
+    if isinstance(cache, LocalCache):
+        data = cache.iter_all()
+        if data is not False:
+            # an address has one record in the file, so the logs are distinct already.
+            # a date object for every distinct day, shared by the logs
+            dates = {}
+            logs = []
+            for row in data:
+                days = int(row[3]) // 86400
+                dt = dates.get(days)
+                if dt is None:
+                    dt = dates[days] = EPOCH + datetime.timedelta(days=days)
+                logs.append((row[1], float(row[2]), dt))
+            data = logs
+    else:
+        # the columnar logs are distinct per address/balance/day
+        data = cache.get_logs()
+
+    cache.close()
+
+    if data is False:
+        print("{} file was corrupted.".format(cache_file))
+
+    return data
+
+
+class ShardPrefetcher:
+    """
+    A class that reads the logs of the next days over a pool of worker processes,
+    while the main process calculates the current day.
+    Only the finished cache files are read ahead, and the days read ahead are limited by a memory budget.
+
+    ATTRIBUTES
+    ----------
+    pool: multiprocessing.Pool
+        the worker processes
+    pending: dict
+        (AsyncResult, estimated bytes) of the days read ahead
+    next_day: datetime.date
+        the next day to read ahead
+    end: datetime.date
+        the last day to read ahead
+    budget: int
+        the bytes of the logs read ahead
+    staged: int
+        the estimated bytes of the pending days
+    """
+
+    def __init__(self, begin, end=None, workers=0, budget=0):
+        """
+        Constructor. starts the worker processes and reads ahead from the first day
+        :param begin: datetime.date
+            the first day
+        :param end: datetime.date
+            the last day. If not specified, yesterday
+        :param workers: int
+            the number of worker processes. If not specified, use Config.PREFETCH_WORKERS
+        :param budget: int
+            the bytes of the logs read ahead. If not specified, use Config.PREFETCH_MEMORY
+        """
+
+        self.pool = multiprocessing.Pool(workers or Config.PREFETCH_WORKERS, initializer=init_worker)
+        self.pending = {}
+        self.next_day = begin
+        self.end = end or datetime.date.today() - datetime.timedelta(days=1)
+        self.budget = budget or Config.PREFETCH_MEMORY
+        self.staged = 0
+
+        self.fill()
+
+    def estimate(self, day):
+        """
+        estimate the bytes of the logs of a day from the record count of its file
+        :param day: datetime.date
+        :return: int, or False
+        """
+
+        cache = open_shard(day_file(day))
+        count = cache.get_record_count()
+        cache.close()
+
+        if count is False:
+            return False
+
+        return count * LOG_BYTES
+
+    def fill(self):
+        """
+        read ahead the next finished days within the budget.
+        A day is read ahead if no day is pending, even if it is over the budget
+        :return: void
+        """
+
+        while self.next_day <= self.end and is_finished(self.next_day):
+            size = self.estimate(self.next_day)
+            if size is False:
+                # it is reported when the day is read
+                break
+
+            if self.pending and self.staged + size > self.budget:
+                break
+
+            self.pending[self.next_day] = (self.pool.apply_async(read_logs, (self.next_day,)), size)
+            self.staged += size
+            self.next_day += datetime.timedelta(days=1)
+
+    @timed("calc.prefetch_wait")
+    def get(self, day):
+        """
+        get the logs of a day, and read ahead the next days
+        :param day: datetime.date
+            the next day, after the day of the last call
+        :return: list of (address, balance, day), or False
+        """
+
+        if day not in self.pending:
+            # the day was not finished when it was due to be read ahead
+            self.next_day = day + datetime.timedelta(days=1)
+            self.fill()
+            return read_logs(day)
+
+        result, size = self.pending.pop(day)
+        self.staged -= size
+        self.fill()
+
+        return result.get()
+
+    def close(self):
+        """
+        Stop the workers, dropping the days read ahead
+        :return: void
+        """
+
+        self.pool.terminate()
+        self.pool.join()
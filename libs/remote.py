@@ -1,6 +1,14 @@
+import collections
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
 from configuration import Config
+from libs.journal import Journal
+from libs.metrics import cursor_factory, timed
+
+# This is the ethereum's birthday
+ORIGIN = datetime.datetime(2015, 7, 30, 15, 0, 0)
 
 
 class RemoteServer:
@@ -15,8 +23,16 @@ class RemoteServer:
         psycopg2 connection
     table: str
         ethereum mainnet balance table name
+    origin: datetime
+        the time from when the data begin
     begin: datetime
         the time from when it starts to fetch
+    journal: Journal
+        the journal of the cached windows
+    done: list
+        (begin, end) of the cached intervals after self.begin, like the days of the back-fill
+    gap: float
+        seconds of the next window
     """
 
     def __init__(self):
@@ -27,41 +43,77 @@ class RemoteServer:
         self.conn = None
         self.table = Config.DB_NAME
 
-        # This is the ethereum's birthday
-        self.begin = datetime.datetime(2015, 7, 30, 15, 0, 0)
+        self.origin = ORIGIN
+        self.begin = self.origin
+
+        # the stored windows
+        self.journal = Journal("cache", datetime.datetime)
+        self.done = []
+
+        # the window size, which is tuned by adapt_gap in the adaptive mode
+        self.gap = Config.TIME_GAP
 
         # connect to the server
+        self.conn = self.connect()
+
+        # if the status file has the last cached time,
+        # set the self.begin to it.
+        self.load_time()
+
+    def connect(self):
+        """
+        Connect to the remote postgre SQL server
+        :return: psycopg2 connection, or None
+        """
+
         try:
-            self.conn = psycopg2.connect(
+            return psycopg2.connect(
                 host=Config.ANY_SERVER,
                 port=Config.ANY_PORT,
                 user=Config.ANY_USER,
                 password=Config.ANY_PASSWORD,
-                dbname=Config.ANY_DB
+                dbname=Config.ANY_DB,
+                cursor_factory=cursor_factory("sql.remote")
             )
 
         except psycopg2.Error as e:
             print(e)
 
-        # if the status file has the last cached time,
-        # set the self.begin to it.
-        self.load_time()
+        return None
+
+    def close(self):
+        """
+        Close the connection
+        :return: void
+        """
+
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
 
-    def fetch_data(self, begin, end):
+        self.journal.close()
+
+    @timed("remote.fetch_data")
+    def fetch_data(self, begin, end, conn=None):
         """
         Fetch data from the server between begin and end
         :param begin: datetime
             specifies from when to fetch
         :param end: datetime
-            specifies till when to fetch
+            specifies till when to fetch, not included
+        :param conn: Object
+            psycopg2 connection to use. If not specified, use self.conn
         :return: 2D array
         """
 
-        sql = "SELECT block_number, address, balance, timestamp FROM {} WHERE timestamp BETWEEN %s AND %s"\
-            .format(self.table)
+        if conn is None:
+            conn = self.conn
+
+        sql = "SELECT block_number, address, balance, timestamp FROM {} " \
+              "WHERE timestamp >= %s AND timestamp < %s".format(self.table)
 
         try:
-            cursor = self.conn.cursor()
+            cursor = conn.cursor()
             cursor.execute(sql, (begin, end))
             return cursor.fetchall()
         except psycopg2.Error as e:
@@ -69,9 +121,51 @@ class RemoteServer:
 
         return False
 
+    @timed("remote.stream_data")
+    def stream_data(self, begin, end):
+        """
+        Stream data from the server between begin and end with a server-side cursor.
+        The rows are fetched Config.FETCH_ITERSIZE at a time while the result is iterated,
+        so a busy window never stays in memory as a whole.
+        :param begin: datetime
+            specifies from when to fetch
+        :param end: datetime
+            specifies till when to fetch, not included
+        :return: iterator of rows, or false
+        """
+
+        sql = "SELECT block_number, address, balance, timestamp FROM {} " \
+              "WHERE timestamp >= %s AND timestamp < %s".format(self.table)
+
+        try:
+            cursor = self.conn.cursor(name="stream_{:%Y%m%d%H%M%S}".format(begin))
+            cursor.itersize = Config.FETCH_ITERSIZE
+            cursor.execute(sql, (begin, end))
+        except psycopg2.Error as e:
+            print(e)
+            self.conn.rollback()
+            return False
+
+        return self.iter_cursor(cursor)
+
+    def iter_cursor(self, cursor):
+        """
+        iterate a server-side cursor and close its transaction at the end
+        :param cursor: psycopg2 named cursor
+        :return: generator of rows
+        """
+
+        try:
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+            self.conn.rollback()
+
     def load_time(self):
         """
-        load the last caching time from the log file
+        load the first time that is not cached yet from the journal.
+        The caching time of the old status file is moved into an empty journal at first.
         :return: void
         """
 
@@ -82,35 +176,129 @@ class RemoteServer:
         except (IOError, ValueError) as e:
             print(e)
 
-        if date:
-            self.begin = date
+        self.journal.migrate(self.origin, date)
+        self.begin = self.journal.lowest_unfinished(self.origin)
+        self.done = [(begin, end) for begin, end, _, _ in self.journal.get_intervals() if end > self.begin]
+
+    def skip_done(self, begin):
+        """
+        move a begin time past the intervals that were cached already
+        :param begin: datetime
+        :return: datetime
+        """
+
+        for done_begin, done_end in self.done:
+            if done_begin <= begin < done_end:
+                begin = done_end
+
+        return begin
 
-    def save_time(self):
+    def complete_window(self, begin, end, rows=None, checksum=None):
+        """
+        record a window in the journal after it was committed into the cache file,
+        and save its end time in the status file
+        :param begin: datetime
+        :param end: datetime
+        :param rows: int
+            the number of the stored rows
+        :param checksum: int
+            the checksum of the stored rows
+        :return: boolean
+        """
+
+        if not self.journal.complete(begin, end, rows, checksum):
+            return False
+
+        return self.save_time(end)
+
+    def save_time(self, time=None):
         """
         save the cached time in the log file
+        :param time: datetime
+            the time until when the data were stored. If not specified, use self.begin
         :return: boolean
         """
 
+        if time is None:
+            time = self.begin
+
         try:
             with open(Config.STATUS_CACHE, "w") as f:
-                f.write(self.begin.isoformat())
+                f.write(time.isoformat())
             return True
         except IOError as e:
             print(e)
 
         return False
 
+    def window_end(self, begin):
+        """
+        get the end time of the window that starts at begin.
+        A window never crosses the day boundary, because the cache files are separated by date.
+        :param begin: datetime
+        :return: datetime
+        """
+
+        end = begin + datetime.timedelta(seconds=self.gap)
+        midnight = datetime.datetime.combine(begin.date() + datetime.timedelta(days=1), datetime.time())
+
+        return min(end, midnight)
+
+    def adapt_gap(self, begin, end, rows, elapsed):
+        """
+        grow or shrink the window toward the target row count and latency of a window,
+        from the result of the last window.
+        It also reports the window into Config.WINDOW_REPORT.
+
+        :param begin: datetime
+            the begin of the last window
+        :param end: datetime
+            the end of the last window
+        :param rows: int
+            the number of rows of the last window
+        :param elapsed: float
+            seconds to fetch and store the last window
+        :return: float, seconds of the next window
+        """
+
+        seconds = (end - begin).total_seconds()
+
+        # the last window of a day is clipped at midnight, its throughput says little
+        clipped = seconds < self.gap and end.time() == datetime.time()
+
+        if Config.ADAPTIVE_GAP and not clipped:
+
+            # the seconds to reach the both targets with the last window's throughput
+            target = seconds * min(Config.TARGET_ROWS / max(rows, 1), Config.TARGET_LATENCY / max(elapsed, 1e-3))
+
+            # change the window smoothly from the current gap, the last window may have an older gap
+            target = min(max(target, self.gap * 0.5), self.gap * 2.0)
+            self.gap = round(min(max(target, Config.MIN_GAP), Config.MAX_GAP))
+
+        if Config.WINDOW_REPORT:
+            try:
+                with open(Config.WINDOW_REPORT, "a") as f:
+                    f.write("{},{},{},{:.3f},{:.0f}\n".format(begin.isoformat(), end.isoformat(), rows, elapsed,
+                                                             self.gap))
+            except IOError as e:
+                print(e)
+
+        return self.gap
+
     def auto_fetch(self):
         """
         fetch data since the last caching for time gap
-        :return: 2D array when success, or false
+        :return: 2D array or iterator of rows when success, or false
         """
 
         # calculate the end time
-        end = self.begin + datetime.timedelta(seconds=Config.TIME_GAP)
+        end = self.window_end(self.begin)
 
         # try fetch data
-        data = self.fetch_data(self.begin, end)
+        if Config.FETCH_ITERSIZE > 0:
+            data = self.stream_data(self.begin, end)
+        else:
+            data = self.fetch_data(self.begin, end)
         if data is False:
             return False
 
@@ -118,3 +306,69 @@ class RemoteServer:
         self.begin = end
 
         return data
+
+    def parallel_fetch(self, workers):
+        """
+        fetch the following windows since the last caching over a pool of connections at the same time.
+        The windows are handed out in timestamp order, and self.begin moves to the end of a window
+        only when it is handed out, so save_time never passes a window that is still in flight.
+        It stops before today's windows.
+
+        :param workers: int
+            the number of connections and windows in flight
+        :return: generator of (begin, end, 2D array or false)
+        """
+
+        try:
+            pool = ThreadedConnectionPool(
+                1, workers,
+                host=Config.ANY_SERVER,
+                port=Config.ANY_PORT,
+                user=Config.ANY_USER,
+                password=Config.ANY_PASSWORD,
+                dbname=Config.ANY_DB,
+                cursor_factory=cursor_factory("sql.remote")
+            )
+        except psycopg2.Error as e:
+            print(e)
+            yield self.begin, self.window_end(self.begin), False
+            return
+
+        def fetch_window(begin, end):
+            conn = pool.getconn()
+            try:
+                return self.fetch_data(begin, end, conn)
+            finally:
+                pool.putconn(conn)
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        pending = collections.deque()
+        scheduled = self.begin
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+
+        try:
+            while True:
+                # keep every connection busy with the next windows
+                while len(pending) < workers and self.skip_done(scheduled) < today:
+                    scheduled = self.skip_done(scheduled)
+                    end = self.window_end(scheduled)
+                    pending.append((scheduled, end, executor.submit(fetch_window, scheduled, end)))
+                    scheduled = end
+
+                if not pending:
+                    return
+
+                # hand out the oldest window
+                begin, end, future = pending.popleft()
+                data = future.result()
+                if data is not False:
+                    self.begin = end
+
+                yield begin, end, data
+
+                if data is False:
+                    return
+
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            pool.closeall()
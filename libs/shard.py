@@ -0,0 +1,481 @@
+import os
+import sqlite3
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from configuration import Config
+from libs.local import LocalCache
+
+
+def shard_file(day, backend="sqlite"):
+    """
+    compose the cache file name of a day
+    :param day: datetime.date or datetime.datetime
+    :param backend: str
+        "sqlite", "parquet", or "arrow"
+    :return: str
+    """
+
+    return "dbs/cache-{}-{}-{}.{}".format(day.year, day.month, day.day, backend)
+
+
+def open_shard(file):
+    """
+    open a cache file of a day by its format
+    :param file: str
+        sqlite, parquet, or arrow cache file name
+    :return: LocalCache, ParquetCache, or ArrowCache
+    """
+
+    if file.endswith(".parquet"):
+        return ParquetCache(file)
+
+    if file.endswith(".arrow"):
+        return ArrowCache(file)
+
+    return LocalCache(file)
+
+
+def shard_schema(address_type):
+    """
+    the typed columns of a columnar cache file
+    :param address_type: pyarrow.DataType
+        pa.string() for addresses, pa.int64() for the ids of the address dictionary
+    :return: pyarrow.Schema
+    """
+
+    return pa.schema([
+        ("block", pa.int64()),
+        ("address", address_type),
+        ("balance", pa.float64()),
+        ("timestamp", pa.timestamp("s")),
+    ])
+
+
+def read_sqlite_tables(sqlite_file, schema, size):
+    """
+    read a sqlite cache file as typed tables
+    :param sqlite_file: str
+        the sqlite cache file of a day
+    :param schema: pyarrow.Schema
+        the schema of shard_schema
+    :param size: int
+        the number of rows of a table
+    :return: generator of pyarrow.Table
+    """
+
+    conn = sqlite3.connect(sqlite_file)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT block, address, balance, timestamp FROM {}".format(Config.DB_NAME))
+
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+
+            blocks, addresses, balances, timestamps = zip(*rows)
+            yield pa.table([
+                pa.array(blocks, pa.int64()),
+                pa.array(addresses, schema.field("address").type),
+                pa.array(balances, pa.float64()),
+                pa.array(np.array(timestamps, dtype=np.int64), pa.int64()).cast(pa.timestamp("s")),
+            ], schema=schema)
+
+    finally:
+        conn.close()
+
+
+def column_view(column):
+    """
+    a NumPy array of a column.
+    A primitive column of a single chunk without nulls is viewed without copying.
+    :param column: pyarrow.ChunkedArray
+    :return: NumPy array
+    """
+
+    if pa.types.is_primitive(column.type) and column.num_chunks == 1 and column.null_count == 0:
+        return column.chunk(0).to_numpy(zero_copy_only=True)
+
+    return column.to_numpy()
+
+
+def day_logs(addresses, balances, timestamps):
+    """
+    convert the rows of a day into the logs of LocalCalc.merge_logs with vectorized operations.
+    Only the last row of the same address, balance, and day is kept, in the order of the rows,
+    so the last log of an address still has its last balance.
+
+    :param addresses: pyarrow.ChunkedArray
+        string addresses, or int64 ids of the address dictionary
+    :param balances: NumPy float64 array
+    :param timestamps: NumPy int64 array
+        epoch seconds
+    :return: list of (address, balance, day) tuples
+    """
+
+    if pa.types.is_integer(addresses.type):
+        codes = column_view(addresses)
+        dictionary = None
+    else:
+        # compare strings by their codes, and convert only the distinct ones to str
+        encoded = addresses.combine_chunks().dictionary_encode()
+        codes = encoded.indices.to_numpy(zero_copy_only=False)
+        dictionary = np.array(encoded.dictionary.to_pylist(), dtype=object)
+
+    days = timestamps // 86400
+
+    # the rows of the same key are sorted by their positions, so the last one ends each group
+    order = np.lexsort((np.arange(len(codes)), days, balances, codes))
+    codes, balances, days = codes[order], balances[order], days[order]
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = (codes[1:] != codes[:-1]) | (balances[1:] != balances[:-1]) | (days[1:] != days[:-1])
+
+    # back to the order of the rows
+    keep = np.argsort(order[last], kind="stable")
+    codes, balances, days = codes[last][keep], balances[last][keep], days[last][keep]
+
+    if dictionary is not None:
+        addresses = dictionary[codes].tolist()
+    else:
+        addresses = codes.tolist()
+
+    # a date object for every distinct day, shared by the logs
+    dates, inverse = np.unique(days, return_inverse=True)
+    dates = dates.astype("datetime64[D]").tolist()
+
+    return list(zip(addresses, balances.tolist(), [dates[i] for i in inverse]))
+
+
+def epoch_seconds(timestamps):
+    """
+    convert a timestamp column into the epoch seconds.
+    Parquet keeps the seconds as milliseconds, so the unit is restored first.
+    :param timestamps: pyarrow.Array or pyarrow.ChunkedArray
+    :return: int64 pyarrow.Array or pyarrow.ChunkedArray
+    """
+
+    return timestamps.cast(pa.timestamp("s")).cast(pa.int64())
+
+
+class ParquetCache:
+    """
+    A class that represents a daily cache file in the columnar Parquet format.
+    It is written once from a finished sqlite cache file of the day,
+    and read back as typed columns without a Python object for every row.
+
+    ATTRIBUTES
+    ----------
+    file: str
+        parquet file name
+    """
+
+    def __init__(self, file):
+        """
+        Constructor
+        :param file: str
+            parquet file name
+        """
+
+        self.file = file
+
+    def read_table(self):
+        """
+        read the whole file
+        :return: pyarrow.Table, or False
+        """
+
+        try:
+            return pq.read_table(self.file)
+        except (IOError, pa.ArrowException) as e:
+            print(e)
+
+        return False
+
+    def read_columns(self):
+        """
+        read the whole file as columns
+        :return: dict of NumPy arrays (block, address, balance, timestamp), or False
+            timestamp is int64 seconds
+        """
+
+        table = self.read_table()
+        if table is False:
+            return False
+
+        columns = {name: table.column(name).to_numpy() for name in ("block", "address", "balance")}
+        columns["timestamp"] = epoch_seconds(table.column("timestamp")).to_numpy()
+
+        return columns
+
+    def iter_all(self, size=Config.CALC_CHUNK_SIZE):
+        """
+        iterate all data as the rows of LocalCache.iter_all
+        :param size: int
+            the number of rows to convert at once
+        :return: iterator of (block, address, balance, timestamp) rows, or False
+        """
+
+        try:
+            parquet = pq.ParquetFile(self.file)
+        except (IOError, pa.ArrowException) as e:
+            print(e)
+            return False
+
+        return self.iter_batches(parquet, size)
+
+    def get_record_count(self):
+        """
+        get the record count from the metadata of the file
+        :return: int, or False
+        """
+
+        try:
+            return pq.ParquetFile(self.file).metadata.num_rows
+        except (IOError, pa.ArrowException) as e:
+            print(e)
+
+        return False
+
+    def get_logs(self):
+        """
+        the logs of the day for LocalCalc.merge_logs
+        :return: list of (address, balance, day) tuples, or False
+        """
+
+        table = self.read_table()
+        if table is False:
+            return False
+
+        balances = column_view(table.column("balance"))
+        timestamps = epoch_seconds(table.column("timestamp")).to_numpy()
+
+        return day_logs(table.column("address"), balances, timestamps)
+
+    @staticmethod
+    def iter_batches(source, size):
+        """
+        convert the record batches of a file into rows
+        :param source: pyarrow.parquet.ParquetFile or pyarrow.Table
+        :param size: int
+            the number of rows of a batch
+        :return: generator of rows
+        """
+
+        if isinstance(source, pa.Table):
+            batches = source.to_batches(max_chunksize=size)
+        else:
+            batches = source.iter_batches(batch_size=size)
+
+        for batch in batches:
+            timestamps = epoch_seconds(batch.column(3))
+            yield from zip(batch.column(0).to_pylist(), batch.column(1).to_pylist(), batch.column(2).to_pylist(),
+                           timestamps.to_pylist())
+
+    def convert_from(self, sqlite_file, size=Config.CALC_CHUNK_SIZE * 100):
+        """
+        write the file from a sqlite cache file.
+        It is written into a temporary file and renamed at the end,
+        so a reader never sees a half written file.
+
+        :param sqlite_file: str
+            the sqlite cache file of the day
+        :param size: int
+            the number of rows of a row group
+        :return: boolean
+        """
+
+        temp_file = self.file + ".tmp"
+
+        try:
+            schema = shard_schema(pa.int64() if Config.ADDRESS_IDS else pa.string())
+
+            with pq.ParquetWriter(temp_file, schema, compression=Config.PARQUET_COMPRESSION) as writer:
+                for table in read_sqlite_tables(sqlite_file, schema, size):
+                    writer.write_table(table)
+
+            os.replace(temp_file, self.file)
+
+        except (sqlite3.Error, IOError, pa.ArrowException) as e:
+            print(e)
+            return False
+
+        return True
+
+    def close(self):
+        pass
+
+
+class ArrowCache:
+    """
+    A class that represents a daily cache file in the Arrow IPC file format.
+    The file is written uncompressed as a single record batch,
+    so it is memory-mapped and its columns are NumPy views of the mapped pages without copying.
+    Rereading a day is served by the page cache of the OS.
+
+    ATTRIBUTES
+    ----------
+    file: str
+        arrow file name
+    """
+
+    def __init__(self, file):
+        """
+        Constructor
+        :param file: str
+            arrow file name
+        """
+
+        self.file = file
+
+    def read_table(self):
+        """
+        map the whole file
+        :return: pyarrow.Table, or False
+        """
+
+        try:
+            source = pa.memory_map(self.file, "r")
+            return pa.ipc.open_file(source).read_all()
+        except (IOError, pa.ArrowException) as e:
+            print(e)
+
+        return False
+
+    def read_columns(self):
+        """
+        read the whole file as columns
+        :return: dict of NumPy arrays (block, address, balance, timestamp), or False
+            timestamp is int64 seconds. The arrays except string addresses are views of the file.
+        """
+
+        table = self.read_table()
+        if table is False:
+            return False
+
+        columns = {name: column_view(table.column(name)) for name in ("block", "address", "balance")}
+        columns["timestamp"] = column_view(table.column("timestamp")).view(np.int64)
+
+        return columns
+
+    def iter_all(self, size=Config.CALC_CHUNK_SIZE):
+        """
+        iterate all data as the rows of LocalCache.iter_all
+        :param size: int
+            the number of rows to convert at once
+        :return: iterator of (block, address, balance, timestamp) rows, or False
+        """
+
+        table = self.read_table()
+        if table is False:
+            return False
+
+        return ParquetCache.iter_batches(table, size)
+
+    def get_record_count(self):
+        """
+        get the record count of the mapped file
+        :return: int, or False
+        """
+
+        table = self.read_table()
+        if table is False:
+            return False
+
+        return table.num_rows
+
+    def get_logs(self):
+        """
+        the logs of the day for LocalCalc.merge_logs
+        :return: list of (address, balance, day) tuples, or False
+        """
+
+        table = self.read_table()
+        if table is False:
+            return False
+
+        balances = column_view(table.column("balance"))
+        timestamps = column_view(table.column("timestamp")).view(np.int64)
+
+        return day_logs(table.column("address"), balances, timestamps)
+
+    def convert_from(self, sqlite_file, size=Config.CALC_CHUNK_SIZE * 100):
+        """
+        write the file from a sqlite cache file.
+        It is written into a temporary file and renamed at the end,
+        so a reader never sees a half written file.
+
+        :param sqlite_file: str
+            the sqlite cache file of the day
+        :param size: int
+            the number of rows to read at once
+        :return: boolean
+        """
+
+        temp_file = self.file + ".tmp"
+
+        try:
+            schema = shard_schema(pa.int64() if Config.ADDRESS_IDS else pa.string())
+
+            tables = list(read_sqlite_tables(sqlite_file, schema, size))
+            table = pa.concat_tables(tables).combine_chunks() if tables else schema.empty_table()
+
+            with pa.ipc.new_file(temp_file, schema) as writer:
+                writer.write_table(table, max_chunksize=max(table.num_rows, 1))
+
+            os.replace(temp_file, self.file)
+
+        except (sqlite3.Error, IOError, pa.ArrowException) as e:
+            print(e)
+            return False
+
+        return True
+
+    def close(self):
+        pass
+
+
+def finish_shard(temp_file, day):
+    """
+    put the finished sqlite file of a day, written under a temporary name, in place of its cache file,
+    converted into Config.CACHE_BACKEND
+    :param temp_file: str
+    :param day: datetime.date or datetime.datetime
+    :return: boolean
+    """
+
+    if Config.CACHE_BACKEND in ("parquet", "arrow"):
+        return convert_shard(temp_file, shard_file(day, Config.CACHE_BACKEND))
+
+    try:
+        os.replace(temp_file, shard_file(day))
+    except OSError as e:
+        print(e)
+        return False
+
+    return True
+
+
+def convert_shard(sqlite_file, shard, keep=False):
+    """
+    convert a finished sqlite cache file into a parquet or arrow cache file
+    :param sqlite_file: str
+    :param shard: str
+        parquet or arrow file name
+    :param keep: boolean
+        keep the sqlite file after converting
+    :return: boolean
+    """
+
+    if not open_shard(shard).convert_from(sqlite_file):
+        return False
+
+    if not keep:
+        # the WAL files of the sqlite file go together
+        for file in (sqlite_file, sqlite_file + "-wal", sqlite_file + "-shm"):
+            if os.path.isfile(file):
+                os.remove(file)
+
+    return True
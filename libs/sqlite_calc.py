@@ -0,0 +1,519 @@
+import datetime
+import math
+import sqlite3
+
+from configuration import Config
+from libs.local import LocalCalc
+from libs.metrics import sqlite_factory, timed
+
+# the dates are stored as ISO text, which sorts and compares as dates
+sqlite3.register_adapter(datetime.date, datetime.date.isoformat)
+sqlite3.register_converter("DATE", lambda value: datetime.date.fromisoformat(value.decode()))
+
+
+def open_calc():
+    """
+    open the local calc db of Config.CALC_BACKEND
+    :return: LocalCalc or SQLiteCalc
+    """
+
+    if Config.CALC_BACKEND == "sqlite":
+        return SQLiteCalc()
+
+    return LocalCalc()
+
+
+def log(base, value):
+    """
+    LOG(base, value) of PostgreSQL
+    :param base: float
+    :param value: float
+    :return: float
+    """
+
+    return math.log(value) / math.log(base)
+
+
+class SQLiteCalc(LocalCalc):
+    """
+    A class that represents the local calc db in an embedded sqlite file instead of the PostgreSQL server.
+    LOG and SQRT are registered into the connection, so the weights and the RMS are calculated
+    with the same statements in the process, and a query costs no network round trip.
+    The logs, addresses and history tables have the same columns, and the dates are ISO text.
+
+    Only the row, set and incremental engines and the range mode are supported.
+    The numpy engine needs a server-side cursor, the parallel engine needs concurrent writers,
+    and the rolling engine needs the array columns of PostgreSQL.
+
+    ATTRIBUTES
+    ----------
+    conn: object
+        sqlite3 connection object
+    """
+
+    ENGINES = ("row", "set", "incremental")
+
+    # the inherited methods report the sqlite errors too
+    ERRORS = (sqlite3.Error,)
+
+    # noinspection PyMissingConstructor
+    def __init__(self, db_file=""):
+        """
+        Constructor
+        :param db_file: str
+            sqlite db file name. If not specified, use the default value: Config.CALC_DB_FILE
+        """
+        self.conn = None
+
+        db = db_file
+        if db == "":
+            db = Config.CALC_DB_FILE
+
+        # open the db file
+        try:
+            self.conn = sqlite3.connect(db, detect_types=sqlite3.PARSE_DECLTYPES, factory=sqlite_factory())
+
+            self.conn.create_function("LOG", 2, log, deterministic=True)
+            self.conn.create_function("SQRT", 1, math.sqrt, deterministic=True)
+
+            cursor = self.conn.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+        except sqlite3.Error as e:
+            print(e)
+            self.conn = None
+
+    def create_tables(self):
+        """
+        Creates the logs, addresses and history tables
+        :return: boolean
+        """
+
+        address_type = "INTEGER" if Config.ADDRESS_IDS else "TEXT"
+
+        try:
+            cursor = self.conn.cursor()
+
+            sql = "CREATE TABLE IF NOT EXISTS {} (" \
+                  "address {} NOT NULL," \
+                  "balance REAL NOT NULL," \
+                  "ts DATE NOT NULL)".format(Config.TABLE_LOG, address_type)
+            cursor.execute(sql)
+
+            sql = "CREATE INDEX IF NOT EXISTS address_time_idx ON {} (address, ts)".format(Config.TABLE_LOG)
+            cursor.execute(sql)
+
+            sql = "CREATE INDEX IF NOT EXISTS time_log_idx ON {} (ts)".format(Config.TABLE_LOG)
+            cursor.execute(sql)
+
+            sql = "CREATE TABLE IF NOT EXISTS {} (" \
+                  "address {} NOT NULL," \
+                  "balance REAL NOT NULL," \
+                  "wallet TEXT NOT NULL)".format(Config.TABLE_ADDRESS, address_type)
+            cursor.execute(sql)
+
+            sql = "CREATE UNIQUE INDEX IF NOT EXISTS address_unique_idx ON {} (address)".format(Config.TABLE_ADDRESS)
+            cursor.execute(sql)
+
+            sql = "CREATE INDEX IF NOT EXISTS wallet_idx ON {} (wallet)".format(Config.TABLE_ADDRESS)
+            cursor.execute(sql)
+
+            sql = "CREATE TABLE IF NOT EXISTS {} (" \
+                  "timestamp DATE NOT NULL," \
+                  "lth REAL NOT NULL," \
+                  "sth REAL NOT NULL)".format(Config.TABLE_HISTORY)
+            cursor.execute(sql)
+
+            sql = "CREATE UNIQUE INDEX IF NOT EXISTS time_idx ON {} (timestamp)".format(Config.TABLE_HISTORY)
+            cursor.execute(sql)
+
+            self.conn.commit()
+
+        except sqlite3.Error as e:
+            print(e)
+            return False
+
+        return True
+
+    @timed("calc.add_history")
+    def add_history(self, timestamp, lth, sth):
+        """
+        Add a new day's LTH, STH balance.
+        If the day is already exists, update it.
+
+        :param timestamp: datetime.date
+        :param lth: float
+        :param sth: float
+        :return: boolean
+        """
+
+        try:
+            sql = "INSERT INTO {} (timestamp, lth, sth) VALUES (?, ?, ?) " \
+                  "ON CONFLICT (timestamp) DO UPDATE SET lth=excluded.lth, sth=excluded.sth".format(Config.TABLE_HISTORY)
+            self.conn.execute(sql, (timestamp, lth, sth))
+        except sqlite3.Error as e:
+            print(e)
+            return False
+
+        return True
+
+    def add_histories(self, rows):
+        """
+        Add or update the LTH, STH balances of many days
+        :param rows: iterable(Union[datetime.date, float, float])
+            (day, lth, sth) of every day
+        :return: boolean
+        """
+
+        try:
+            sql = "INSERT INTO {} (timestamp, lth, sth) VALUES (?, ?, ?) " \
+                  "ON CONFLICT (timestamp) DO UPDATE SET lth=excluded.lth, sth=excluded.sth".format(Config.TABLE_HISTORY)
+            self.conn.executemany(sql, rows)
+        except sqlite3.Error as e:
+            print(e)
+            return False
+
+        return True
+
+    @timed("calc.update_address_wallet")
+    def update_address_wallet(self, address, wallet):
+        """
+        Updates the wallet for an already existing address.
+
+        :param address: str
+        :param wallet: str
+            'L' for LTH, 'S' for STH
+        :return: boolean
+        """
+
+        try:
+            sql = "UPDATE {} SET wallet=? WHERE address=?".format(Config.TABLE_ADDRESS)
+            self.conn.execute(sql, (wallet, address))
+        except sqlite3.Error as e:
+            print(e)
+            return False
+
+        return True
+
+    @timed("calc.update_wallets")
+    def update_wallets(self, wallets, others=True):
+        """
+        Update the wallets of all addresses in bulk.
+
+        :param wallets: iterable(Union[str, str])
+            (address, wallet) of the addresses that have records in recent 155 days
+        :param others: boolean
+            set every other address to LTH. If False, only the given wallets are updated.
+        :return: boolean
+        """
+
+        try:
+            cursor = self.conn.cursor()
+
+            cursor.execute("DROP TABLE IF EXISTS calc_wallets")
+            cursor.execute("CREATE TEMP TABLE calc_wallets (address PRIMARY KEY, wallet TEXT NOT NULL)")
+            cursor.executemany("INSERT INTO calc_wallets (address, wallet) VALUES (?, ?)", wallets)
+
+            if others:
+                sql = f"UPDATE {Config.TABLE_ADDRESS} SET wallet='L' " \
+                      "WHERE wallet<>'L' AND address NOT IN (SELECT address FROM calc_wallets)"
+                cursor.execute(sql)
+
+            # with a subquery instead of UPDATE FROM, which needs sqlite 3.33
+            wallet = f"(SELECT w.wallet FROM calc_wallets w WHERE w.address={Config.TABLE_ADDRESS}.address)"
+            sql = f"UPDATE {Config.TABLE_ADDRESS} SET wallet={wallet} " \
+                  f"WHERE address IN (SELECT address FROM calc_wallets) AND wallet<>{wallet}"
+            cursor.execute(sql)
+
+            cursor.execute("DROP TABLE calc_wallets")
+
+        except sqlite3.Error as e:
+            print(e)
+            return False
+
+        return True
+
+    def check_address(self, address, balance):
+        """
+        Add the address with the default 'S' value of wallet, or update its balance if it exists.
+
+        :param address: str
+        :param balance: float
+        :return: boolean
+        """
+
+        try:
+            sql = "INSERT INTO {} (address, balance, wallet) VALUES (?, ?, 'S') " \
+                  "ON CONFLICT (address) DO UPDATE SET balance=excluded.balance".format(Config.TABLE_ADDRESS)
+            self.conn.execute(sql, (address, balance))
+        except sqlite3.Error as e:
+            print(e)
+            return False
+
+        return True
+
+    def get_addresses(self, offset, count):
+        """
+        Return the address list from offset
+        :param offset: int
+        :param count: int
+        :return: array(address), array(balance)
+        """
+
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT address, balance FROM {} ORDER BY address LIMIT ? OFFSET ?"
+                       .format(Config.TABLE_ADDRESS), (count, offset))
+        res = cursor.fetchall()
+        return [r[0] for r in res], [r[1] for r in res]
+
+    def iter_addresses(self, count, shard=None):
+        """
+        Iterate the addresses table in chunks ordered by address, paging by the last address.
+        The chunks are fetched before they are yielded, as the caller updates the table in between.
+
+        :param count: int
+            number of addresses of a chunk
+        :param shard: not supported, the parallel engine needs the PostgreSQL backend
+        :return: generator of array(address, balance, wallet)
+        """
+
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT address, balance, wallet FROM {} ORDER BY address LIMIT ?"
+                       .format(Config.TABLE_ADDRESS), (count,))
+
+        while True:
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            yield rows
+
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT address, balance, wallet FROM {} WHERE address > ? ORDER BY address LIMIT ?"
+                           .format(Config.TABLE_ADDRESS), (rows[-1][0], count))
+
+    def iter_logs(self, begin_dt, end_dt):
+        """
+        Iterate the logs between the dates in chunks ordered by date
+        :param begin_dt: datetime.date object
+            the first date
+        :param end_dt: datetime.date object
+            the date after the last, not included
+        :return: generator of array(address, balance, ts), raises sqlite3.Error
+        """
+
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT address, balance, ts FROM {} WHERE ts >= ? AND ts < ? ORDER BY ts"
+                       .format(Config.TABLE_LOG), (begin_dt, end_dt))
+
+        while True:
+            rows = cursor.fetchmany(Config.CALC_CHUNK_SIZE * 100)
+            if not rows:
+                break
+
+            yield rows
+
+    def add_log(self, address, balance, timestamp):
+        """
+        Add a record from the caches into log table, unless it exists
+        :param address: str
+        :param balance: float
+        :param timestamp: datetime.date
+        :return: boolean
+        """
+
+        try:
+            sql = "INSERT INTO {0} (address, balance, ts) SELECT ?, ?, ? " \
+                  "WHERE NOT EXISTS (SELECT 1 FROM {0} WHERE address=? AND balance=? AND ts=?)".format(Config.TABLE_LOG)
+            self.conn.execute(sql, (address, balance, timestamp) * 2)
+        except sqlite3.Error as e:
+            print(e)
+            return False
+
+        return True
+
+    @timed("calc.merge_logs")
+    def merge_logs(self, logs, commit=True):
+        """
+        Add the whole logs from a day in bulk.
+        The logs are inserted into a staging table, then merged into the addresses and logs tables with 2 statements.
+        The rowid of the staging table keeps the order of the logs, so the last balance of an address wins.
+
+        :param logs: iterable(Union[str, float, datetime.date])
+            (address, balance, day) of every log
+        :param commit: boolean
+            commit the merge. If False, the caller commits it with its other changes
+        :return: boolean
+        """
+
+        try:
+            cursor = self.conn.cursor()
+
+            cursor.execute("DROP TABLE IF EXISTS logs_stage")
+            cursor.execute("CREATE TEMP TABLE logs_stage (address NOT NULL, balance REAL NOT NULL, ts DATE NOT NULL)")
+            cursor.executemany("INSERT INTO logs_stage (address, balance, ts) VALUES (?, ?, ?)", logs)
+
+            # the balance of the row of MAX(rowid) is taken with it
+            sql = f"INSERT INTO {Config.TABLE_ADDRESS} (address, balance, wallet) " \
+                  "SELECT address, balance, 'S' FROM (" \
+                  "SELECT address, balance, MAX(rowid) FROM logs_stage GROUP BY address) WHERE TRUE " \
+                  "ON CONFLICT (address) DO UPDATE SET balance=excluded.balance"
+            cursor.execute(sql)
+
+            sql = f"INSERT INTO {Config.TABLE_LOG} (address, balance, ts) " \
+                  "SELECT DISTINCT s.address, s.balance, s.ts FROM logs_stage s " \
+                  f"WHERE NOT EXISTS (SELECT 1 FROM {Config.TABLE_LOG} l " \
+                  "WHERE l.address=s.address AND l.balance=s.balance AND l.ts=s.ts)"
+            cursor.execute(sql)
+
+            cursor.execute("DROP TABLE logs_stage")
+
+            if commit:
+                self.conn.commit()
+            return True
+
+        except sqlite3.Error as e:
+            print(e)
+            self.conn.rollback()
+
+        return False
+
+    @timed("calc.calculate_lth_sth")
+    def calculate_lth_sth(self, address, dt, balance):
+        """
+        Calculate LTH or STH for address
+        :param address: str
+        :param dt: datetime.date object
+            current date
+        :param balance: float
+            current balance
+        :return: 'L' for LTH, 'S' for STH
+        """
+
+        cursor = self.conn.cursor()
+
+        # Stage 1)
+        # If there is no records in recent 155 days, it is LTH
+        end_dt = dt + datetime.timedelta(days=-1)
+        begin_dt = end_dt + datetime.timedelta(days=-Config.WALLET_THRESHOLD)
+
+        sql = f"SELECT COUNT(*) FROM {Config.TABLE_LOG} WHERE address=? AND ts BETWEEN ? AND ?"
+        cursor.execute(sql, (address, begin_dt, end_dt))
+
+        if cursor.fetchone()[0] < 1:
+            return 'L'
+
+        # Stage 2)
+        # balance < 2 * Weighed_RSM for 6 month, it is LTH
+        begin_dt = end_dt + datetime.timedelta(days=-Config.WINDOW_SIZE)
+
+        try:
+            sql = "SELECT SUM(1-LOG(180, JULIANDAY(?) - JULIANDAY(ts))) " \
+                  f"FROM {Config.TABLE_LOG} WHERE address=? AND ts BETWEEN ? AND ?"
+            cursor.execute(sql, (dt, address, begin_dt, end_dt))
+            weights = float(cursor.fetchone()[0])
+
+            sql = "SELECT 2 * SQRT(SUM(balance * balance * (1-LOG(180, JULIANDAY(?) - JULIANDAY(ts))))) / ? " \
+                  f"FROM {Config.TABLE_LOG} WHERE address=? AND ts BETWEEN ? AND ?"
+            cursor.execute(sql, (dt, weights, address, begin_dt, end_dt))
+            pbl = cursor.fetchone()[0]
+
+            # a zero weight sum gives NULL here, where PostgreSQL fails with the division
+            if pbl is not None and balance <= pbl:
+                return 'L'
+
+        except sqlite3.Error:
+            return 'S'
+
+        return 'S'
+
+    def begin_active_addresses(self, dt, addresses):
+        """
+        Collect the addresses whose wallet can change on dt into the calc_active temp table.
+        It must be called before the day's logs are merged.
+
+        :param dt: datetime.date object
+        :param addresses: iterable(str)
+            addresses of the day's logs
+        :return: array(wallet, balance) of the active addresses before the merge, or False
+        """
+
+        active_dt = dt + datetime.timedelta(days=-(Config.WALLET_THRESHOLD + 2))
+
+        try:
+            cursor = self.conn.cursor()
+
+            cursor.execute("DROP TABLE IF EXISTS calc_active")
+            cursor.execute("CREATE TEMP TABLE calc_active (address PRIMARY KEY)")
+
+            sql = f"INSERT OR IGNORE INTO calc_active (address) SELECT address FROM {Config.TABLE_LOG} WHERE ts >= ?"
+            cursor.execute(sql, (active_dt,))
+
+            cursor.executemany("INSERT OR IGNORE INTO calc_active (address) VALUES (?)",
+                               ((address,) for address in addresses))
+
+        except sqlite3.Error as e:
+            print(e)
+            return False
+
+        return self.get_active_lth_sth()
+
+    @timed("calc.classify_addresses")
+    def classify_addresses(self, dt, active=False, rolling=False):
+        """
+        Calculate LTH or STH for every address in a few set-based statements,
+        the same way as LocalCalc.classify_addresses.
+
+        :param dt: datetime.date object
+            current date
+        :param active: boolean
+            only recalculate the addresses collected by begin_active_addresses
+        :param rolling: not supported, there is no address_stats table
+        :return: boolean
+        """
+
+        if rolling:
+            print("The rolling window needs the PostgreSQL backend.")
+            return False
+
+        end_dt = dt + datetime.timedelta(days=-1)
+        threshold_dt = end_dt + datetime.timedelta(days=-Config.WALLET_THRESHOLD)
+        begin_dt = end_dt + datetime.timedelta(days=-Config.WINDOW_SIZE)
+
+        try:
+            cursor = self.conn.cursor()
+
+            # Stage 2) previous balance level of the addresses which have records in recent 155 days
+            cursor.execute("DROP TABLE IF EXISTS calc_levels")
+            cursor.execute("CREATE TEMP TABLE calc_levels (address PRIMARY KEY, level REAL)")
+            # the weight of a log is calculated once for both sums
+            sql = "INSERT INTO calc_levels (address, level) SELECT address, " \
+                  "2 * SQRT(SUM(balance * balance * weight)) / SUM(weight) FROM (" \
+                  "SELECT address, balance, ts, 1-LOG(180, JULIANDAY(?) - JULIANDAY(ts)) AS weight " \
+                  f"FROM {Config.TABLE_LOG} WHERE ts BETWEEN ? AND ?" \
+                  ") GROUP BY address HAVING MAX(ts) >= ?"
+            cursor.execute(sql, (dt, begin_dt, end_dt, threshold_dt))
+
+            # Stage 1)
+            # If there is no records in recent 155 days, it is LTH
+            sql = f"UPDATE {Config.TABLE_ADDRESS} SET wallet='L' " \
+                  "WHERE wallet<>'L' AND address NOT IN (SELECT address FROM calc_levels)"
+            if active:
+                sql += " AND address IN (SELECT address FROM calc_active)"
+            cursor.execute(sql)
+
+            # balance <= 2 * Weighed_RSM for 6 month, it is LTH
+            # with subqueries instead of UPDATE FROM, which needs sqlite 3.33
+            wallet = "(SELECT CASE WHEN balance <= c.level THEN 'L' ELSE 'S' END FROM calc_levels c " \
+                     f"WHERE c.address={Config.TABLE_ADDRESS}.address)"
+            sql = f"UPDATE {Config.TABLE_ADDRESS} SET wallet={wallet} " \
+                  f"WHERE address IN (SELECT address FROM calc_levels) AND wallet<>{wallet}"
+            cursor.execute(sql)
+
+            cursor.execute("DROP TABLE calc_levels")
+
+        except sqlite3.Error as e:
+            print(e)
+            return False
+
+        return True
@@ -0,0 +1,407 @@
+import datetime
+import os
+import sqlite3
+
+import numpy as np
+import psycopg2
+
+from configuration import Config
+from libs.columnar import ColumnarCalc
+
+# the exact totals are integers in units of 2 ** -EXACT_SHIFT,
+# the mantissa bits of the smallest float
+EXACT_SHIFT = 1074 + 53
+
+# the elements summed at once, the float sums of the 26 bit halves of the mantissas stay exact
+EXACT_CHUNK = 1 << 24
+
+
+def exact_total(values):
+    """
+    the exact sum of floats
+    :param values: array(float)
+    :return: int, in units of 2 ** -EXACT_SHIFT
+    """
+
+    total = 0
+    for start in range(0, len(values), EXACT_CHUNK):
+        fractions, exponents = np.frexp(values[start:start + EXACT_CHUNK])
+
+        # value = mantissa * 2 ** (exponent - 53), with an integer mantissa
+        mantissas = (fractions * 2.0 ** 53).astype(np.int64)
+        shifts = exponents + 1074
+
+        high = np.bincount(shifts, weights=mantissas >> 26)
+        low = np.bincount(shifts, weights=mantissas & 0x3FFFFFF)
+
+        for shift in np.flatnonzero((high != 0) | (low != 0)):
+            total += ((int(high[shift]) << 26) + int(low[shift])) << int(shift)
+
+    return total
+
+
+class AddressState:
+    """
+    A class that keeps the state of the calculation of every address in memory as arrays.
+    An address has a dense id, its current balance and wallet are array elements,
+    and the logs of the Stage 2) window are columns of address ids, dates and balances.
+    A day is classified with array operations, and the LTH/STH totals are exact sums.
+    It can be saved as a snapshot and loaded again, so a restart does not read the whole tables.
+
+    ATTRIBUTES
+    ----------
+    day: datetime.date
+        the first day that is not merged into the state
+    index: dict
+        the id of every address
+    addresses: list
+        the address of every id
+    balances: array(float)
+        the current balance of every id
+    wallets: array(bool)
+        True for STH, False for LTH
+    dirty: array(bool)
+        the ids whose balance or wallet changed since the last write-through
+    log_ids, log_days, log_balances: array
+        address id, date ordinal and balance of every log in the window, one log per address/balance/day
+    log_count: int
+        the number of the used elements of the log columns
+    """
+
+    def __init__(self, day):
+        """
+        Constructor. an empty state
+        :param day: datetime.date
+            the first day to merge
+        """
+
+        self.day = day
+        self.index = {}
+        self.addresses = []
+        self.balances = np.zeros(1024)
+        self.wallets = np.zeros(1024, dtype=bool)
+        self.dirty = np.zeros(1024, dtype=bool)
+        self.log_ids = np.zeros(1024, dtype=np.int64)
+        self.log_days = np.zeros(1024, dtype=np.int32)
+        self.log_balances = np.zeros(1024)
+        self.log_count = 0
+
+    @property
+    def count(self):
+        """
+        :return: int, the number of addresses
+        """
+
+        return len(self.addresses)
+
+    @staticmethod
+    def grow(array, size):
+        """
+        get an array that has room for size elements, doubling its capacity
+        :param array: array
+        :param size: int
+        :return: array, the same one if it has room
+        """
+
+        if size <= len(array):
+            return array
+
+        grown = np.zeros(max(size, 2 * len(array)), dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def get_ids(self, addresses):
+        """
+        get the ids of addresses, adding the new ones
+        :param addresses: iterable(str)
+        :return: array(int)
+        """
+
+        ids = []
+        for address in addresses:
+            i = self.index.get(address)
+            if i is None:
+                i = len(self.addresses)
+                self.index[address] = i
+                self.addresses.append(address)
+            ids.append(i)
+
+        count = self.count
+        self.balances = self.grow(self.balances, count)
+        self.wallets = self.grow(self.wallets, count)
+        self.dirty = self.grow(self.dirty, count)
+
+        return np.array(ids, dtype=np.int64)
+
+    def add_addresses(self, rows):
+        """
+        add the addresses from the addresses table
+        :param rows: array(address, balance, wallet)
+        :return: void
+        """
+
+        if not rows:
+            return
+
+        addresses, balances, wallets = zip(*rows)
+        ids = self.get_ids(addresses)
+        self.balances[ids] = balances
+        self.wallets[ids] = np.array(wallets) == 'S'
+
+    def add_window(self, ids, days, balances):
+        """
+        append logs to the window columns, dropping the ones that are there already
+        :param ids: array(int)
+        :param days: array(int)
+            date ordinals
+        :param balances: array(float)
+        :return: void
+        """
+
+        n = self.log_count
+
+        # only the logs of the same days can be the same
+        same = np.flatnonzero(np.isin(self.log_days[:n], np.unique(days)))
+        ids = np.concatenate((self.log_ids[same], ids))
+        days = np.concatenate((self.log_days[same], days))
+        balances = np.concatenate((self.log_balances[same], balances))
+
+        order = np.lexsort((balances, days, ids))
+        ids, days, balances = ids[order], days[order], balances[order]
+        first = np.concatenate(([True], (ids[1:] != ids[:-1]) | (days[1:] != days[:-1]) |
+                                (balances[1:] != balances[:-1])))
+
+        # the old logs of those days are replaced by the distinct logs
+        keep = np.ones(n, dtype=bool)
+        keep[same] = False
+        self.compact(keep)
+
+        n = self.log_count
+        size = n + int(first.sum())
+        self.log_ids = self.grow(self.log_ids, size)
+        self.log_days = self.grow(self.log_days, size)
+        self.log_balances = self.grow(self.log_balances, size)
+
+        self.log_ids[n:size] = ids[first]
+        self.log_days[n:size] = days[first]
+        self.log_balances[n:size] = balances[first]
+        self.log_count = size
+
+    def compact(self, keep):
+        """
+        keep only some logs of the window
+        :param keep: array(bool)
+            for every used element of the log columns
+        :return: void
+        """
+
+        size = int(keep.sum())
+        if size == self.log_count:
+            return
+
+        n = self.log_count
+        self.log_ids[:size] = self.log_ids[:n][keep]
+        self.log_days[:size] = self.log_days[:n][keep]
+        self.log_balances[:size] = self.log_balances[:n][keep]
+        self.log_count = size
+
+    def merge(self, logs):
+        """
+        merge the logs of a day, as LocalCalc.merge_logs does
+        :param logs: list of (address, balance, day)
+        :return: void
+        """
+
+        if not logs:
+            return
+
+        addresses, balances, days = zip(*logs)
+        count = self.count
+        ids = self.get_ids(addresses)
+
+        # a new address starts with 'S'
+        self.wallets[count:self.count] = True
+
+        balances = np.array(balances, dtype=np.float64)
+        days = np.array([day.toordinal() for day in days], dtype=np.int32)
+
+        # the last balance of an address is its balance
+        last_ids, reverse = np.unique(ids[::-1], return_index=True)
+        self.balances[last_ids] = balances[len(ids) - 1 - reverse]
+        self.dirty[last_ids] = True
+
+        self.add_window(ids, days, balances)
+
+    def classify(self, dt):
+        """
+        classify every address on a day, as LocalCalc.classify_addresses does
+        :param dt: datetime.date
+            current date, whose logs were merged
+        :return: void
+        """
+
+        today = dt.toordinal()
+        end = today - 1
+        begin = end - Config.WINDOW_SIZE
+
+        # the logs that left the window
+        n = self.log_count
+        self.compact(self.log_days[:n] >= begin)
+
+        n = self.log_count
+        mask = self.log_days[:n] <= end
+        ids = self.log_ids[:n][mask]
+        order = np.argsort(ids, kind="stable")
+        ids = ids[order]
+
+        actives, wallets = ColumnarCalc.classify_window(ids, today - self.log_days[:n][mask][order],
+                                                        self.log_balances[:n][mask][order], self.balances[ids])
+
+        # every address without records in recent 155 days is LTH
+        count = self.count
+        new = np.zeros(count, dtype=bool)
+        new[actives] = wallets == 'S'
+
+        self.dirty[:count] |= new != self.wallets[:count]
+        self.wallets[:count] = new
+
+        self.day = dt + datetime.timedelta(days=1)
+
+    def get_lth_sth(self):
+        """
+        the LTH and STH totals, correctly rounded
+        :return: (lth, sth)
+        """
+
+        count = self.count
+        balances = self.balances[:count]
+        wallets = self.wallets[:count]
+
+        return exact_total(balances[~wallets]) / 2 ** EXACT_SHIFT, exact_total(balances[wallets]) / 2 ** EXACT_SHIFT
+
+    def get_dirty(self):
+        """
+        get the addresses that changed since the last write-through
+        :return: list of (address, balance, wallet)
+        """
+
+        ids = np.flatnonzero(self.dirty[:self.count])
+        return [(self.addresses[i], float(self.balances[i]), 'S' if self.wallets[i] else 'L') for i in ids]
+
+    def clean(self):
+        """
+        forget the changes after they were written through
+        :return: void
+        """
+
+        self.dirty[:] = False
+
+    @classmethod
+    def from_calc(cls, calc, day):
+        """
+        build the state from the addresses table and the logs of the window before a day
+        :param calc: LocalCalc
+        :param day: datetime.date
+            the first day to merge, the days before must be calculated
+        :return: AddressState, or None
+        """
+
+        state = cls(day)
+        window_dt = day + datetime.timedelta(days=-(Config.WINDOW_SIZE + 1))
+
+        try:
+            for rows in calc.iter_addresses(Config.CALC_CHUNK_SIZE * 100):
+                state.add_addresses(rows)
+
+            for rows in calc.iter_logs(window_dt, day):
+                addresses, balances, days = zip(*rows)
+                state.add_window(state.get_ids(addresses), np.array([ts.toordinal() for ts in days], dtype=np.int32),
+                                 np.array(balances, dtype=np.float64))
+
+        except (psycopg2.Error, sqlite3.Error) as e:
+            print(e)
+            return None
+
+        return state
+
+    @staticmethod
+    def history_key(history):
+        """
+        the values of a history row that a snapshot is checked with
+        :param history: (date, lth, sth)
+            the last row of the history table
+        :return: list of float
+        """
+
+        return [float(history[0].toordinal()), float(history[1]), float(history[2])]
+
+    def save(self, history, file=""):
+        """
+        save a snapshot of the state.
+        It is written into a temporary file and renamed, so a reader never sees a half written file.
+        :param history: (date, lth, sth)
+            the last row of the history table, written with the state
+        :param file: str
+            the snapshot file name. If not specified, use the default value: Config.STATE_FILE
+        :return: boolean
+        """
+
+        if file == "":
+            file = Config.STATE_FILE
+
+        count = self.count
+        n = self.log_count
+        temp_file = file + ".tmp.npz"
+
+        try:
+            np.savez(temp_file, day=np.array(self.day.toordinal()), history=np.array(self.history_key(history)),
+                     addresses=np.array(self.addresses),
+                     balances=self.balances[:count], wallets=self.wallets[:count],
+                     log_ids=self.log_ids[:n], log_days=self.log_days[:n], log_balances=self.log_balances[:n])
+            os.replace(temp_file, file)
+        except IOError as e:
+            print(e)
+            return False
+
+        return True
+
+    @classmethod
+    def load(cls, day, history, file=""):
+        """
+        load the snapshot of the state before a day
+        :param day: datetime.date
+            the first day to merge
+        :param history: (date, lth, sth)
+            the last row of the history table, which must be the one saved with the state
+        :param file: str
+            the snapshot file name. If not specified, use the default value: Config.STATE_FILE
+        :return: AddressState, or None if there is no snapshot of the day and the history
+        """
+
+        if file == "":
+            file = Config.STATE_FILE
+
+        try:
+            with np.load(file) as data:
+                if datetime.date.fromordinal(int(data["day"])) != day:
+                    return None
+
+                # a snapshot of another calc db, or of the days that were calculated again
+                if not history or data["history"].tolist() != cls.history_key(history):
+                    return None
+
+                state = cls(day)
+                state.addresses = data["addresses"].tolist()
+                state.index = {address: i for i, address in enumerate(state.addresses)}
+                state.balances = data["balances"]
+                state.wallets = data["wallets"]
+                state.dirty = np.zeros(len(state.addresses), dtype=bool)
+                state.log_ids = data["log_ids"]
+                state.log_days = data["log_days"]
+                state.log_balances = data["log_balances"]
+                state.log_count = len(state.log_ids)
+
+        except (IOError, ValueError, KeyError):
+            return None
+
+        return state
@@ -0,0 +1,121 @@
+from configuration import Config
+from libs.state import AddressState
+
+
+class RangeSweep:
+    """
+    A class that calculates the days of a range in one pass, keeping the state of every address in memory.
+    The state before the range is loaded once from its snapshot, or from the addresses table and the window of logs,
+    then every day's logs are merged and the addresses are classified in the AddressState,
+    and the logs, the changed addresses and the history are written through in a batch.
+
+    It gives the same wallets as classifying the days one by one.
+    The LTH/STH totals are exact sums, so they do not depend on the order of the balances.
+
+    ATTRIBUTES
+    ----------
+    calc: LocalCalc
+        the calc db to load from and to save into
+    begin: datetime.date
+        the first day of the range
+    state: AddressState
+        the addresses and the window
+    logs: list
+        (address, balance, day) of the logs merged since the last save
+    """
+
+    def __init__(self, calc, begin):
+        """
+        Constructor
+        :param calc: LocalCalc
+        :param begin: datetime.date
+            the first day of the range, the days before must be calculated
+        """
+
+        self.calc = calc
+        self.begin = begin
+        self.state = None
+        self.logs = []
+
+    def load(self):
+        """
+        load the state before the first day from its snapshot, or from the calc db.
+        The snapshot is used only when it was saved with the last history row of the calc db
+        :return: boolean
+        """
+
+        self.state = None
+        if Config.STATE_SNAPSHOT_DAYS > 0:
+            self.state = AddressState.load(self.begin, self.calc.get_last_history())
+
+        # a snapshot of another calc db, or of the days that were calculated again
+        if self.state is not None and self.state.count != self.calc.get_address_count():
+            self.state = None
+
+        if self.state is None:
+            self.state = AddressState.from_calc(self.calc, self.begin)
+
+        return self.state is not None
+
+    def add_logs(self, logs):
+        """
+        merge the logs of a day, as LocalCalc.merge_logs does
+        :param logs: list of (address, balance, day)
+        :return: void
+        """
+
+        self.state.merge(logs)
+        self.logs.extend(logs)
+
+    def classify(self, dt):
+        """
+        classify the addresses on a day, as LocalCalc.classify_addresses does
+        :param dt: datetime.date
+            current date, whose logs were merged
+        :return: (lth, sth)
+        """
+
+        self.state.classify(dt)
+
+        return self.state.get_lth_sth()
+
+    def get_address_count(self):
+        """
+        :return: int, the number of addresses
+        """
+
+        return self.state.count
+
+    def save(self, history):
+        """
+        write the logs and the addresses changed since the last save, and the history of the days, in a transaction
+        :param history: list of (datetime.date, lth, sth)
+        :return: boolean
+        """
+
+        wallets = ((address, wallet) for address, _, wallet in self.state.get_dirty())
+
+        if not self.calc.merge_logs(self.logs, commit=False) or \
+                not self.calc.update_wallets(wallets, others=False) or \
+                not self.calc.add_histories(history):
+            self.calc.conn.rollback()
+            return False
+
+        self.calc.conn.commit()
+
+        self.logs = []
+        self.state.clean()
+
+        return True
+
+    def snapshot(self):
+        """
+        save the snapshot of the state after the last saved day, so the next range starts without reading the tables
+        :return: boolean
+        """
+
+        history = self.calc.get_last_history()
+        if not history:
+            return False
+
+        return self.state.save(history, Config.STATE_FILE)
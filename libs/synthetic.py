@@ -0,0 +1,123 @@
+import datetime
+import random
+
+
+class SyntheticChain:
+    """
+    A class that generates the balance changes of a synthetic ethereum mainnet from a seed,
+    in the rows of the anyblock.net balance table.
+    Some addresses are much busier than the others and change many times a day,
+    the active addresses are replaced by new ones day by day, and some balances are emptied to 0.
+
+    ATTRIBUTES
+    ----------
+    rand: random.Random
+        the seeded random generator
+    start: datetime.datetime
+        the first day
+    rows: int
+        the number of balance changes a day
+    churn: float
+        the ratio of the active addresses that are replaced by new ones every day
+    zero_rate: float
+        the ratio of the changes that empty a balance
+    active: list
+        the addresses that change, the first ones are the busiest
+    balances: dict
+        the last balance of every address in wei
+    block: int
+        the last block number
+    """
+
+    def __init__(self, seed=0, addresses=10000, rows=20000, start=datetime.datetime(2020, 1, 1), churn=0.01,
+                 zero_rate=0.05):
+        """
+        Constructor
+        :param seed: int
+            the random seed, the same seed gives the same rows
+        :param addresses: int
+            the number of active addresses
+        :param rows: int
+            the number of balance changes a day
+        :param start: datetime.datetime
+            the first day
+        :param churn: float
+            the ratio of the active addresses that are replaced by new ones every day
+        :param zero_rate: float
+            the ratio of the changes that empty a balance
+        """
+
+        self.rand = random.Random(seed)
+        self.start = start
+        self.rows = rows
+        self.churn = churn
+        self.zero_rate = zero_rate
+        self.balances = {}
+        self.block = 10000000
+
+        self.active = [self.new_address() for _ in range(addresses)]
+
+    def new_address(self):
+        """
+        make a new random address
+        :return: str
+        """
+
+        return "0x{:040x}".format(self.rand.getrandbits(160))
+
+    def new_balance(self, address):
+        """
+        the next balance of an address
+        :param address: str
+        :return: int, balance in wei
+        """
+
+        balance = self.balances.get(address, 0)
+
+        if balance > 0 and self.rand.random() < self.zero_rate:
+            return 0
+
+        if balance > 0 and self.rand.random() < 0.8:
+            # most changes move a part of the balance
+            return max(int(balance * self.rand.lognormvariate(0, 0.5)), 1)
+
+        return int(self.rand.paretovariate(1.2) * 1e17)
+
+    def day(self, n):
+        """
+        generate the balance changes of a day
+        :param n: int
+            the day index from the start
+        :return: list of (block_number, address, balance, timestamp) sorted by timestamp
+        """
+
+        # some active addresses go dormant, and new ones come
+        for _ in range(int(len(self.active) * self.churn)):
+            self.active[self.rand.randrange(len(self.active))] = self.new_address()
+
+        begin = self.start + datetime.timedelta(days=n)
+        seconds = sorted(self.rand.randrange(86400) for _ in range(self.rows))
+
+        data = []
+        for second in seconds:
+            # the busy addresses at the front are picked much more often
+            address = self.active[int(len(self.active) * self.rand.random() ** 3)]
+            balance = self.new_balance(address)
+            self.balances[address] = balance
+
+            # a block every 13 seconds
+            self.block = max(self.block, int((begin - self.start).total_seconds() + second) // 13 + 10000000)
+            data.append((self.block, address, balance, begin + datetime.timedelta(seconds=second)))
+
+        return data
+
+    def days(self, count):
+        """
+        generate the balance changes of days one by one
+        :param count: int
+            the number of days
+        :return: generator of (datetime.datetime, list of rows)
+        """
+
+        for n in range(count):
+            yield self.start + datetime.timedelta(days=n), self.day(n)
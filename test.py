@@ -1,9 +1,27 @@
 from configuration import Config
 import psycopg2
+import random
 import time
 import datetime
-from libs.local import LocalCache
-from libs.remote import RemotePostgreSQL
+import calendar
+import fractions
+import os
+import tempfile
+import signal
+import sys
+import numpy as np
+import do_cache
+from libs import backfill
+from libs.addressbook import AddressBook
+from libs.async_remote import AsyncRemoteServer
+from libs.columnar import ColumnarCalc
+from libs.local import LocalCache, LocalCalc
+from libs.remote import ORIGIN, RemoteServer
+from libs.sqlite_calc import SQLiteCalc
+from libs.state import EXACT_SHIFT, AddressState, exact_total
+from libs.shard import shard_file
+from libs.sweep import RangeSweep
+from libs.synthetic import SyntheticChain
 
 
 def test_remote_connect():
@@ -51,31 +69,33 @@ def test_timestamp():
 
 
 def test_local():
-    local = LocalCache()
-    local.create_table()
+    with tempfile.TemporaryDirectory() as folder:
+        local = LocalCache(os.path.join(folder, "cache.sqlite"))
+        local.create_table()
 
-    # insert initial data
-    local.proc_record(3, [[1, "0x33333333333", 11223344556677, datetime.datetime(2021, 5, 6, 15, 38, 40)]])
-    local.proc_record(4, [[1, "0x44444444444", 22334455, datetime.datetime(2021, 5, 7, 15, 38, 40)]])
-    local.proc_record(5, [[1, "0x55555555555", 345, datetime.datetime(2021, 5, 8, 15, 38, 40)]])
+        # insert initial data
+        local.proc_record([[1, "0x33333333333", 11223344556677, datetime.datetime(2021, 5, 6, 15, 38, 40)]])
+        local.proc_record([[1, "0x44444444444", 22334455, datetime.datetime(2021, 5, 7, 15, 38, 40)]])
+        local.proc_record([[1, "0x55555555555", 345, datetime.datetime(2021, 5, 8, 15, 38, 40)]])
 
-    # checking data
-    # should not be inserted
-    local.proc_record(6, [[1, "0x33333333333", 11223344556677, datetime.datetime(2021, 5, 6, 15, 38, 40)]])
+        # checking data
+        # should not be inserted
+        local.proc_record([[1, "0x33333333333", 11223344556677, datetime.datetime(2021, 5, 6, 15, 38, 40)]])
 
-    # should be deleted
-    local.proc_record(7, [[1, "0x55555555555", 0, datetime.datetime(2021, 5, 6, 15, 38, 40)]])
+        # should be deleted
+        local.proc_record([[1, "0x55555555555", 0, datetime.datetime(2021, 5, 6, 15, 38, 40)]])
 
-    # check that only two records are stored.
-    rows = local.get_all()
-    for row in rows:
-        print(row)
+        # check that only two records are stored.
+        rows = local.get_all()
+        for row in rows:
+            print(row)
+        assert len(rows) == 2
 
-    local.close()
+        local.close()
 
 
 def test_remote_server():
-    server = RemotePostgreSQL()
+    server = RemoteServer()
     begin = datetime.datetime(2021, 5, 7, 15, 0, 0)
     end = datetime.datetime(2021, 5, 7, 15, 1, 0)
 
@@ -93,9 +113,450 @@ def test_remote_server():
     print("{} records are retrieved from {}.".format(len(data), server.begin))
 
 
+def make_synthetic_calc(seed, dt, count=500):
+    """
+    Open the local calc db with temporary logs and addresses tables of synthetic data.
+    The temporary tables shadow the real ones in this session, and disappear with it.
+    """
+    calc = LocalCalc()
+    cursor = calc.conn.cursor()
+
+    cursor.execute("CREATE TEMP TABLE {} (address TEXT NOT NULL, balance DOUBLE PRECISION NOT NULL, "
+                   "ts DATE NOT NULL)".format(Config.TABLE_LOG))
+    cursor.execute("CREATE TEMP TABLE {} (address TEXT NOT NULL, balance DOUBLE PRECISION NOT NULL, "
+                   "wallet TEXT NOT NULL)".format(Config.TABLE_ADDRESS))
+
+    rand = random.Random(seed)
+    for i in range(count):
+        address = "0x{:040x}".format(i)
+        balance = 0
+        for _ in range(rand.randint(1, 10)):
+            balance = round(rand.uniform(0.001, 1e6), 6)
+            day = dt - datetime.timedelta(days=rand.randint(1, 240))
+            cursor.execute("INSERT INTO {} VALUES (%s, %s, %s)".format(Config.TABLE_LOG), (address, balance, day))
+
+        # the current balance sometimes stays at the last log, sometimes moves away
+        balance = rand.choice([balance, round(balance * rand.uniform(0, 3), 6)])
+        cursor.execute("INSERT INTO {} VALUES (%s, %s, 'S')".format(Config.TABLE_ADDRESS), (address, balance))
+
+    return calc
+
+
+def test_columnar_parity():
+    dt = datetime.date(2021, 5, 7)
+    calc = make_synthetic_calc(8, dt)
+    cursor = calc.conn.cursor()
+
+    # the SQL path
+    expected = {}
+    cursor.execute("SELECT address, balance FROM {}".format(Config.TABLE_ADDRESS))
+    for address, balance in cursor.fetchall():
+        expected[address] = calc.calculate_lth_sth(address, dt, balance)
+
+    # the NumPy path
+    assert ColumnarCalc(calc).classify_addresses(dt)
+    cursor.execute("SELECT address, wallet FROM {}".format(Config.TABLE_ADDRESS))
+    actual = dict(cursor.fetchall())
+
+    mismatches = [address for address in expected if expected[address] != actual[address]]
+    print("{} addresses, {} STH, {} mismatches".format(
+        len(expected), list(expected.values()).count('S'), len(mismatches)))
+    assert not mismatches
+
+    calc.conn.close()
+
+
+def test_async_remote(windows=24):
+    """
+    Fetch windows of synthetic balance rows from the local PostgreSQL server standing in for anyblock.net,
+    with AsyncRemoteServer and RemoteServer, and compare them.
+    """
+    table = "balance_stand_in"
+    begin = datetime.datetime(2021, 5, 7)
+
+    # load the stand-in table
+    conn = psycopg2.connect(host=Config.LOCAL_SERVER, port=Config.LOCAL_PORT, user=Config.LOCAL_USER,
+                            password=Config.LOCAL_PASSWORD, dbname=Config.LOCAL_DB)
+    cursor = conn.cursor()
+    cursor.execute("DROP TABLE IF EXISTS {}".format(table))
+    cursor.execute("CREATE TABLE {} (block_number BIGINT, address TEXT, balance NUMERIC, timestamp TIMESTAMP)"
+                   .format(table))
+    rand = random.Random(16)
+    for i in range(5000):
+        timestamp = begin + datetime.timedelta(seconds=rand.randint(0, windows * Config.TIME_GAP))
+        cursor.execute("INSERT INTO {} VALUES (%s, %s, %s, %s)".format(table),
+                       (i, "0x{:040x}".format(rand.randint(0, 999)), rand.randint(0, 10 ** 22), timestamp))
+    conn.commit()
+
+    # the servers connect to the stand-in
+    saved = (Config.ANY_SERVER, Config.ANY_PORT, Config.ANY_USER, Config.ANY_PASSWORD, Config.ANY_DB)
+    Config.ANY_SERVER, Config.ANY_PORT, Config.ANY_USER, Config.ANY_PASSWORD, Config.ANY_DB = \
+        Config.LOCAL_SERVER, Config.LOCAL_PORT, Config.LOCAL_USER, Config.LOCAL_PASSWORD, Config.LOCAL_DB
+
+    server = RemoteServer()
+    async_server = AsyncRemoteServer()
+    try:
+        for remote in (server, async_server):
+            remote.table = table
+            remote.begin = begin
+
+        fetched = 0
+        for window_begin, window_end, data in async_server.parallel_fetch(8):
+            assert data is not False
+            expected = server.fetch_data(window_begin, window_end)
+            assert sorted(data) == sorted(expected)
+            fetched += len(data)
+            if window_end >= begin + datetime.timedelta(seconds=windows * Config.TIME_GAP):
+                break
+
+        print("{} rows in {} windows are the same".format(fetched, windows))
+        assert async_server.begin == window_end
+
+    finally:
+        server.close()
+        async_server.close()
+        Config.ANY_SERVER, Config.ANY_PORT, Config.ANY_USER, Config.ANY_PASSWORD, Config.ANY_DB = saved
+        cursor.execute("DROP TABLE {}".format(table))
+        conn.commit()
+        conn.close()
+
+
+def test_sqlite_calc_parity(days=200):
+    """
+    Run the same synthetic days through the PostgreSQL and the sqlite backends, and compare them day by day.
+    The PostgreSQL side uses temporary tables that shadow the real ones in this session.
+    """
+    postgres = LocalCalc()
+    cursor = postgres.conn.cursor()
+    cursor.execute("CREATE TEMP TABLE {} (address TEXT NOT NULL, balance DOUBLE PRECISION NOT NULL, "
+                   "ts DATE NOT NULL)".format(Config.TABLE_LOG))
+    cursor.execute("CREATE TEMP TABLE {} (address TEXT NOT NULL UNIQUE, balance DOUBLE PRECISION NOT NULL, "
+                   "wallet TEXT NOT NULL)".format(Config.TABLE_ADDRESS))
+
+    sqlite = SQLiteCalc(":memory:")
+    assert sqlite.create_tables()
+
+    chain = SyntheticChain(seed=21, addresses=300, rows=200, start=datetime.datetime(2021, 1, 1), churn=0.05)
+    for dt, data in chain.days(days):
+        rows = [(block, address, balance, calendar.timegm(ts.timetuple())) for block, address, balance, ts in data]
+
+        # the wallets are calculated on the next day, as do_calc does
+        day = dt.date() + datetime.timedelta(days=1)
+        for calc in (postgres, sqlite):
+            assert calc.add_logs(rows)
+            assert calc.classify_addresses(day)
+
+        expected = dict(postgres.get_lth_sth())
+        actual = dict(sqlite.get_lth_sth())
+        assert expected.keys() == actual.keys(), day
+        for wallet in expected:
+            assert abs(expected[wallet] - actual[wallet]) <= 1e-9 * abs(expected[wallet]), (day, wallet)
+
+    cursor.execute("SELECT address, balance, wallet FROM {} ORDER BY address".format(Config.TABLE_ADDRESS))
+    expected = cursor.fetchall()
+    actual = sqlite.conn.execute("SELECT address, balance, wallet FROM {} ORDER BY address"
+                                 .format(Config.TABLE_ADDRESS)).fetchall()
+    assert expected == actual
+
+    # the per address calculation of the row engine
+    mismatches = [address for address, balance, _ in expected[::10]
+                  if postgres.calculate_lth_sth(address, day, balance) != sqlite.calculate_lth_sth(address, day, balance)]
+    print("{} addresses, {} STH, {} mismatches".format(
+        len(expected), [row[2] for row in expected].count('S'), len(mismatches)))
+    assert not mismatches
+
+    postgres.conn.close()
+    sqlite.conn.close()
+
+
+def test_range_parity(days=200):
+    """
+    Run the same synthetic days one by one and through the range mode with a save in the middle,
+    on in-memory sqlite dbs, and compare the tables.
+    The range mode sums LTH/STH exactly, so the history may differ from the SQL sums in the last bits.
+    """
+    one = SQLiteCalc(":memory:")
+    assert one.create_tables()
+    calc = SQLiteCalc(":memory:")
+    assert calc.create_tables()
+
+    chain = SyntheticChain(seed=22, addresses=300, rows=200, start=datetime.datetime(2021, 1, 1), churn=0.05)
+    first = None
+    sweep = None
+    history = []
+
+    for i, (dt, data) in enumerate(chain.days(days)):
+        rows = [(block, address, balance, calendar.timegm(ts.timetuple())) for block, address, balance, ts in data]
+        day = dt.date() + datetime.timedelta(days=1)
+
+        # one by one
+        assert one.add_logs(rows)
+        assert one.classify_addresses(day)
+        totals = dict(one.get_lth_sth())
+        assert one.add_history(day, totals.get('L', 0) * Config.UNIT_CALC, totals.get('S', 0) * Config.UNIT_CALC)
+        one.conn.commit()
+
+        # the range mode, as LocalCalc.add_logs converts the rows
+        if sweep is None:
+            first = day
+            sweep = RangeSweep(calc, first)
+            assert sweep.load()
+
+        sweep.add_logs([(row[1], float(row[2]), datetime.datetime.utcfromtimestamp(int(row[3])).date())
+                        for row in rows])
+        lth, sth = sweep.classify(day)
+        history.append((day, lth * Config.UNIT_CALC, sth * Config.UNIT_CALC))
+
+        if i == days // 2:
+            assert sweep.save(history)
+            history = []
+
+    assert sweep.save(history)
+
+    for sql in ("SELECT address, balance, wallet FROM {} ORDER BY address".format(Config.TABLE_ADDRESS),
+                "SELECT address, balance, ts FROM {} ORDER BY address, ts, balance".format(Config.TABLE_LOG)):
+        assert one.conn.execute(sql).fetchall() == calc.conn.execute(sql).fetchall(), sql
+
+    expected = one.get_history()
+    actual = calc.get_history()
+    assert [row[0] for row in expected] == [row[0] for row in actual]
+    for row, other in zip(expected, actual):
+        for a, b in zip(row[1:], other[1:]):
+            assert abs(a - b) <= 1e-12 * max(abs(a), 1e-6), row
+
+    wallets = [row[0] for row in calc.conn.execute("SELECT wallet FROM {}".format(Config.TABLE_ADDRESS))]
+    print("{} days from {}, {} addresses, {} STH".format(len(actual), first, len(wallets), wallets.count('S')))
+
+    one.conn.close()
+    calc.conn.close()
+
+
+def test_state_snapshot(days=120):
+    """
+    Save a snapshot of the range mode in the middle of the days, reload it,
+    and check it gives the same LTH/STH on the following days as the state loaded from the calc db.
+    Also check the exact sums against fractions.
+    """
+    values = [random.uniform(-1, 1) * 2.0 ** random.randint(-1000, 1000) for _ in range(1000)] + [0.1] * 10
+    assert exact_total(np.array(values)) == sum(fractions.Fraction(v) for v in values) * 2 ** EXACT_SHIFT
+    # the float sum overflows here
+    assert exact_total(np.array([1e308, 1e308, -1e308])) == fractions.Fraction(1e308) * 2 ** EXACT_SHIFT
+
+    calc = SQLiteCalc(":memory:")
+    assert calc.create_tables()
+
+    chain = SyntheticChain(seed=23, addresses=300, rows=200, start=datetime.datetime(2021, 1, 1), churn=0.05)
+    sweep = None
+    loaded = None
+    fresh = None
+    history = []
+
+    with tempfile.TemporaryDirectory() as folder:
+        file = os.path.join(folder, "state.npz")
+
+        for i, (dt, data) in enumerate(chain.days(days)):
+            logs = [(address, float(balance), ts.date()) for _, address, balance, ts in data]
+            day = dt.date() + datetime.timedelta(days=1)
+
+            if sweep is None:
+                sweep = RangeSweep(calc, day)
+                assert sweep.load()
+
+            if loaded is not None:
+                loaded.merge(logs)
+                loaded.classify(day)
+                fresh.merge(logs)
+                fresh.classify(day)
+
+            sweep.add_logs(logs)
+            lth, sth = sweep.classify(day)
+            history.append((day, lth * Config.UNIT_CALC, sth * Config.UNIT_CALC))
+
+            if loaded is not None:
+                assert loaded.get_lth_sth() == fresh.get_lth_sth() == (lth, sth), day
+
+            if i == days // 2:
+                assert sweep.save(history)
+                history = []
+
+                last = calc.get_last_history()
+                assert sweep.state.save(last, file)
+
+                after = day + datetime.timedelta(days=1)
+                loaded = AddressState.load(after, last, file)
+                fresh = AddressState.from_calc(calc, after)
+                assert loaded is not None and fresh is not None
+                # the ids are in the order of the merges or of the addresses table
+                assert not loaded.get_dirty()
+                states = [{address: (state.balances[i], state.wallets[i]) for i, address in enumerate(state.addresses)}
+                          for state in (loaded, fresh)]
+                assert states[0] == states[1]
+
+                # a snapshot of other days or another history is not loaded
+                assert AddressState.load(day, last, file) is None
+                assert AddressState.load(after, (last[0], last[1] + 1, last[2]), file) is None
+
+    print("{} days, {} addresses".format(days, sweep.get_address_count()))
+
+    calc.conn.close()
+
+
+def test_address_book():
+    """
+    Encode two overlapping batches of addresses while the id cache overflows,
+    and check the ids stay the same and decode back.
+    """
+    saved = Config.ADDRESS_CACHE_SIZE
+    Config.ADDRESS_CACHE_SIZE = 10
+
+    with tempfile.TemporaryDirectory() as folder:
+        book = AddressBook(os.path.join(folder, "addresses.sqlite"))
+        try:
+            first = ["0x{:040x}".format(i) for i in range(8)]
+            second = first[4:] + ["0x{:040x}".format(i) for i in range(8, 12)] + ["not hex"]
+
+            first_ids = book.encode(first)
+            second_ids = book.encode(second)
+            assert first_ids is not False and second_ids is not False
+            assert second_ids[:4] == first_ids[4:]
+            assert len(set(first_ids + second_ids)) == 13
+            assert book.decode(first_ids + second_ids) == first + second
+            assert book.encode(first) == first_ids
+        finally:
+            book.close()
+            Config.ADDRESS_CACHE_SIZE = saved
+
+    print("13 addresses are encoded over a cache of 10")
+
+
+class FakeServer(RemoteServer):
+    """
+    A RemoteServer without a server, a balance row every 20 minutes from the origin.
+    It calls on_window after a window was recorded.
+    """
+    on_window = None
+
+    def connect(self):
+        return True
+
+    def close(self):
+        self.journal.close()
+
+    def fetch_data(self, begin, end, conn=None):
+        rows = []
+        i = max(0, -(-int((begin - ORIGIN).total_seconds()) // 1200))
+        while ORIGIN + datetime.timedelta(seconds=i * 1200) < end:
+            rows.append((i, "0x{:040x}".format(i % 37), (i % 11) * 10 ** 18,
+                         ORIGIN + datetime.timedelta(seconds=i * 1200)))
+            i += 1
+        return rows
+
+    def stream_data(self, begin, end):
+        return iter(self.fetch_data(begin, end))
+
+    def complete_window(self, begin, end, rows=None, checksum=None):
+        ret = super().complete_window(begin, end, rows, checksum)
+        if self.on_window is not None:
+            self.on_window(end)
+        return ret
+
+
+def test_backfill_interleave():
+    """
+    Cache the days in order while the back-fill caches the days ahead of it,
+    and check the in-order caching skips them, and every day's file is in place only when it is finished.
+    """
+    days = [ORIGIN.date() + datetime.timedelta(days=i) for i in range(7)]
+    midnights = [datetime.datetime.combine(day, datetime.time()) for day in days]
+    saved = (Config.TIME_GAP, Config.STATUS_CACHE, do_cache.RemoteServer, signal.getsignal(signal.SIGINT))
+    cwd = os.getcwd()
+
+    def run(stop, hook=None):
+        def on_window(end):
+            if hook is not None:
+                hook(end)
+            if end >= stop:
+                do_cache.terminate = True
+
+        FakeServer.on_window = staticmethod(on_window)
+        do_cache.terminate = False
+        do_cache.main()
+
+    def expected(day):
+        local = LocalCache(os.path.join(folder, "expected-{}.sqlite".format(day)))
+        local.create_table()
+        assert local.proc_record(backfill.remote.fetch_data(*backfill.day_bounds(day, ORIGIN)))
+        return local
+
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        os.mkdir("dbs")
+        Config.TIME_GAP = 3 * 3600
+        Config.STATUS_CACHE = "status.cache"
+        do_cache.RemoteServer = FakeServer
+        backfill.remote = FakeServer()
+        backfill.book = None
+        argv = sys.argv
+        sys.argv = ["do_cache.py"]
+
+        try:
+            # the day 2 was back-filled, and a worker caches the day 4
+            assert backfill.cache_day(days[2]) > 0
+            assert backfill.remote.journal.claim(midnights[4], midnights[5], "backfill-0")
+
+            def hook(end):
+                if end == midnights[1] + datetime.timedelta(hours=12):
+                    # the in-order caching holds the day 1, and the back-fill goes ahead of it
+                    assert backfill.cache_day(days[1]) is None
+                    assert backfill.cache_day(days[3]) > 0
+
+            # stop in the middle of the day 5
+            run(midnights[5] + datetime.timedelta(hours=12), hook)
+
+            for i in (0, 1, 2, 3):
+                assert os.path.isfile(shard_file(days[i])), days[i]
+            assert not os.path.isfile(shard_file(days[4])) and not os.path.isfile(shard_file(days[4]) + ".tmp")
+            assert not os.path.isfile(shard_file(days[5])) and os.path.isfile(shard_file(days[5]) + ".tmp")
+
+            # the worker finishes the day 4, and the in-order caching resumes the day 5
+            backfill.remote.journal.release(midnights[4])
+            assert backfill.cache_day(days[4]) > 0
+            run(midnights[6] + datetime.timedelta(days=1))
+
+            for day in days:
+                cache = LocalCache(shard_file(day))
+                reference = expected(day)
+                assert sorted(cache.iter_all()) == sorted(reference.iter_all()), day
+                cache.close()
+                reference.close()
+            assert not [file for file in os.listdir("dbs") if file.endswith(".tmp")]
+
+            journal = backfill.remote.journal
+            assert journal.gaps(ORIGIN, midnights[6] + datetime.timedelta(days=1)) == []
+            assert journal.get_intervals("claimed") == []
+            print("{} days are cached in order and by the back-fill".format(len(days)))
+
+        finally:
+            backfill.remote.close()
+            backfill.remote = None
+            sys.argv = argv
+            os.chdir(cwd)
+            Config.TIME_GAP, Config.STATUS_CACHE, do_cache.RemoteServer, handler = saved
+            signal.signal(signal.SIGINT, handler)
+
+
 if __name__ == "__main__":
 
+    # the tests of the remote server and the local PostgreSQL server
     # test_remote_connect()
-    # test_timestamp()
-    test_local()
     # test_remote_server()
+    # test_columnar_parity()
+    # test_async_remote()
+    # test_sqlite_calc_parity()
+
+    test_timestamp()
+    test_local()
+    test_address_book()
+    test_range_parity()
+    test_state_snapshot()
+    test_backfill_interleave()